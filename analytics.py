@@ -0,0 +1,404 @@
+import argparse
+import csv
+import datetime
+import glob
+import os
+import sys
+
+import numpy as np
+
+from log_archive import LogArchive, ARCHIVE_EXT, TIME_COLUMNS
+
+# ====== 入退室ログの集計 ======
+# entry_log_*.csv / .lgz（と esp32_log_*）を列ごとの NumPy 配列に読み込み、
+# 行ごとの Python ループを使わずに次の集計を行う。
+#   dwell     : idm ごとの滞在時間（入室〜退室の組）
+#   occupancy : 在室人数の推移（一定間隔ごとの人数と区間内の最大人数）
+#   hourly    : 時間帯ごとの入室・退室件数と平均在室人数（ピーク時間帯）
+#   pir       : 人感センサーの検知とカード読み取りの対応
+# 時刻は "YYYY-MM-DD HH:MM:SS" をそのまま1970年からの秒数にして扱う（log_archive.py と同じ）。
+# サーバーのログ（timestamp,idm,name,action）とクライアントのログ（scan_time,...）の両方を読める。
+
+IN_ACTIONS = ["入室", "IN"]
+OUT_ACTIONS = ["退室", "OUT"]
+FORCE_CHECKOUT_TIME = "20:00"  # 強制退室（force_checkout_all / force_exit_process）を行う時刻
+MAX_SESSION_HOURS = 24  # これより長い入室〜退室は組にしない（退室漏れとみなす）
+MOTION_WINDOW = 60  # カード読み取りと人感センサーの検知を対応付ける前後の秒数
+DAY = 86400
+
+ENTRY_COLUMNS = {"ts": ("timestamp", "scan_time"), "idm": ("idm",), "name": ("name",), "action": ("action",)}
+ESP32_COLUMNS = {"ts": ("timestamp",), "message": ("message",)}
+
+
+# ====== 読み込み ======
+def find_log_files(prefix, since=None, until=None, directory="."):
+    """prefix_YYYY-MM-DD.csv / .lgz を日付順に返す（同じ日はアーカイブ → CSV の順）"""
+    files = []
+    for path in glob.glob(os.path.join(directory, f"{prefix}_*")):
+        base, ext = os.path.splitext(os.path.basename(path))
+        date_str = base[len(prefix) + 1:]
+        if ext not in (".csv", ARCHIVE_EXT):
+            continue
+        try:
+            datetime.datetime.strptime(date_str, "%Y-%m-%d")
+        except ValueError:
+            continue
+        if (since and date_str < since[:10]) or (until and date_str > until[:10]):
+            continue
+        files.append((date_str, ext == ".csv", path))
+    return [path for _, _, path in sorted(files)]
+
+
+def parse_times(values):
+    """時刻の文字列の配列を秒数の配列にする。読めない値は -1"""
+    values = np.asarray(values, dtype=str)
+    try:
+        seconds = values.astype("datetime64[s]").astype(np.int64)
+    except ValueError:
+        seconds = np.empty(len(values), dtype=np.int64)
+        for i, value in enumerate(values):
+            try:
+                seconds[i] = np.datetime64(value, "s").astype(np.int64)
+            except ValueError:
+                seconds[i] = -1
+    seconds[seconds == np.iinfo(np.int64).min] = -1  # 空文字（NaT）
+    return seconds
+
+
+def to_seconds(value, end_of_day=False):
+    """"YYYY-MM-DD[ HH:MM:SS]" を秒数にする。end_of_day なら日付だけの指定はその日の終わり"""
+    seconds = int(parse_times([value])[0])
+    if seconds < 0:
+        raise ValueError(f"日時の形式が不正です: {value}")
+    if end_of_day and len(value) == 10:
+        seconds += DAY - 1
+    return seconds
+
+
+def select_columns(path, header, columns):
+    """columns（{出力名: (列名の候補, ...)}）それぞれについて header 中の列番号を返す"""
+    selected = {}
+    for key, names in columns.items():
+        for name in names:
+            if name in header:
+                selected[key] = (header.index(name), name in TIME_COLUMNS)
+                break
+        else:
+            raise ValueError(f"{path} に {names} の列がありません")
+    return selected
+
+
+def empty_columns(columns):
+    return {key: np.zeros(0, dtype=np.int64 if names[0] in TIME_COLUMNS else str)
+            for key, names in columns.items()}
+
+
+def read_log_file(path, columns):
+    """1ファイルを読み、指定した列を配列で返す（時刻の列は秒数、それ以外は文字列）"""
+    if path.endswith(ARCHIVE_EXT):
+        archive = LogArchive(path)
+        selected = select_columns(path, archive.columns, columns)
+        if not archive.blocks:
+            return empty_columns(columns)
+        blocks = [archive.read_columns(n) for n in range(len(archive.blocks))]
+        result = {}
+        for key, (i, is_time) in selected.items():
+            raw = np.concatenate([np.asarray(block[i]) for block in blocks])
+            if i in archive.time_columns:
+                result[key] = raw.astype(np.int64)
+                continue
+            values = np.asarray(archive.dicts[i], dtype=str)[raw]
+            result[key] = parse_times(values) if is_time else values
+        return result
+
+    with open(path, newline='', encoding='utf-8') as f:
+        rows = list(csv.reader(f))
+    if not rows:
+        return empty_columns(columns)
+    header = rows[0]
+    selected = select_columns(path, header, columns)
+    rows = [row for row in rows[1:] if len(row) == len(header)]  # 書きかけ・壊れた行は除く
+    if not rows:
+        return empty_columns(columns)
+    table = np.array(rows, dtype=str)
+    return {key: parse_times(table[:, i]) if is_time else table[:, i]
+            for key, (i, is_time) in selected.items()}
+
+
+def load_logs(paths, columns):
+    parts = [read_log_file(path, columns) for path in paths]
+    if not parts:
+        return empty_columns(columns)
+    return {key: np.concatenate([part[key] for part in parts]) for key in columns}
+
+
+def load_entry_events(prefix="entry_log", since=None, until=None, directory="."):
+    """
+    入退室ログを読み込む。戻り値は
+      ts（秒数） / idm（idms の番号） / is_in（入室なら True） / idms / names（idm ごとの最新の名前）
+    の辞書。入室・退室以外の行と時刻の読めない行は除く。
+    """
+    data = load_logs(find_log_files(prefix, since, until, directory), ENTRY_COLUMNS)
+    is_in = np.isin(data["action"], IN_ACTIONS)
+    keep = (is_in | np.isin(data["action"], OUT_ACTIONS)) & (data["ts"] >= 0)
+    if since:
+        keep &= data["ts"] >= to_seconds(since)
+    if until:
+        keep &= data["ts"] <= to_seconds(until, end_of_day=True)
+
+    idms, codes = np.unique(data["idm"][keep], return_inverse=True)
+    names = data["name"][keep]
+    last = np.zeros(len(idms), dtype=np.int64)
+    np.maximum.at(last, codes, np.arange(len(codes)))
+    return {
+        "ts": data["ts"][keep],
+        "idm": codes.astype(np.int64),
+        "is_in": is_in[keep],
+        "idms": idms,
+        "names": names[last] if len(names) else names,
+    }
+
+
+def load_motion_events(prefix="esp32_log", since=None, until=None, directory="."):
+    """人感センサーの検知（MOTION_DETECTED）の時刻と距離（cm、不明なら nan）を読み込む"""
+    data = load_logs(find_log_files(prefix, since, until, directory), ESP32_COLUMNS)
+    keep = np.char.startswith(data["message"], "MOTION_DETECTED") & (data["ts"] >= 0)
+    if since:
+        keep &= data["ts"] >= to_seconds(since)
+    if until:
+        keep &= data["ts"] <= to_seconds(until, end_of_day=True)
+    ts = data["ts"][keep]
+    values = np.char.partition(data["message"][keep], "DISTANCE=")[:, 2] if keep.any() else np.zeros(0, str)
+    try:
+        distance = np.where(values == "", "nan", values).astype(float)
+    except ValueError:
+        distance = np.array([float(v) if v.replace(".", "", 1).lstrip("-").isdigit() else np.nan
+                             for v in values])
+    distance[distance < 0] = np.nan  # 測定失敗
+    order = np.argsort(ts, kind="stable")
+    return {"ts": ts[order], "distance": distance[order]}
+
+
+# ====== 滞在の組み立て ======
+def pair_sessions(events, max_hours=MAX_SESSION_HOURS):
+    """
+    idm ごとに入室と退室を組にする。同じ操作が続いた場合は状態の変わった最初の行を使う
+    （入室中の再入室は無視し、退室済みの再退室も無視する。サーバーの entry_state と同じ扱い）。
+    強制退室の時刻ちょうどの退室は forced として印を付ける。戻り値の辞書:
+      idm / start / end / forced : 組になった滞在
+      open_idm / open_start      : 最後の行が入室のまま（現在入室中）の idm と入室時刻
+      dropped                    : max_hours を超えたため組にしなかった件数
+    """
+    order = np.lexsort((events["ts"], events["idm"]))  # 同時刻はファイル上の順
+    ts = events["ts"][order]
+    idm = events["idm"][order]
+    is_in = events["is_in"][order]
+
+    changed = np.ones(len(ts), dtype=bool)
+    changed[1:] = (idm[1:] != idm[:-1]) | (is_in[1:] != is_in[:-1])
+    ts, idm, is_in = ts[changed], idm[changed], is_in[changed]
+
+    same_next = np.zeros(len(ts), dtype=bool)
+    same_next[:-1] = idm[:-1] == idm[1:]
+    first = np.flatnonzero(is_in & same_next)  # 変化した行だけなので次の行は退室
+    start, end = ts[first], ts[first + 1]
+    ok = end - start <= max_hours * 3600
+
+    hour, minute = (int(v) for v in FORCE_CHECKOUT_TIME.split(":"))
+    forced = (end % DAY) // 60 == hour * 60 + minute
+    still_in = np.flatnonzero(is_in & ~same_next)
+    return {
+        "idm": idm[first][ok],
+        "start": start[ok],
+        "end": end[ok],
+        "forced": forced[ok],
+        "open_idm": idm[still_in],
+        "open_start": ts[still_in],
+        "dropped": int((~ok).sum()),
+    }
+
+
+# ====== 集計 ======
+def dwell_report(events, sessions):
+    """idm ごとの滞在回数・合計・平均・中央値・最長と強制退室の回数"""
+    k = len(events["idms"])
+    who = sessions["idm"]
+    duration = (sessions["end"] - sessions["start"]).astype(np.int64)
+    count = np.bincount(who, minlength=k)
+    total = np.bincount(who, weights=duration, minlength=k)
+    longest = np.zeros(k, dtype=np.int64)
+    np.maximum.at(longest, who, duration)
+    forced = np.bincount(who, weights=sessions["forced"], minlength=k)
+
+    # 中央値: idm・滞在時間の順に並べ、各 idm の区間の真ん中を取る
+    ordered = duration[np.lexsort((duration, who))]
+    begin = np.cumsum(count) - count
+    low = np.clip(begin + (count - 1) // 2, 0, max(len(ordered) - 1, 0))
+    high = np.clip(begin + count // 2, 0, max(len(ordered) - 1, 0))
+    median = (ordered[low] + ordered[high]) / 2 if len(ordered) else np.zeros(k)
+
+    header = ["idm", "name", "sessions", "total_hours", "mean_minutes", "median_minutes",
+              "max_minutes", "forced_checkouts"]
+    rows = []
+    for i in np.argsort(-total, kind="stable"):
+        if not count[i]:
+            continue
+        rows.append([events["idms"][i], events["names"][i], int(count[i]),
+                     round(total[i] / 3600, 2), round(total[i] / count[i] / 60, 1),
+                     round(median[i] / 60, 1), round(longest[i] / 60, 1), int(forced[i])])
+    return header, rows
+
+
+def occupancy_series(sessions, since=None, until=None, step=3600):
+    """
+    在室人数の推移。step 秒ごとの時刻 t について (t, t時点の人数, [t, t+step) の最大人数) を返す。
+    現在入室中の滞在は until（省略時は最後の記録）まで在室として数える。
+    """
+    start = np.concatenate([sessions["start"], sessions["open_start"]])
+    end = sessions["end"]
+    if not len(start):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    t0 = to_seconds(since) if since else int(start.min()) // step * step
+    t1 = to_seconds(until, end_of_day=True) if until else int(max(start.max(), end.max() if len(end) else 0))
+    end = np.concatenate([end, np.full(len(sessions["open_start"]), t1 + 1, dtype=np.int64)])
+    grid = np.arange(t0, t1 + 1, step, dtype=np.int64)
+
+    starts, ends = np.sort(start), np.sort(end)
+    at = np.searchsorted(starts, grid, "right") - np.searchsorted(ends, grid, "right")
+
+    # 区間内の最大: 入室(+1)・退室(-1)を時刻順に累積し、区間ごとの最大を取る
+    times = np.concatenate([start, end])
+    delta = np.concatenate([np.ones(len(start), dtype=np.int64), -np.ones(len(end), dtype=np.int64)])
+    order = np.lexsort((delta, times))  # 同時刻は退室を先に
+    times, level = times[order], np.cumsum(delta[order])
+    inside = (times >= grid[0]) & (times < grid[-1] + step)
+    peak = at.copy()
+    if inside.any():
+        bins = (times[inside] - t0) // step
+        np.maximum.at(peak, bins, level[inside])
+    return grid, at, peak
+
+
+def hourly_report(events, sessions, since=None, until=None):
+    """時間帯（0〜23時）ごとの入室・退室件数と、在室人数の平均・最大"""
+    hour_of = (events["ts"] % DAY) // 3600
+    entries = np.bincount(hour_of[events["is_in"]], minlength=24)
+    exits = np.bincount(hour_of[~events["is_in"]], minlength=24)
+    grid, at, peak = occupancy_series(sessions, since, until, step=3600)
+    hours = (grid % DAY) // 3600
+    samples = np.bincount(hours, minlength=24)
+    mean = np.bincount(hours, weights=at, minlength=24) / np.maximum(samples, 1)
+    highest = np.zeros(24, dtype=np.int64)
+    np.maximum.at(highest, hours, peak)
+
+    header = ["hour", "entries", "exits", "mean_occupancy", "max_occupancy"]
+    rows = [[f"{h:02d}:00", int(entries[h]), int(exits[h]), round(float(mean[h]), 2), int(highest[h])]
+            for h in range(24)]
+    return header, rows
+
+
+def nearest_lag(targets, sources):
+    """sources（時刻順）の各時刻について、最も近い targets（時刻順）との差（target - source）"""
+    if not len(targets):
+        return np.full(len(sources), np.inf)
+    idx = np.searchsorted(targets, sources)
+    before = targets[np.clip(idx - 1, 0, len(targets) - 1)] - sources
+    after = targets[np.clip(idx, 0, len(targets) - 1)] - sources
+    return np.where(np.abs(before) <= np.abs(after), before, after).astype(float)
+
+
+def pir_report(events, motions, window=MOTION_WINDOW):
+    """カード読み取りの前後 window 秒に人感センサーの検知があったか、検知に読み取りが伴ったか"""
+    scans = np.sort(events["ts"])
+    scan_lag = nearest_lag(motions["ts"], scans)
+    motion_lag = nearest_lag(scans, motions["ts"])
+    scan_matched = np.abs(scan_lag) <= window
+    motion_matched = np.abs(motion_lag) <= window
+
+    # 時間ごとの件数の相関（両方の記録がある期間のみ）
+    corr = float("nan")
+    if len(scans) and len(motions["ts"]):
+        t0 = max(scans[0], motions["ts"][0]) // 3600
+        t1 = min(scans[-1], motions["ts"][-1]) // 3600
+        if t1 > t0:
+            def per_hour(ts):
+                hours = ts // 3600
+                hours = hours[(hours >= t0) & (hours <= t1)]
+                return np.bincount(hours - t0, minlength=t1 - t0 + 1)
+            a, b = per_hour(scans), per_hour(motions["ts"])
+            if a.std() and b.std():
+                corr = float(np.corrcoef(a, b)[0, 1])
+
+    def mean(values):
+        values = values[~np.isnan(values)]
+        return round(float(values.mean()), 2) if len(values) else ""
+
+    header = ["item", "value"]
+    rows = [
+        ["scans", len(scans)],
+        ["scans_with_motion", int(scan_matched.sum())],
+        ["scan_motion_rate", round(float(scan_matched.mean()), 3) if len(scans) else ""],
+        ["median_motion_lag_seconds", float(np.median(scan_lag[scan_matched])) if scan_matched.any() else ""],
+        ["motions", len(motions["ts"])],
+        ["motions_with_scan", int(motion_matched.sum())],
+        ["motions_without_scan", int((~motion_matched).sum())],
+        ["mean_distance_with_scan_cm", mean(motions["distance"][motion_matched])],
+        ["mean_distance_without_scan_cm", mean(motions["distance"][~motion_matched])],
+        ["hourly_correlation", round(corr, 3) if not np.isnan(corr) else ""],
+    ]
+    return header, rows
+
+
+# ====== コマンドライン ======
+def write_table(header, rows, output=None):
+    f = open(output, "w", newline='', encoding="utf-8") if output else sys.stdout
+    try:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    finally:
+        if output:
+            f.close()
+
+
+def main():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--dir", default=".", help="ログのあるディレクトリ")
+    common.add_argument("--prefix", default="entry_log", help="入退室ログの接頭辞（クライアントの写しは server_log）")
+    common.add_argument("--since", help="集計の開始（YYYY-MM-DD[ HH:MM:SS]）")
+    common.add_argument("--until", help="集計の終了（YYYY-MM-DD[ HH:MM:SS]）")
+    common.add_argument("-o", "--output", help="結果のCSVの出力先（既定: 標準出力）")
+
+    parser = argparse.ArgumentParser(description="入退室ログの集計")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("dwell", parents=[common], help="idm ごとの滞在時間")
+    p = sub.add_parser("occupancy", parents=[common], help="在室人数の推移")
+    p.add_argument("--step", type=int, default=3600, help="集計の間隔（秒）")
+    sub.add_parser("hourly", parents=[common], help="時間帯ごとの入退室件数と在室人数")
+    p = sub.add_parser("pir", parents=[common], help="人感センサーの検知とカード読み取りの対応")
+    p.add_argument("--esp32-prefix", default="esp32_log", help="ESP32ログの接頭辞")
+    p.add_argument("--window", type=int, default=MOTION_WINDOW, help="対応付ける前後の秒数")
+    args = parser.parse_args()
+
+    events = load_entry_events(args.prefix, args.since, args.until, args.dir)
+    sessions = pair_sessions(events)
+    print(f"[analytics] {len(events['ts'])} 件の入退室、{len(sessions['start'])} 件の滞在"
+          f"（入室中 {len(sessions['open_start'])} 件、除外 {sessions['dropped']} 件）", file=sys.stderr)
+
+    if args.command == "dwell":
+        header, rows = dwell_report(events, sessions)
+    elif args.command == "occupancy":
+        grid, at, peak = occupancy_series(sessions, args.since, args.until, args.step)
+        header = ["time", "occupancy", "peak"]
+        times = np.char.replace(grid.astype("datetime64[s]").astype(str), "T", " ")
+        rows = zip(times, at.tolist(), peak.tolist())
+    elif args.command == "hourly":
+        header, rows = hourly_report(events, sessions, args.since, args.until)
+    else:
+        motions = load_motion_events(args.esp32_prefix, args.since, args.until, args.dir)
+        header, rows = pir_report(events, motions, args.window)
+    write_table(header, rows, args.output)
+
+
+if __name__ == "__main__":
+    main()
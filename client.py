@@ -6,24 +6,90 @@ import datetime
 import socket
 import os
 import csv
-from plyer import notification
-import winsound
+import json
+import zlib
+import contextlib
+import uuid
+import random
+import queue
+import asyncio
+import re
 import tkinter as tk
 from tkinter import simpledialog, scrolledtext, messagebox
 
+from log_writer import DailyLogWriter
+from log_archive import archive_old_logs
+from scheduler import Scheduler
+from retry_queue import RetryQueue
+from notifier import NotificationService, PRIORITY_SCAN, PRIORITY_ALERT, PRIORITY_MOTION
+
 # ----- 設定値 -----
 DLL_PATH = "felica.libのパス"
 SERVER_IP = "サーバのIPアドレス"
 SERVER_PORT = 12345
 ENTRY_TIMEOUT = 30
-RETRY_LOG_FILE = "retry_log.csv"
+RETRY_LOG_FILE = "retry_log.csv"  # 旧形式の再送ログ（起動時に再送キューへ移す）
+RETRY_QUEUE_DIR = "retry_queue"  # 再送キュー（retry_queue.py）のディレクトリ
+RETRY_QUEUE_FSYNC = True  # 再送キューへの追記ごとにfsync（電源断でも未送信分が残る）
+RETRY_BATCH_SIZE = 200  # 再送時に1リクエストへまとめるイベント数
+LOG_CURSOR_FILE = "log_cursor.json"  # サーバーログの取得済み位置
 PASORI_SUCCESS = 0
 ESP32_PORT = 50000 
+ESP32_READ_TIMEOUT = 60  # ESP32 からの接続でこの秒数なにも届かなければ切断する
+ESP32_MAX_LINE = 1024  # ESP32 から受け取る1行の最大長（バイト）
+ESP32_MAX_CONNECTIONS = 64  # 同時に受け付ける ESP32 の接続数の上限
+ESP32_STALE_ALERT = 60  # 検知からこの秒数以上たって届いたイベント（送信待ちだった分）は音・通知・サーバー転送をせずログのみ
+ESP32_SEEN_BOOTS = 8  # センサーごとに重複判定の連番を覚えておく起動IDの数
+LOG_FLUSH_INTERVAL = 1.0  # ログをまとめて書き込む間隔（秒）。0 で即時書き込み
+LOG_FLUSH_ROWS = 100  # この行数がたまったら間隔を待たずに書き込む
+LOG_FSYNC = "never"  # "never": flushのみ / "batch": まとめ書きごとにfsync（log_writer.py参照）
+ARCHIVE_AFTER_DAYS = 1  # この日数より前のログをアーカイブ（.lgz）へ変換する
+ARCHIVE_INTERVAL = 3600  # アーカイブ対象を確認する間隔（秒）
+FORCE_EXIT_TIME = "20:00"  # 入室中の人を強制退室させる時刻
+RETRY_INTERVAL = 30  # 再送キューに送れなかった行が残っているとき、次に送り直すまでの秒数
+RETRY_BACKOFF_MIN = 5  # サーバーに送れなかったときに再送を待つ秒数（失敗するたびに倍）
+RETRY_BACKOFF_MAX = 600  # 再送を待つ秒数の上限
+SCHEDULER_HISTORY_FILE = "scheduler_history.json"  # 定時処理の実行記録
+SUBSCRIBE_TIMEOUT = 90  # サーバーの通知（HEARTBEAT含む）がこの秒数途切れたら再接続する
+SUBSCRIBE_RETRY_INTERVAL = 30  # 通知の購読に失敗したときに再接続するまでの秒数
+POOL_SIZE = 4  # 使い回すサーバー接続の最大数
+POOL_IDLE_CHECK = 30  # これ以上使っていない接続は貸し出す前に PING で確認する（秒）
+POOL_MAX_IDLE = 600  # これ以上使っていない接続は確認せずに閉じて作り直す（秒）
+KEEPALIVE_IDLE = 60  # 無通信がこの秒数続いたら TCP keepalive を送り始める
+KEEPALIVE_INTERVAL = 10  # TCP keepalive の送信間隔（秒）
+SCAN_QUEUE_SIZE = 256  # 読み取り済みでサーバーとのやり取りを待つスキャンの上限
+NOTIFY_QUEUE_SIZE = 32  # 表示・再生を待つ通知の上限（あふれたら優先度の低い古い通知から捨てる）
+NOTIFY_AUDIO = "auto"  # 音のバックエンド: "winsound" / "null"（"auto" は使えるものを選ぶ）
+NOTIFY_TOAST = "auto"  # 通知表示のバックエンド: "plyer" / "null"
+MOTION_ALERT_COOLDOWN = 3.0  # 人感センサーの検知音を続けて鳴らさない秒数（その間の検知は1回にまとめる）
+REGISTRATION_POLL_INTERVAL = 200  # GUIスレッドが未登録IDの名前入力の依頼を確認する間隔（ミリ秒）
 
 # ----- 状態保持 -----
 entry_state = {}
 id_name_map = {}
 server_available = True
+server_entry_view = {"epoch": None, "version": 0, "entries": {}}  # サーバーの入退室状態の写し（差分で更新）
+
+entry_log_writer = DailyLogWriter(
+    "entry_log", ["scan_time", "send_time", "idm", "name", "action", "status"],
+    flush_interval=LOG_FLUSH_INTERVAL, flush_rows=LOG_FLUSH_ROWS, fsync=LOG_FSYNC)
+retry_queue = RetryQueue(RETRY_QUEUE_DIR, fsync=RETRY_QUEUE_FSYNC)
+retry_wakeup = threading.Event()  # 再送ワーカーを起こす（行の追加・サーバーの復旧）
+retry_next_attempt = 0.0  # バックオフ中はこの時刻（time.monotonic()）まで再送しない
+esp32_log_writer = DailyLogWriter(
+    "esp32_log", ["timestamp", "message", "status"],
+    flush_interval=LOG_FLUSH_INTERVAL, flush_rows=LOG_FLUSH_ROWS, fsync=LOG_FSYNC)
+scan_queue = queue.Queue(maxsize=SCAN_QUEUE_SIZE)  # (idm, スキャン時刻, イベントID, 積んだ時刻, 入力された名前)
+registration_queue = queue.Queue()  # 名前の入力を待つ未登録の idm（GUIスレッドが取り出す）
+registration_lock = threading.Lock()
+pending_registrations = {}  # idm -> 名前の入力を待っているスキャン [(スキャン時刻, イベントID), ...]
+pipeline_stats_lock = threading.Lock()
+pipeline_stats = {}  # 段階名 -> {"count", "total", "max"}（秒）
+esp32_sensors = {}  # センサーID -> {"addr", "last_seen", "events"}（ESP32受信のイベントループからのみ更新）
+esp32_connections = 0  # 受付中の ESP32 の接続数
+notifier = NotificationService(NOTIFY_AUDIO, NOTIFY_TOAST, max_pending=NOTIFY_QUEUE_SIZE,
+                               cooldown=MOTION_ALERT_COOLDOWN,
+                               on_latency=lambda stage, seconds: record_latency(stage, seconds))
 
 # ----- FeliCa構造体定義 -----
 class Felica(ctypes.Structure):
@@ -34,65 +100,177 @@ class Felica(ctypes.Structure):
         ("system_code", ctypes.c_ushort)
     ]
 
-# ===== 音声関数の強化 =====
-def play_enter_sound():
-    """入室時の音"""
-    print("🔊 入室: 高い音を再生")
-    winsound.Beep(880, 500)  # 高い音（880Hz）
+# ===== 通知（notifier.py の専用スレッドで表示・再生） =====
+def notify_scan_result(name, action, local=False):
+    """この端末で読み取ったカードの結果（最優先）"""
+    if local:
+        notifier.notify(PRIORITY_SCAN, f"{name}さん", f"{action}（ローカル記録）",
+                        sound="enter" if action == "入室" else "exit")
+    else:
+        notifier.notify(PRIORITY_SCAN, f"{name}さん", f"{action}が記録されました", sound="recorded")
 
-def play_exit_sound():
-    """退室時の音"""
-    print("🔊 退室: 低い音を再生")
-    winsound.Beep(440, 500)  # 低い音（440Hz）
+def notify_remote_entry(is_in):
+    """他のクライアントでの入退室（音のみ）"""
+    notifier.notify(PRIORITY_ALERT, sound="enter" if is_in else "exit")
 
-def play_motion_alert_sound():
-    """動き検知時の音"""
-    print("🔊 動き検知: 短い音")
-    winsound.Beep(660, 200)  # 中くらいの音（660Hz）
-    time.sleep(0.5)
-    winsound.Beep(660, 200)  # 中くらいの音（660Hz）
+def notify_motion(distance, sensor=None):
+    """人感センサーの検知（同じセンサーから続けて届いた分はまとめる）"""
+    title = f"ESP32通知（{sensor}）" if sensor else "ESP32通知"
+    notifier.notify(PRIORITY_MOTION, title, f"動き検知 → 距離: {distance}", sound="motion",
+                    key=f"motion:{sensor}" if sensor else "motion")
 
 # ===== ESP32からの通知受信 =====
+# 複数の ESP32 からの接続を1つのイベントループで受け付ける（1台が止まっても他の通知は遅れない）。
+# 1行が1メッセージで、1つの接続で複数行を続けて送ってよい:
+#   MOTION_DETECTED[,DISTANCE=<cm>][,SENSOR=<センサーID>][,BOOT=<起動ID>,SEQ=<連番>][,TS=<検知日時>]
+#   SYNC  : それまでに受け取ったイベントの最後を ACK,<起動ID>,<連番> で返す（main.py はこれを受けてバッファから消す）
+#   PING  : 接続の維持のみ
+# SENSOR が無い場合は送信元のIPアドレスをセンサーIDとする。TS（ESP32 の NTP 同期済みの時刻）があればログにはその時刻を使う。
+# 同じ起動ID・連番のイベントが再送されても記録は1回だけにする（ACK が届かずに送り直された場合）。
+# 通知は notifier、ログは esp32_log_writer、サーバーへの転送はスレッドプールに渡すだけで、ここでは待たない。
+SENSOR_ID_PATTERN = re.compile(r"^[0-9A-Za-z_.:-]{1,32}$")
+
 def esp32_listener():
-    """ESP32からの通知を受けて音を鳴らし、ログ保存"""
+    """ESP32からの通知の受け付けを開始する（専用スレッドで呼ぶ）"""
+    try:
+        asyncio.run(serve_esp32())
+    except Exception as e:
+        print(f"[ESP32受信エラー] {e}")
+
+async def serve_esp32():
+    server = await asyncio.start_server(handle_esp32, "", ESP32_PORT,  # すべてのインターフェースで待機
+                                        limit=ESP32_MAX_LINE, reuse_address=True)
     print(f"[ESP32受信] ポート {ESP32_PORT} で待機中...")
+    async with server:
+        await server.serve_forever()
+
+async def handle_esp32(reader, writer):
+    global esp32_connections
+    addr = writer.get_extra_info("peername")
+    if esp32_connections >= ESP32_MAX_CONNECTIONS:
+        print(f"[ESP32受信] 接続数が上限に達しているため切断: {addr}")
+        writer.close()
+        return
+    esp32_connections += 1
+    session = {"last_event": None}  # この接続で最後に受け取った (起動ID, 連番)
     try:
-        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_sock.bind(("", ESP32_PORT))  # すべてのインターフェースで待機
-        server_sock.listen(1)
         while True:
-            client_sock, addr = server_sock.accept()
-            print(f"[ESP32受信] 接続: {addr}")
-            data = client_sock.recv(1024).decode().strip()
-            print(f"[ESP32受信] メッセージ: {data}")
-
-            timestamp = datetime.datetime.now()
-
-            # --- メッセージ解析 ---
-            if data.startswith("MOTION_DETECTED"):
-                distance = "Unknown"
-                if "DISTANCE=" in data:
-                    try:
-                        distance_str = data.split("DISTANCE=")[1]
-                        distance_value = float(distance_str)
-                        if distance_value < 0:
-                            distance = "Error"  # 測定失敗扱い
-                        else:
-                            distance = f"{distance_value:.2f} cm"
-                    except Exception as e:
-                        print(f"[ESP32受信] 距離パースエラー: {e}")
-                        distance = "ParseError"
-
-                play_motion_alert_sound()
-                notify_user("ESP32通知", f"動き検知 → 距離: {distance}")
-                save_esp32_log(timestamp, data, distance)
-            else:
-                print(f"[ESP32受信] 未知のメッセージ: {data}")
-                save_esp32_log(timestamp, data, "UNKNOWN")
-
-            client_sock.close()
+            try:
+                line = await asyncio.wait_for(reader.readline(), ESP32_READ_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"[ESP32受信] {ESP32_READ_TIMEOUT} 秒間受信が無いため切断: {addr}")
+                break
+            except ValueError:  # 1行が ESP32_MAX_LINE を超えた
+                print(f"[ESP32受信] 行が長すぎるため切断: {addr}")
+                break
+            if not line:
+                break
+            message = line.decode(errors="replace").strip()
+            if message == "SYNC":
+                boot, seq = session["last_event"] or ("-", 0)
+                writer.write(f"ACK,{boot},{seq}\n".encode())
+                await asyncio.wait_for(writer.drain(), ESP32_READ_TIMEOUT)
+            elif message and message != "PING":
+                handle_esp32_message(message, addr[0], session)
+    except (OSError, asyncio.TimeoutError) as e:
+        print(f"[ESP32受信] 通信エラー {addr}: {e!r}")
+    finally:
+        esp32_connections -= 1
+        writer.close()
+
+def parse_esp32_message(message):
+    """'MOTION_DETECTED,DISTANCE=12.34,SENSOR=room1' -> ("MOTION_DETECTED", {"DISTANCE": "12.34", "SENSOR": "room1"})"""
+    kind, *items = message.split(",")
+    fields = {}
+    for item in items:
+        key, sep, value = item.partition("=")
+        if sep:
+            fields[key.strip().upper()] = value.strip()
+    return kind.strip(), fields
+
+def format_distance(value):
+    if value is None:
+        return "Unknown"
+    try:
+        distance_value = float(value)
+    except ValueError as e:
+        print(f"[ESP32受信] 距離パースエラー: {e}")
+        return "ParseError"
+    if distance_value < 0:
+        return "Error"  # 測定失敗扱い
+    return f"{distance_value:.2f} cm"
+
+def parse_device_time(value, received):
+    """ESP32 の検知日時。無い・読めない・受信より未来（時計が合っていない）なら受信時刻を使う"""
+    if value:
+        try:
+            timestamp = datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+            if timestamp <= received + datetime.timedelta(seconds=5):
+                return timestamp
+        except ValueError:
+            pass
+        print(f"[ESP32受信] 検知日時が不正なため受信時刻を使います: {value}")
+    return received
+
+def is_duplicate_event(info, boot, seq):
+    """起動IDごとに受け取った最大の連番を覚えておき、それ以下なら重複とする"""
+    seen = info["seen"]
+    if seq <= seen.get(boot, 0):
+        return True
+    seen.pop(boot, None)
+    seen[boot] = seq  # 最近の起動IDほど後ろに置く
+    while len(seen) > ESP32_SEEN_BOOTS:
+        del seen[next(iter(seen))]
+    return False
+
+def handle_esp32_message(message, host, session=None):
+    """1行分のメッセージを処理する（イベントループから呼ぶ。待つ処理はしない）"""
+    received = datetime.datetime.now()
+    kind, fields = parse_esp32_message(message)
+    sensor = fields.get("SENSOR", "")
+    if not SENSOR_ID_PATTERN.match(sensor):
+        sensor = host
+    info = esp32_sensors.setdefault(sensor, {"addr": host, "last_seen": None, "events": 0, "seen": {}})
+    info["addr"] = host
+    info["last_seen"] = received
+    print(f"[ESP32受信] {sensor}: {message}")
+
+    if kind == "MOTION_DETECTED":
+        boot, seq = fields.get("BOOT"), fields.get("SEQ", "")
+        if boot and seq.isdigit():
+            if session is not None:
+                session["last_event"] = (boot, int(seq))
+            if is_duplicate_event(info, boot, int(seq)):
+                print(f"[ESP32受信] 受信済みのイベントのため無視: {sensor} {boot} {seq}")
+                return
+        info["events"] += 1
+        timestamp = parse_device_time(fields.get("TS"), received)
+        distance = format_distance(fields.get("DISTANCE"))
+        if (received - timestamp).total_seconds() >= ESP32_STALE_ALERT:
+            # 接続が切れている間に送信待ちだった分。ログにだけ残す
+            save_esp32_log(timestamp, esp32_log_message(sensor, fields), distance)
+            return
+        notify_motion(distance, sensor)
+        save_esp32_log(timestamp, esp32_log_message(sensor, fields), distance)
+        if server_available:
+            asyncio.get_running_loop().run_in_executor(None, forward_motion_to_server, distance)
+    else:
+        print(f"[ESP32受信] 未知のメッセージ: {message}")
+        save_esp32_log(received, message, "UNKNOWN")
+
+def esp32_log_message(sensor, fields):
+    # DISTANCE は最後に置く（analytics.py は DISTANCE= より後ろを距離として読む）
+    logged = f"MOTION_DETECTED,SENSOR={sensor}"
+    if "DISTANCE" in fields:
+        logged += f",DISTANCE={fields['DISTANCE']}"
+    return logged
+
+def forward_motion_to_server(distance):
+    """動き検知をサーバーへ送り、他のクライアントへ配信してもらう"""
+    try:
+        server_pool.request(f"MOTION,{distance}", timeout=3)
     except Exception as e:
-        print(f"[ESP32受信エラー] {e}")
+        print(f"[ESP32受信] サーバーへの転送エラー: {e}")
 
 # ===== ESP32ログ保存 =====
 def save_esp32_log(timestamp, message, status):
@@ -100,46 +278,29 @@ def save_esp32_log(timestamp, message, status):
     ESP32からの通知をCSVに保存
     """
     try:
-        log_filename = f"esp32_log_{timestamp.strftime('%Y-%m-%d')}.csv"
-        file_exists = os.path.isfile(log_filename)
-
-        with open(log_filename, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            if not file_exists:
-                writer.writerow(["timestamp", "message", "status"])
-            writer.writerow([
-                timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-                message,
-                status
-            ])
+        esp32_log_writer.write(timestamp.strftime('%Y-%m-%d'), [
+            timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+            message,
+            status
+        ])
         print(f"📝 ESP32ログ保存: {timestamp}, {message}, {status}")
     except Exception as e:
         print(f"[save_esp32_log] エラー: {e}")
 
 def server_notification_listener():
+    """サーバーの通知を購読し、他のクライアントの入退室や動き検知で音を鳴らす（切断時は再接続）"""
     print("[通知監視] スレッド開始")
-    buffer = ""
-    try:
-        with socket.create_connection((SERVER_IP, 12345)) as sock:
-            print("[通知監視] サーバーに接続しました")
-            while True:
-                data = sock.recv(1024)
-                if not data:
-                    print("[通知監視] サーバー接続が切れました")
-                    break
-                buffer += data.decode()
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    message = line.strip()
-                    print(f"[通知監視] 受信メッセージ: {repr(message)}")
-                    if message == "MOTION_ALERT":
-                        print("🚨 動作検知通知を受信しました")
-                        play_motion_alert_sound()
-                        notify_user("ESP32通知", "動きを検知しました")
-                    else:
-                        print(f"[通知監視] 未知のメッセージ: {repr(message)}")
-    except Exception as e:
-        print(f"[通知監視エラー] {e}")
+    while True:
+        try:
+            with socket.create_connection((SERVER_IP, SERVER_PORT), timeout=SUBSCRIBE_TIMEOUT) as sock:
+                # 自分のスキャンや ESP32 の検知は手元で音を鳴らしているので NOSELF で除く
+                sock.sendall(b"SUBSCRIBE,ENTER,EXIT,MOTION,NOSELF")
+                print("[通知監視] サーバーに接続しました")
+                listen_server(sock)
+                print("[通知監視] サーバー接続が切れました")
+        except Exception as e:
+            print(f"[通知監視エラー] {e}")
+        time.sleep(SUBSCRIBE_RETRY_INTERVAL)
 
 # ----- サーバーからの通知音分岐 -----
 def listen_server(sock):
@@ -153,14 +314,23 @@ def listen_server(sock):
             while b'\n' in buffer:
                 line, buffer = buffer.split(b'\n', 1)
                 line_str = line.decode().strip()
+                fields = line_str.split(",")
 
                 # サーバーからの通知に応じた音
-                if line_str == "MOTION_ALERT":
-                    play_motion_alert_sound()
-                elif line_str == "ENTER_ALERT":
-                    play_enter_sound()
-                elif line_str == "EXIT_ALERT":
-                    play_exit_sound()
+                if fields[0] in ("HEARTBEAT", "SUBSCRIBE_OK"):
+                    continue
+                elif fields[0] == "MOTION_ALERT":
+                    print("🚨 動作検知通知を受信しました")
+                    distance = fields[2] if len(fields) >= 3 else "Unknown"
+                    notify_motion(distance)
+                elif fields[0] in ("ENTER_ALERT", "EXIT_ALERT") and len(fields) >= 3:
+                    action = "入室" if fields[0] == "ENTER_ALERT" else "退室"
+                    print(f"[通知監視] {fields[2]} ({fields[1]}) {action}")
+                    notify_remote_entry(fields[0] == "ENTER_ALERT")
+                elif fields[0] == "FORCE_EXIT_ALERT":
+                    print(f"[通知監視] 強制退室 {fields[1]} 人")
+                elif fields[0] == "DROPPED":
+                    print(f"[通知監視] 通知 {fields[1]} 件が届きませんでした")
                 else:
                     print("📥 未知のメッセージ:", line_str)
 
@@ -168,23 +338,8 @@ def listen_server(sock):
             print(f"[listen_server] 通信エラー: {e}")
             break
 
-# ----- ローカルモード用通知 -----
-def notify_user_local(name, action):
-    """ローカル記録時の通知 + 音"""
-    notify_user(f"{name}さん", f"{action}（ローカル記録）")
-    if action == "入室":
-        play_enter_sound()
-    elif action == "退室":
-        play_exit_sound()
-    else:
-        play_motion_alert_sound()
-
 def check_server_connection():  # ★追加
-    try:
-        with socket.create_connection((SERVER_IP, SERVER_PORT), timeout=5):
-            return True
-    except Exception:
-        return False
+    return server_pool.ping(timeout=5)
     
 def connection_monitor():  # ★追加
     global server_available
@@ -193,8 +348,9 @@ def connection_monitor():  # ★追加
         is_connected = check_server_connection()
         if is_connected:
             if not server_available:
-                print("[再接続] サーバーとの接続が復旧しました。retry_logを再送します。")
-                retry_unsent_logs()
+                print("[再接続] サーバーとの接続が復旧しました。再送キューを送信します。")
+                kick_retry_worker(reset_backoff=True)
+                sync_log_from_server()
             server_available = True
             wait_interval = min(wait_interval * 2, 1800)
         else:
@@ -211,10 +367,11 @@ def get_log_filename(date=None):
     return f"entry_log_{date.strftime('%Y-%m-%d')}.csv"
 
 # ----- ログから状態復元機能を追加 -----
-def load_entry_state_from_log():
+def load_entry_state_from_log(log_filename=None):
     global entry_state, id_name_map
     # 当日ログファイル名取得（直近のファイルを自分で複数日対応したい場合は拡張可能）
-    log_filename = get_log_filename()
+    if log_filename is None:
+        log_filename = get_log_filename()
     if not os.path.exists(log_filename):
         print(f"[復元] ログファイル {log_filename} が見つかりません。状態復元はスキップします。")
         return
@@ -235,20 +392,33 @@ def load_entry_state_from_log():
 
 def load_retry_state():
     global entry_state, id_name_map
+    try:
+        restored = 0
+        for row in retry_queue.iter_pending():
+            if len(row) < 6:
+                continue
+            idm, name, action = row[2:5]
+            entry_state[idm] = (action == "入室")
+            id_name_map[idm] = name
+            restored += 1
+        if restored:
+            print(f"[復元] 再送キューの {restored} 件から一時状態を補完しました。")
+    except Exception as e:
+        print(f"[復元] 再送キューの読み込みエラー: {e}")
+
+def migrate_retry_log():
+    """旧形式の retry_log.csv が残っていれば再送キューへ移して削除する"""
     if not os.path.exists(RETRY_LOG_FILE):
         return
     try:
         with open(RETRY_LOG_FILE, newline='', encoding='utf-8') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                if len(row) < 6:
-                    continue
-                _, _, idm, name, action, _ = row
-                entry_state[idm] = (action == "入室")
-                id_name_map[idm] = name
-        print("[復元] retry_log.csv から一時状態を補完しました。")
+            rows = [row + [retry_row_event_id(row)] if len(row) == 6 else row
+                    for row in csv.reader(f) if len(row) in (6, 7)]
+        retry_queue.append(rows)
+        os.remove(RETRY_LOG_FILE)
+        print(f"[再送キュー] {RETRY_LOG_FILE} の {len(rows)} 件を移しました")
     except Exception as e:
-        print(f"[復元] retry_log.csvの読み込みエラー: {e}")
+        print(f"[再送キュー] {RETRY_LOG_FILE} の移行エラー: {e}")
 
 # ----- ログ保存 -----
 def save_log(scan_time, send_time, idm, name, action, status="OK"):
@@ -256,97 +426,150 @@ def save_log(scan_time, send_time, idm, name, action, status="OK"):
         # "IN" → "入室", "OUT" → "退室" に変換
         action_disp = action  # 既に変換済 or 異常値の保険
 
-        date_str = scan_time.strftime("%Y-%m-%d")
-        log_filename = f"entry_log_{date_str}.csv"
-        file_exists = os.path.isfile(log_filename)
-
-        with open(log_filename, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            if not file_exists:
-                writer.writerow(["scan_time", "send_time", "idm", "name", "action", "status"])
-            writer.writerow([
-                scan_time.strftime("%Y-%m-%d %H:%M:%S"),
-                send_time.strftime("%Y-%m-%d %H:%M:%S"),
-                idm,
-                name.replace("，", "").replace(",", ""),  # 安全処理（全角カンマ対策）
-                action_disp,
-                status
-            ])
+        entry_log_writer.write(scan_time.strftime("%Y-%m-%d"), [
+            scan_time.strftime("%Y-%m-%d %H:%M:%S"),
+            send_time.strftime("%Y-%m-%d %H:%M:%S"),
+            idm,
+            name.replace("，", "").replace(",", ""),  # 安全処理（全角カンマ対策）
+            action_disp,
+            status
+        ])
     except Exception as e:
         print(f"[save_log] エラー: {e}")
 
+# ----- イベントID -----
+# スキャンごとに一意なIDを付けて送り、サーバーは処理済みのIDを反映せずに受け付ける。
+# 応答が届かずに再送しても二重に記録されない。
+def new_event_id():
+    return uuid.uuid4().hex
+
+def retry_row_event_id(row):
+    """再送キューの行のイベントID（ID列が無い古い行は内容から決める）"""
+    if len(row) >= 7 and row[6]:
+        return row[6]
+    scan_str, _, idm, _, action = row[:5]
+    return uuid.uuid5(uuid.NAMESPACE_OID, f"{scan_str}|{idm}|{action}").hex
+
 # ----- 再送用ログ保存 -----
-def save_retry_log(scan_time, send_time, idm, name, action, status="FAILED"):
+def save_retry_log(scan_time, send_time, idm, name, action, status="FAILED", event_id=None):
     try:
-        with open(RETRY_LOG_FILE, "a", newline='', encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                scan_time.strftime("%Y-%m-%d %H:%M:%S"),
-                send_time.strftime("%Y-%m-%d %H:%M:%S"),
-                idm, name, action, status
-            ])
+        retry_queue.append([[
+            scan_time.strftime("%Y-%m-%d %H:%M:%S"),
+            send_time.strftime("%Y-%m-%d %H:%M:%S"),
+            idm, name, action, status, event_id or new_event_id()
+        ]])
+        kick_retry_worker()
     except Exception as e:
         print(f"[save_retry_log] エラー: {e}")
 
 def retry_unsent_logs():
-    if not os.path.exists(RETRY_LOG_FILE):
-        return
-
-    temp_rows = []
-    with open(RETRY_LOG_FILE, newline='', encoding='utf-8') as f:
-        reader = csv.reader(f)
-        for row in reader:
-            if len(row) != 6:
-                print(f"[警告] 想定外の列数: {row}")
-                continue
-            scan_str, send_str, idm, name, action, status = row
-            try:
-                message = f"ENTRY_EVENT,{idm},{name},{action},{scan_str}"
-                with socket.create_connection((SERVER_IP, SERVER_PORT), timeout=5) as sock:
-                    sock.sendall(message.encode("utf-8"))
-                    response = sock.recv(1024).decode("utf-8").strip()
-                    print(f"[受信レスポンス] {repr(response)}")
-
-                    if response == "ENTRY_EVENT_OK":
-                        scan_time = datetime.datetime.strptime(scan_str, "%Y-%m-%d %H:%M:%S")
-                        send_time = datetime.datetime.now()
-                        save_log(scan_time, send_time, idm, name, action, status="OK")
-                        print(f"[再送成功] {idm} {name} {action}")
-                    elif response == "NOT_REGISTERED":
-                        print(f"[再送失敗] 未登録: {idm}")
-
-                        # 名前がある場合は自動登録を試みる
-                        if name:
-                            reg_res = communicate_with_server(idm, name=name, register=True)
-                            print(f"[自動登録レスポンス] {reg_res}")
-                            if reg_res == "REGISTERED_SUCCESS":
-                                print(f"[自動登録成功] {idm} {name}")
-
-                                # 再送を再試行
-                                try:
-                                    retry_msg = f"ENTRY_EVENT,{idm},{name},{action},{scan_str}"
-                                    with socket.create_connection((SERVER_IP, SERVER_PORT), timeout=5) as sock2:
-                                        sock2.sendall(retry_msg.encode("utf-8"))
-                                        response2 = sock2.recv(1024).decode("utf-8").strip()
-                                        if response2 == "ENTRY_EVENT_OK":
-                                            scan_time = datetime.datetime.strptime(scan_str, "%Y-%m-%d %H:%M:%S")
-                                            send_time = datetime.datetime.now()
-                                            save_log(scan_time, send_time, idm, name, action, status="OK")
-                                            print(f"[再送成功（登録後）] {idm} {name} {action}")
-                                            continue  # 成功したので temp_rows に入れない
-                                except Exception as e:
-                                    print(f"[再送処理エラー（登録後）] {e}")
-                        temp_rows.append(row)  # 自動登録不可 or 再送失敗
+    """
+    再送キューの未送信分をバッチごとに送り、送れたところまでカーソルを進める。
+    サーバーが受け付けなかった行はキューの末尾に入れ直す（この回では送り直さない）。
+    サーバーと通信できなかった場合は False を返す（カーソルは進めない）。
+    """
+    end = retry_queue.end_position()
+    try:
+        with server_pool.connection(timeout=10) as conn:
+            while True:
+                batch, position = retry_queue.read_batch(RETRY_BATCH_SIZE, end)
+                if not batch:
+                    return True
+                results = send_entry_event_batch(conn, batch)
+
+                failed = []
+                unregistered = []
+                for row, result in zip(batch, results):
+                    if result == "ENTRY_EVENT_OK":
+                        mark_retry_row_sent(row)
+                    elif result == "NOT_REGISTERED" and row[3]:
+                        print(f"[再送失敗] 未登録: {row[2]}")
+                        unregistered.append(row)
                     else:
-                        print(f"[再送失敗] サーバー応答: {response}")
-                        temp_rows.append(row)
-            except Exception as e:
-                print(f"[再送処理エラー] {e}")
-                temp_rows.append(row)
+                        print(f"[再送失敗] サーバー応答: {result}")
+                        failed.append(row)
+
+                if unregistered:
+                    # 名前がある場合は自動登録を試み、登録できた分をまとめて再送
+                    failed.extend(register_and_resend(conn, unregistered))
+                retry_queue.append(failed)
+                retry_queue.commit(position)
+    except Exception as e:
+        print(f"[再送処理エラー] {e}")
+        return False
+
+def kick_retry_worker(reset_backoff=False):
+    global retry_next_attempt
+    if reset_backoff:
+        retry_next_attempt = 0.0
+    retry_wakeup.set()
+
+def retry_worker():
+    """
+    再送キューを送る唯一のスレッド。行が追加されると起きて送信し、
+    サーバーに送れなければ RETRY_BACKOFF_MIN 秒から倍々に（最大 RETRY_BACKOFF_MAX 秒）待つ。
+    """
+    global retry_next_attempt
+    backoff = RETRY_BACKOFF_MIN
+    while True:
+        retry_wakeup.clear()
+        wait = retry_next_attempt - time.monotonic()
+        if wait <= 0 and retry_queue.pending():
+            if retry_unsent_logs():
+                backoff = RETRY_BACKOFF_MIN
+                wait = RETRY_INTERVAL
+            else:
+                wait = backoff * random.uniform(0.8, 1.2)  # 複数台が同時に再接続しないようにずらす
+                retry_next_attempt = time.monotonic() + wait
+                print(f"[再送] {wait:.0f} 秒後に再試行します")
+                backoff = min(backoff * 2, RETRY_BACKOFF_MAX)
+        elif wait <= 0:
+            wait = RETRY_INTERVAL
+        retry_wakeup.wait(wait)
+
+def send_entry_event_batch(conn, rows):
+    """再送キューの行をまとめて ENTRY_EVENT_BATCH で送り、行ごとの結果を返す"""
+    events = [
+        {"idm": row[2], "name": row[3], "action": row[4], "scan_timestamp": row[0],
+         "event_id": retry_row_event_id(row)}
+        for row in rows
+    ]
+    response = conn.request("ENTRY_EVENT_BATCH," + json.dumps(events, ensure_ascii=False))
+    print(f"[受信レスポンス] {repr(response[:80])}")
+    if not response.startswith("ENTRY_EVENT_BATCH_OK,"):
+        raise ConnectionError(f"一括再送失敗: {response}")
+    results = json.loads(response.split(",", 1)[1])
+    if len(results) != len(rows):
+        raise ConnectionError("一括再送の結果件数が一致しません")
+    return results
+
+def register_and_resend(conn, rows):
+    """未登録IDを登録してから再送し、送れなかった行を返す"""
+    register_msgs = [f"REGISTER,{row[2]},{row[3]}" for row in rows]
+    registered = []
+    failed = []
+    for row, res in zip(rows, conn.request_many(register_msgs)):
+        res = res.decode("utf-8").strip()
+        print(f"[自動登録レスポンス] {res}")
+        if res == "REGISTER_SUCCESS":
+            print(f"[自動登録成功] {row[2]} {row[3]}")
+            registered.append(row)
+        else:
+            failed.append(row)
+    if registered:
+        for row, result in zip(registered, send_entry_event_batch(conn, registered)):
+            if result == "ENTRY_EVENT_OK":
+                mark_retry_row_sent(row, note="（登録後）")
+            else:
+                failed.append(row)
+    return failed
 
-    with open(RETRY_LOG_FILE, "w", newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerows(temp_rows)
+def mark_retry_row_sent(row, note=""):
+    scan_str, send_str, idm, name, action, status = row[:6]
+    scan_time = datetime.datetime.strptime(scan_str, "%Y-%m-%d %H:%M:%S")
+    send_time = datetime.datetime.now()
+    save_log(scan_time, send_time, idm, name, action, status="OK")
+    print(f"[再送成功{note}] {idm} {name} {action}")
 
 # ----- 入室者状態表示（コンソール） -----
 def print_current_status(entry_state, id_name_map):
@@ -357,23 +580,52 @@ def print_current_status(entry_state, id_name_map):
         print(f" - {name} ({idm})")
 
 # ----- 未登録ID入力GUI -----
-def prompt_for_name(idm):
-    root = tk.Tk()
-    root.withdraw()
-    root.after(0, root.deiconify)
+# 名前の入力ダイアログは GUI スレッド（start_gui の Tk）で開く。scan_worker は入力を待たずに次のスキャンへ進み、
+# 入力された名前を付けて同じスキャンを scan_queue に積み直す。入力を待つ間に同じカードが読まれても
+# ダイアログは1つにまとめ、その間のスキャンは読み取った順に積み直す。キャンセルされたら記録しない。
+def prompt_for_name(idm, parent):
+    return simpledialog.askstring("未登録ID検出", f"IDm {idm} の名前を入力してください:", parent=parent)
+
+def request_registration(idm, scan_time, event_id):
+    """未登録のスキャンを名前の入力待ちにする（入力は GUI スレッドで行う）"""
+    with registration_lock:
+        scans = pending_registrations.get(idm)
+        if scans is not None:
+            scans.append((scan_time, event_id))
+            return
+        pending_registrations[idm] = [(scan_time, event_id)]
+    print(f"未登録ID: {idm}（名前の入力を待っています）")
+    registration_queue.put(idm)
+
+def poll_registrations(root):
+    """GUI スレッドで名前の入力依頼を処理し、入力された名前を付けてスキャンを積み直す"""
     try:
-        name = simpledialog.askstring("未登録ID検出", f"IDm {idm} の名前を入力してください:", parent=root)
-    finally:
-        root.destroy()
-    return name
+        while True:
+            idm = registration_queue.get_nowait()
+            name = prompt_for_name(idm, root)
+            with registration_lock:
+                scans = pending_registrations.pop(idm, [])
+            if not name:
+                print(f"名前入力キャンセル: {idm}（{len(scans)} 件のスキャンを記録しません）")
+                continue
+            for scan_time, event_id in scans:
+                enqueue_scan(idm, scan_time, event_id, name)
+    except queue.Empty:
+        pass
+    root.after(REGISTRATION_POLL_INTERVAL, poll_registrations, root)
 
 # ----- サーバー通信 -----
-def communicate_with_server(idm, name=None, register=False, entry_event=None, retries=3, retry_delay=2):
+def communicate_with_server(idm, name=None, register=False, entry_event=None, toggle_time=None,
+                           event_id=None, retries=3, retry_delay=2):
     if not server_available:
         return None
     msg = ""
     if register and name:
         msg = f"REGISTER,{idm},{name}"
+    elif toggle_time:
+        msg = f"TOGGLE,{idm},{toggle_time.strftime('%Y-%m-%d %H:%M:%S')}"
+        if event_id:  # 同じIDで再試行するので、応答が届かなかった場合も二重に切り替わらない
+            msg += f",{event_id}"
     elif entry_event:
         safe_name = name.replace(",", "，")
         msg = f"ENTRY_EVENT,{idm},{safe_name},{entry_event}"
@@ -382,10 +634,7 @@ def communicate_with_server(idm, name=None, register=False, entry_event=None, re
 
     for attempt in range(1, retries + 1):
         try:
-            with socket.create_connection((SERVER_IP, SERVER_PORT), timeout=10) as sock:
-                sock.sendall(msg.encode())
-                response = sock.recv(1024).decode()
-                return response.strip()
+            return server_pool.request(msg, timeout=10)
         except Exception as e:
             print(f"[{attempt}/{retries}] サーバー通信エラー: {e}")
             if attempt < retries:
@@ -393,21 +642,308 @@ def communicate_with_server(idm, name=None, register=False, entry_event=None, re
                 time.sleep(retry_delay)
     return None
 
+# ----- フレーム化プロトコル（v2）での接続 -----
+class ServerConnection:
+    """
+    HELLO でフレームモードに切り替えた1本の接続。
+    request_many() で複数コマンドをまとめて送り、応答を送信順に受け取れる。
+    compress=True の場合はログ送信の zlib 圧縮を交渉する。
+    """
+    PROTOCOL_VERSION = 2
+
+    def __init__(self, host=None, port=None, timeout=10, compress=False):
+        self.host = host or SERVER_IP
+        self.port = port or SERVER_PORT
+        self.timeout = timeout
+        self.compress = compress
+        self.features = set()
+        self.sock = None
+        self.buffer = b""
+        self.next_id = 1
+        self.streaming = False  # request_stream() の応答を読み終えていない
+        self.last_used = 0.0
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._enable_keepalive()
+        hello = f"HELLO,{self.PROTOCOL_VERSION}" + (",zlib" if self.compress else "")
+        self.sock.sendall(hello.encode() + b"\n")
+        line = self._read_line()
+        if not line.startswith(b"HELLO_OK"):
+            self.close()
+            raise ConnectionError(f"ハンドシェイク失敗: {line!r}")
+        self.features = set(line.decode().split(",")[2:])
+        return self
+
+    def _enable_keepalive(self):
+        """長く使い回す接続が経路の途中で切れたことに気付けるよう TCP keepalive を有効にする"""
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "SIO_KEEPALIVE_VALS"):  # Windows
+            self.sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, KEEPALIVE_IDLE * 1000, KEEPALIVE_INTERVAL * 1000))
+        elif hasattr(socket, "TCP_KEEPIDLE"):
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+                self.buffer = b""
+                self.streaming = False
+
+    def set_timeout(self, timeout):
+        self.timeout = timeout
+        self.sock.settimeout(timeout)
+
+    def ping(self):
+        try:
+            return self.request("PING") == "PONG"
+        except (OSError, ConnectionError, ValueError):
+            return False
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _recv_more(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("サーバーが接続を閉じました")
+        self.buffer += chunk
+
+    def _read_line(self):
+        while b"\n" not in self.buffer:
+            self._recv_more()
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line
+
+    def _read_header(self, expected_id):
+        req_id, _, length = self._read_line().decode().partition(",")
+        if req_id != expected_id:
+            raise ConnectionError(f"応答IDの不一致: {req_id} != {expected_id}")
+        return length
+
+    def _iter_payload(self, length):
+        """応答ペイロードを受信した分ずつ返す（"z" は zlib ストリーム、"c" は長さ付きチャンクの列）"""
+        if length == "c":
+            while True:
+                size = int(self._read_line())
+                if size == 0:
+                    return
+                yield from self._iter_payload(size)
+        if length == "z":
+            decompressor = zlib.decompressobj()
+            while not decompressor.eof:
+                if not self.buffer:
+                    self._recv_more()
+                data, self.buffer = self.buffer, b""
+                out = decompressor.decompress(data)
+                if out:
+                    yield out
+            self.buffer = decompressor.unused_data
+            return
+        remaining = int(length)
+        while remaining > 0:
+            if not self.buffer:
+                self._recv_more()
+            chunk, self.buffer = self.buffer[:remaining], self.buffer[remaining:]
+            remaining -= len(chunk)
+            yield chunk
+
+    def _send(self, messages):
+        ids = []
+        out = []
+        for message in messages:
+            req_id = str(self.next_id)
+            self.next_id += 1
+            payload = message.encode("utf-8")
+            ids.append(req_id)
+            out.append(f"{req_id},{len(payload)}\n".encode() + payload)
+        self.sock.sendall(b"".join(out))
+        return ids
+
+    def request_many(self, messages):
+        """コマンド群をパイプライン送信し、応答（bytes）のリストを送信順に返す"""
+        responses = []
+        for req_id in self._send(messages):
+            length = self._read_header(req_id)
+            responses.append(b"".join(self._iter_payload(length)))
+        return responses
+
+    def request(self, message):
+        return self.request_many([message])[0].decode("utf-8").strip()
+
+    def request_stream(self, message):
+        """
+        1コマンドを送り、応答を受信した分ずつ返す（ログなど大きな応答用）。
+        途中でやめると接続が使えなくなるため、最後まで読むか close() すること。
+        """
+        self.streaming = True
+        req_id = self._send([message])[0]
+        yield from self._iter_payload(self._read_header(req_id))
+        self.streaming = False
+
+# ----- サーバーへの接続プール -----
+class ConnectionPool:
+    """
+    ServerConnection を最大 size 本まで保持して使い回す（スキャンのたびにTCP接続しない）。
+    - 貸し出す前に、POOL_IDLE_CHECK 秒以上使っていない接続は PING で確認し、
+      POOL_MAX_IDLE 秒以上使っていない接続は閉じて作り直す
+    - 通信中に例外が出た接続、ストリームを読み終えていない接続は戻さずに閉じる
+    - 使い回した接続が切れていた場合（サーバーの再起動など）は新しい接続で1回だけやり直す。
+      応答待ちのタイムアウトはサーバーが処理済みかもしれないのでやり直さない
+    - タイムアウトはリクエストごとに指定する
+    """
+    def __init__(self, size=POOL_SIZE, idle_check=POOL_IDLE_CHECK, max_idle=POOL_MAX_IDLE):
+        self.size = size
+        self.idle_check = idle_check
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def _acquire(self, timeout):
+        """(接続, 使い回しか) を返す。空いている接続が無ければ新しく接続する"""
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn = self.idle.pop()
+            idle_time = time.monotonic() - conn.last_used
+            if idle_time < self.max_idle:
+                conn.set_timeout(timeout)
+                if idle_time < self.idle_check or conn.ping():
+                    return conn, True
+            conn.close()
+        return ServerConnection(timeout=timeout, compress=True).connect(), False
+
+    def _release(self, conn):
+        if conn.sock is None or conn.streaming:
+            conn.close()
+            return
+        conn.last_used = time.monotonic()
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=10):
+        """接続を1本借りる。with を抜けると（途中で例外が出た場合は閉じて）プールへ戻す"""
+        conn, _ = self._acquire(timeout)
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        finally:
+            self._release(conn)
+
+    def request_many(self, messages, timeout=10):
+        for attempt in (1, 2):
+            conn, reused = self._acquire(timeout)
+            try:
+                return conn.request_many(messages)
+            except socket.timeout:
+                conn.close()
+                raise
+            except (OSError, ConnectionError) as e:
+                conn.close()
+                if not reused or attempt == 2:
+                    raise
+                print(f"[接続プール] 切れた接続を作り直します: {e}")
+            except BaseException:
+                conn.close()  # 応答の途中で失敗した接続は受信位置がずれているので使い回さない
+                raise
+            finally:
+                self._release(conn)
+
+    def request(self, message, timeout=10):
+        return self.request_many([message], timeout)[0].decode("utf-8").strip()
+
+    def ping(self, timeout=5):
+        """サーバーが応答するか確認する（接続できなければ False）"""
+        try:
+            return self.request("PING", timeout) == "PONG"
+        except (OSError, ConnectionError):
+            return False
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+server_pool = ConnectionPool()
+
 # ----- サーバーログ取得 -----
 def get_server_log():
     try:
-        with socket.create_connection((SERVER_IP, SERVER_PORT), timeout=5) as sock:
-            sock.sendall(b"GET_LOG")
-            log_data = b""
-            while True:
-                part = sock.recv(4096)
-                if not part:
-                    break
-                log_data += part
-            return log_data.decode("utf-8")
+        with server_pool.connection(timeout=5) as conn:
+            return b"".join(conn.request_stream("GET_LOG")).decode("utf-8")
     except Exception as e:
         return f"通信エラー: {e}"
 
+# ----- サーバーログ検索 -----
+def query_server_log(**filters):
+    """
+    サーバーの索引から入退室ログを検索し、[timestamp, idm, name, action] の行を順に返す。
+    filters: idm / name / action / since / until（"YYYY-MM-DD[ HH:MM:SS]"） / limit
+    """
+    with server_pool.connection(timeout=15) as conn:
+        chunks = conn.request_stream("QUERY_LOG," + json.dumps(filters, ensure_ascii=False))
+        rest = b""
+        header_seen = False
+        for chunk in chunks:
+            lines = (rest + chunk).split(b"\n")
+            rest = lines.pop()
+            for row in csv.reader(line.decode("utf-8") for line in lines):
+                if not header_seen:
+                    header_seen = True
+                    if row != ["timestamp", "idm", "name", "action"]:
+                        raise ConnectionError(f"検索失敗: {row}")
+                    continue
+                yield row
+        if not header_seen:
+            raise ConnectionError(f"検索失敗: {rest!r}")
+
+# ----- サーバーの在室状況 -----
+def get_server_stats(idm=None):
+    """
+    サーバーの集計を取得する（失敗時は None）。
+    idm 省略時は {"date", "headcount", "hourly_in", "hourly_out"}、
+    指定時は {"idm", "name", "state", "presence_seconds"}
+    """
+    try:
+        return json.loads(server_pool.request(f"STATS,{idm}" if idm else "STATS", timeout=3))
+    except Exception as e:
+        print(f"[集計] 取得エラー: {e}")
+        return None
+
+# ----- サーバーの入退室状態 -----
+def fetch_server_entry_state():
+    """
+    サーバーの入退室状態を前回取得した版からの差分で更新し、{idm: (名前, 入室中か)} を返す（失敗時は None）。
+    初回やサーバーの再起動後は全件が返る。
+    """
+    view = server_entry_view
+    try:
+        data = json.loads(server_pool.request(f"GET_ENTRY_STATE,{view['epoch'] or 0},{view['version']}", timeout=3))
+    except Exception as e:
+        print(f"[入退室状態] 取得エラー: {e}")
+        return None
+    if data["full"]:
+        view["entries"] = {}
+    for entry in data["entries"]:
+        view["entries"][entry["idm"]] = (entry["name"], entry["state"] == "IN")
+    view["epoch"] = data["epoch"]
+    view["version"] = data["version"]
+    return view["entries"]
+
 def show_server_log():
     log_text = get_server_log()
     window = tk.Toplevel()
@@ -429,14 +965,33 @@ def show_entry_list():
     label = tk.Label(window, text="※10秒ごとに自動更新", fg="blue", font=("Meiryo", 12))
     label.pack(pady=10)
 
+    stats_label = tk.Label(window, text="", font=("Meiryo", 12))
+    stats_label.pack()
+
+    latency_label = tk.Label(window, text="", font=("Meiryo", 10), justify="left")
+    latency_label.pack()
+
     listbox = tk.Listbox(window, width=50, height=30, font=("Meiryo", 14))
     listbox.pack(padx=20, pady=10)
 
     def update_list():
+        stats = get_server_stats() if server_available else None
+        if stats:
+            stats_label.config(text=f"サーバー集計: 在室 {stats['headcount']} 人 / "
+                                    f"本日の入室 {sum(stats['hourly_in'])} 件・退室 {sum(stats['hourly_out'])} 件")
+        else:
+            stats_label.config(text="サーバー集計: 取得できません")
+        latency = pipeline_latency_summary()
+        latency_label.config(text="\n".join(
+            f"{stage}: 平均 {stat['avg_ms']} ms / 最大 {stat['max_ms']} ms（{stat['count']} 件）"
+            for stage, stat in latency.items()))
         listbox.delete(0, tk.END)
-        inside = [idm for idm, state in entry_state.items() if state]
-        for idm in inside:
-            name = id_name_map.get(idm, "不明")
+        server_entries = fetch_server_entry_state() if server_available else None
+        if server_entries is not None:
+            inside = [(name, idm) for idm, (name, is_in) in server_entries.items() if is_in]
+        else:
+            inside = [(id_name_map.get(idm, "不明"), idm) for idm, state in entry_state.items() if state]
+        for name, idm in inside:
             listbox.insert(tk.END, f"{name} ({idm})")
         window.after(10000, update_list)
 
@@ -448,29 +1003,113 @@ def start_gui():
     root.title("入退室管理システム クライアント")
     tk.Button(root, text="サーバーログを表示", command=show_server_log).pack(padx=20, pady=10)
     tk.Button(root, text="現在の入室者を表示", command=show_entry_list).pack(padx=20, pady=10)
+    poll_registrations(root)
     root.mainloop()
 
-# ----- 通知表示 -----
-def notify_user(title, message):
+# ----- スキャン処理のパイプライン -----
+# カード読み取りスレッド（card_reader_loop）はポーリング・連続読み取りの除外・スキャン時刻の記録だけを行い、
+# スキャンを scan_queue に積む。サーバーとのやり取りは scan_worker、通知の表示と音は notifier（notifier.py）が行う。
+# ログは DailyLogWriter と再送キューに渡すだけで、ファイルへの書き込みは待たない。
+# サーバーが応答しない間も読み取りは止まらず、スキャン時刻は読み取った時点のものが記録される。
+def record_latency(stage, seconds):
+    with pipeline_stats_lock:
+        stat = pipeline_stats.setdefault(stage, {"count": 0, "total": 0.0, "max": 0.0})
+        stat["count"] += 1
+        stat["total"] += seconds
+        stat["max"] = max(stat["max"], seconds)
+
+def pipeline_latency_summary():
+    """段階ごとの件数・平均・最大（ミリ秒）"""
+    with pipeline_stats_lock:
+        return {stage: {"count": stat["count"],
+                        "avg_ms": round(stat["total"] / stat["count"] * 1000, 1),
+                        "max_ms": round(stat["max"] * 1000, 1)}
+                for stage, stat in pipeline_stats.items()}
+
+def enqueue_scan(idm, scan_time, event_id, name=None):
+    item = (idm, scan_time, event_id, time.monotonic(), name)
     try:
-        notification.notify(
-            title=title,
-            message=message,
-            timeout=3  # 秒数
-        )
-    except Exception as e:
-        print(f"[通知エラー] {e}")
+        scan_queue.put_nowait(item)
+    except queue.Full:
+        # サーバー処理が大きく遅れている。スキャン時刻は記録済みなので、空くまで待って積む
+        print(f"[スキャン] 処理待ちが {SCAN_QUEUE_SIZE} 件に達したため、空くのを待ちます")
+        scan_queue.put(item)
 
-# ----- 音声通知 -----
-def play_notification_sound():
-    try:
-        winsound.Beep(700, 800)
-    except Exception as e:
-        print(f"[音声通知エラー] {e}")
+def scan_worker():
+    while True:
+        idm, scan_time, event_id, queued_at, name = scan_queue.get()
+        started = time.monotonic()
+        record_latency("scan_wait", started - queued_at)
+        try:
+            process_scan(idm, scan_time, event_id, name)
+        except Exception as e:
+            print(f"[scan_worker] エラー: {e}")
+        finished = time.monotonic()
+        record_latency("server", finished - started)
+        record_latency("scan_total", finished - queued_at)
+
+def process_scan(idm, scan_time, event_id, name=None):
+    """
+    1件のスキャンをサーバーで記録する（記録できなければローカルに記録して再送キューへ）。
+    name は未登録のカードについて GUI で入力された名前（未入力なら入力を依頼して終わる）。
+    """
+    # 後ろにスキャンが待っている間は再試行せずに再送キューへ回す（待っている人の記録を遅らせない）
+    retries = 1 if scan_queue.qsize() else 3
+
+    # 照会・入退室の切り替え・記録をサーバーで1回にまとめて行う（TOGGLE）
+    response = communicate_with_server(idm, toggle_time=scan_time, event_id=event_id, retries=retries)
+    if response == "NOT_REGISTERED":
+        if not name:
+            request_registration(idm, scan_time, event_id)
+            return
+        print(f"登録開始: ID={idm}, 名前={name}")
+        res = communicate_with_server(idm, name=name, register=True)
+        print(f"登録レスポンス: {res}")  # 追加ログ
+        if res != "REGISTER_SUCCESS":
+            print("登録失敗")
+            return
+        id_name_map[idm] = name
+        print(f"{name} さんを登録しました。")
+        response = communicate_with_server(idm, toggle_time=scan_time, event_id=event_id, retries=retries)
+    send_time = datetime.datetime.now()
+
+    if response and response.startswith("TOGGLE_OK,"):
+        name, status, _ = response[len("TOGGLE_OK,"):].rsplit(",", 2)
+        id_name_map[idm] = name
+        entry_state[idm] = (status == "IN")
+        action_str = "入室" if entry_state[idm] else "退室"
+        print(f"{name} さんの{action_str}を記録しました。")
+        save_log(scan_time, send_time, idm, name, action_str)
+        notify_scan_result(name, action_str)
+        return
+
+    # サーバーで記録できなかった場合はローカルの状態で切り替えて再送に回す
+    known = id_name_map.get(idm, "不明")  # 既知の名前があれば使用、なければ入力された名前で記録
+    if known != "不明":
+        name = known
+    if not name:
+        request_registration(idm, scan_time, event_id)
+        return
+    id_name_map[idm] = name
+
+    new_status = not entry_state.get(idm, False)
+    action_str = "入室" if new_status else "退室"
+    if response is None:
+        print(f"[ローカル記録] {name} さんの {action_str} を記録（サーバー未接続）")
+        status = "LOCAL"
+    else:
+        print(f"[受信レスポンス] {repr(response)}")
+        print(f"送信失敗、再送キューに記録します。")
+        status = "FAILED"
+    save_log(scan_time, send_time, idm, name, action_str, status=status)
+    # TOGGLE と同じイベントIDで再送する（サーバーで処理済みだった場合は二重に記録されない）
+    save_retry_log(scan_time, send_time, idm, name, action_str, event_id=event_id)
+    entry_state[idm] = new_status
+    notify_scan_result(name, action_str, local=True)
 
 # ----- カード読み取りループ -----
 def card_reader_loop():
-    global entry_state, id_name_map
+    """PaSoRiのポーリングだけを行い、読み取ったスキャンを scan_queue に積む"""
     last_seen = {}
 
     try:
@@ -491,13 +1130,15 @@ def card_reader_loop():
 
     print("カードをかざしてください...")
 
-    retry_unsent_logs()  # 起動時に未送信ログの再送処理
+    kick_retry_worker()  # 起動時に未送信ログの再送処理
 
     try:
         while True:
             card_ptr = felicalib.felica_polling(pasori, 0xFFFF, 0, 0)
             now_time = time.time()
             if card_ptr:
+                # スキャン時刻はカード読み取り直後に取得
+                scan_time = datetime.datetime.now()
                 felica = Felica.from_address(card_ptr)
                 idm = ''.join(f"{byte:02X}" for byte in felica.idm)
 
@@ -506,97 +1147,7 @@ def card_reader_loop():
                     continue
                 last_seen[idm] = now_time
 
-                response = communicate_with_server(idm)
-                if response is None:
-                    print("通信失敗（CHECK）→ ローカル処理へ")
-                    name = id_name_map.get(idm, "不明")  # 既知の名前があれば使用、なければ仮で記録
-                    if name == "不明":
-                        name = prompt_for_name(idm)
-                        if name:
-                            id_name_map[idm] = name
-                        else:
-                            print("名前が取得できず、処理中断")
-                            continue
-
-    # 入退室トグル処理
-                    current_status = entry_state.get(idm, False)
-                    new_status = not current_status
-                    action_str = "入室" if new_status else "退室"
-                    scan_time = datetime.datetime.now()
-                    send_time = scan_time  # 通信しないので同時刻でOK
-
-                    save_log(scan_time, send_time, idm, name, action_str, status="LOCAL")
-                    save_retry_log(scan_time, send_time, idm, name, action_str)
-                    entry_state[idm] = new_status
-
-                    notify_user(f"{name}さん", f"{action_str}（ローカル記録）")
-                    play_notification_sound()
-                    notify_user_local(name, action_str)
-                    continue  # この後の処理はスキップ
-
-
-                if response.startswith("REGISTERED"):
-                    name = response.split(",", 1)[-1]
-                    id_name_map[idm] = name
-                elif response == "NOT_REGISTERED":
-                    print(f"未登録ID: {idm}")
-                    name = prompt_for_name(idm)
-                    if name:
-                        print(f"登録開始: ID={idm}, 名前={name}")
-                        res = communicate_with_server(idm, name=name, register=True)
-                        print(f"登録レスポンス: {res}")  # 追加ログ
-                        if res == "REGISTERE_SUCCESS":
-                            id_name_map[idm] = name
-                            print(f"{name} さんを登録しました。")
-                        else:
-                            print("登録失敗")
-                            continue
-                    else:
-                        print("名前入力キャンセル")
-                        continue
-                else:
-                    print(f"予期せぬレスポンス: {response}")
-                    continue
-
-                # 入退室トグル処理
-                current_status = entry_state.get(idm, False)
-                new_status = not current_status
-                action_str = "入室" if new_status else "退室"
-
-                # スキャン時刻はカード読み取り直後に取得
-                scan_time = datetime.datetime.now()
-                
-                # サーバーへ送信
-                send_response = communicate_with_server(idm, name=id_name_map[idm], entry_event=action_str)
-                send_time = datetime.datetime.now()
-
-                if send_response == "ENTRY_EVENT_OK" or send_response.startswith("REGISTERED"):
-                    print(f"{name} さんの{action_str}を記録しました。")
-                    entry_state[idm] = new_status
-                    save_log(scan_time, send_time, idm, id_name_map[idm], action_str)
-
-                    notify_user(f"{name}さん", f"{action_str}が記録されました")
-                    play_notification_sound()
-
-                elif send_response is None:  # ★追加：ローカルモード用
-                    print(f"[ローカル記録] {name} さんの {action_str} を記録（サーバー未接続）")
-                    save_log(scan_time, send_time, idm, name, action_str, status="LOCAL")
-                    save_retry_log(scan_time, send_time, idm, name, action_str)
-                    notify_user(f"{name}さん", f"{action_str}（ローカル記録）")
-                    play_notification_sound()
-                    entry_state[idm] = new_status
-                
-                else:
-                    print(f"[受信レスポンス] {repr(send_response)}")
-                    print(f"送信失敗、retry_logに記録します。")
-                    save_retry_log(scan_time, send_time, idm, id_name_map[idm], action_str)
-
-                    # === 追加：ローカルでも処理する ===
-                    entry_state[idm] = new_status
-                    save_log(scan_time, send_time, idm, id_name_map[idm], action_str, status="FAILED")
-    
-                    notify_user(f"{name}さん", f"{action_str}（ローカル記録）")
-                    play_notification_sound()
+                enqueue_scan(idm, scan_time, new_event_id())
             else:
                 time.sleep(0.1)
 
@@ -604,85 +1155,149 @@ def card_reader_loop():
         felicalib.pasori_close(pasori)
 
 def force_exit_process():
-    while True:
-        now = datetime.datetime.now()
-        if now.hour == 20 and now.minute == 0:
-            print("[強制退室] 20時になったため強制退室処理を実行します。")
-            for idm, status in list(entry_state.items()):
-                if status:  # 入室中の人だけ退室処理
-                    name = id_name_map.get(idm, "不明")
-                    scan_time = datetime.datetime.now()
-                    action_str = "退室"
-                    send_response = communicate_with_server(idm, name=name, entry_event=action_str)
-                    send_time = datetime.datetime.now()
-
-                    if send_response == "ENTRY_EVENT_OK":
-                        entry_state[idm] = False
-                        save_log(scan_time, send_time, idm, name, action_str)
-                        print(f"[強制退室] {name} さんを退室処理しました。")
-                    else:
-                        print(f"[強制退室失敗] {name} → retry_logに記録")
-                        save_retry_log(scan_time, send_time, idm, name, action_str)
+    """
+    サーバーの CHECKOUT_ALL で入室中の全員を1回の通信で退室にする。
+    サーバー側の強制退室が先に済んでいれば対象が0人になるだけで、退室の行は重複しない。
+    サーバーに接続できない場合は再送しない（サーバー自身の強制退室が退室を記録する）。
+    """
+    inside = [idm for idm, status in list(entry_state.items()) if status]
+    print(f"[強制退室] 強制退室処理を実行します。（入室中 {len(inside)} 人）")
+    scan_time = datetime.datetime.now()
+    checked_out = None
+    if server_available:
+        try:
+            response = server_pool.request("CHECKOUT_ALL", timeout=10)
+            if response.startswith("CHECKOUT_ALL_OK,"):
+                checked_out = json.loads(response.split(",", 1)[1])
+            else:
+                print(f"[強制退室] 予期せぬレスポンス: {response}")
+        except Exception as e:
+            print(f"[強制退室] サーバー通信エラー: {e}")
+    send_time = datetime.datetime.now()
+    action_str = "退室"
+
+    if checked_out is None:
+        # 再送キューに退室を積むと、サーバーの強制退室の記録に重ねてもう1行記録されてしまう
+        for idm in inside:
+            name = id_name_map.get(idm, "不明")
+            entry_state[idm] = False
+            save_log(scan_time, send_time, idm, name, action_str, status="LOCAL")
+            print(f"[強制退室] {name} さんをローカルで退室にしました（サーバーの強制退室に任せます）")
+        return
 
-            # 重複実行を避けるため1分間スリープ
-            time.sleep(60)
-        time.sleep(5)
+    print(f"[強制退室] サーバーで {len(checked_out)} 人を退室処理しました。")
+    # 状態は入室中だった全員を退室にする。ログはサーバーで退室にした人だけ記録する
+    # （サーバーで先に退室済みだった人の退室の行はサーバー側で記録済み）
+    for idm in inside:
+        entry_state[idm] = False
+    for record in checked_out:
+        idm = record["idm"]
+        name = record.get("name") or id_name_map.get(idm, "不明")
+        save_log(scan_time, send_time, idm, name, action_str)
+        print(f"[強制退室] {name} さんを退室処理しました。")
+
+# ----- サーバーログの差分同期 -----
+# サーバーの当日ログを server_log_<日付>.csv にバイト単位でそのまま写し、
+# 取得済みの位置（カーソル）を log_cursor.json に保存して次回は差分だけ取得する。
+def get_server_log_filename(date_str=None):
+    if date_str is None:
+        date_str = datetime.date.today().strftime('%Y-%m-%d')
+    return f"server_log_{date_str}.csv"
+
+def load_log_cursor():
+    try:
+        with open(LOG_CURSOR_FILE, "r", encoding="utf-8") as f:
+            cursor = json.load(f)
+        date_str, offset = cursor["date"], int(cursor["offset"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None, 0
+    mirror = get_server_log_filename(date_str)
+    # 写しがカーソルより短い（途中で壊れた等）場合は先頭から取り直す
+    if not os.path.exists(mirror) or os.path.getsize(mirror) < offset:
+        return date_str, 0
+    return date_str, offset
+
+def save_log_cursor(date_str, offset):
+    tmp_path = LOG_CURSOR_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"date": date_str, "offset": offset}, f)
+    os.replace(tmp_path, LOG_CURSOR_FILE)
 
 def sync_log_from_server():
+    today_str = datetime.date.today().strftime('%Y-%m-%d')
+    cursor_date, offset = load_log_cursor()
+    if cursor_date != today_str:
+        offset = 0
     try:
-        with socket.create_connection((SERVER_IP, SERVER_PORT), timeout=15) as s:
-            s.settimeout(15)
-            s.sendall("GET_LOG".encode())
-            buffer = b""
-            while True:
-                try:
-                    chunk = s.recv(4096)
-                    if not chunk:
-                        break
-                    buffer += chunk
-                except socket.timeout:
-                    print("[同期] 受信タイムアウト発生")
-            log_data = buffer.decode("utf-8", errors="ignore")
-            if log_data:
-                with open(f"entry_log_{datetime.date.today().strftime('%Y-%m-%d')}.csv", "w", encoding="utf-8") as f:
-                    f.write(log_data)
-                print("[同期] サーバーログ取得完了")
-                return True
-            else:
-                print("[同期] サーバーログ空")
+        mirror = get_server_log_filename(today_str)
+        with server_pool.connection(timeout=15) as conn:
+            chunks = conn.request_stream(f"GET_LOG_SINCE,{today_str},{offset}")
+            # 先頭行（LOG_DELTA,...）を読み取り、残りは受信した分ずつファイルへ書く
+            head = b""
+            for chunk in chunks:
+                head += chunk
+                if b"\n" in head:
+                    break
+            header, _, rest = head.partition(b"\n")
+            fields = header.decode("utf-8").split(",")
+            if fields[0] != "LOG_DELTA" or len(fields) != 4:
+                print(f"[同期] 予期せぬレスポンス: {header!r}")
                 return False
+            start, end = int(fields[2]), int(fields[3])
+
+            # カーソルより後ろに書きかけのデータがあれば切り詰めてから追記する
+            with open(mirror, "r+b" if os.path.exists(mirror) else "wb") as f:
+                f.truncate(start)
+                f.seek(start)
+                f.write(rest)
+                for chunk in chunks:
+                    f.write(chunk)
+                received = f.tell() - start
+                f.flush()
+                os.fsync(f.fileno())
+        if start + received != end:
+            print(f"[同期] 受信サイズ不一致: {start + received} != {end}")
+            return False
+        save_log_cursor(today_str, end)
+
+        if start < offset:
+            print("[同期] サーバーログが作り直されたため先頭から取得しました")
+        print(f"[同期] サーバーログ差分取得完了: {received} バイト（位置 {end}）")
+        if end == 0:
+            print("[同期] サーバーログ空")
+            return False
+        return True
     except Exception as e:
         print(f"[同期] サーバーログ取得エラー: {e}")
         return False
 
-def retry_loop():
-    while True:
-        if not os.path.exists(RETRY_LOG_FILE):
-            time.sleep(300)  # 5分スリープ（ログがなければ頻繁に確認しない）
-            continue
-
-        with open(RETRY_LOG_FILE, newline='', encoding='utf-8') as f:
-            lines = f.readlines()
-
-        if len(lines) <= 1:
-            time.sleep(300)  # 見出し以外の未送信データがなければスリープ延長
-        else:
-            retry_unsent_logs()
-            time.sleep(30)  # 未送信があるなら頻度高くチェック
-
-def start_retry_thread():
-    def retry_loop():
-        while True:
-            retry_unsent_logs()
-            time.sleep(30)
-    t = threading.Thread(target=retry_loop, daemon=True)
-    t.start()
+# ----- 古いログのアーカイブ -----
+# 日付の変わった entry_log / esp32_log / server_log の CSV を .lgz 形式へ変換する。
+# 元のCSVに戻すには python log_archive.py restore <ファイル名>
+def archive_local_logs():
+    before = (datetime.date.today() - datetime.timedelta(days=ARCHIVE_AFTER_DAYS - 1)).strftime('%Y-%m-%d')
+    for prefix, writer in [("entry_log", entry_log_writer), ("esp32_log", esp32_log_writer), ("server_log", None)]:
+        if writer:
+            writer.flush()
+        archive_old_logs(prefix, before, writer=writer)
+
+# ----- 定時処理 -----
+# 強制退室（毎日 FORCE_EXIT_TIME）とアーカイブは scheduler.py で実行する（再送は retry_worker）。
+# 強制退室の実行漏れは起動後に実行しない。CHECKOUT_ALL は実行した時点で入室中の人を退室にするため、
+# 予定時刻の後に入室し直した人まで退室になってしまう（実行漏れはサーバー側の強制退室が処理する）。
+def start_scheduler():
+    scheduler = Scheduler(SCHEDULER_HISTORY_FILE)
+    scheduler.add_daily("force_exit", FORCE_EXIT_TIME, force_exit_process, catch_up=False)
+    scheduler.add_interval("archive", ARCHIVE_INTERVAL, archive_local_logs, run_at_start=True)
+    scheduler.start()
+    return scheduler
 
 # ----- メイン関数 -----
 def main():
+    migrate_retry_log()
     synced = sync_log_from_server()
     if synced:
-        load_entry_state_from_log()  # サーバーのログに基づいて復元
+        load_entry_state_from_log(get_server_log_filename())  # サーバーのログに基づいて復元
     else:
         load_entry_state_from_log()  # ローカルのログに基づいて復元
         load_retry_state()           # 未送信分も補完
@@ -699,14 +1314,14 @@ def main():
     esp32_thread = threading.Thread(target=esp32_listener, daemon=True)
     esp32_thread.start()
 
-    # 再送スレッド
-    retry_thread = threading.Thread(target=retry_loop, daemon=True)
-    retry_thread.start()
-    start_retry_thread()
+    # 強制退室・アーカイブ
+    start_scheduler()
+
+    # スキャン処理（サーバーとのやり取り）のスレッド
+    threading.Thread(target=scan_worker, name="scan_worker", daemon=True).start()
 
-    # 強制退室スレッド
-    force_exit_thread = threading.Thread(target=force_exit_process, daemon=True)
-    force_exit_thread.start()
+    # 再送ワーカー（送れなかった入退室をまとめて再送）
+    threading.Thread(target=retry_worker, name="retry_worker", daemon=True).start()
 
     # 接続監視スレッド（30分ごとにチェック）
     conn_thread = threading.Thread(target=connection_monitor, daemon=True)  # ★追加
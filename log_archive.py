@@ -0,0 +1,319 @@
+import array
+import argparse
+import calendar
+import contextlib
+import csv
+import datetime
+import glob
+import io
+import itertools
+import json
+import os
+import struct
+import sys
+import zlib
+
+# ====== 日次ログのアーカイブ形式（.lgz） ======
+# 日付の変わった entry_log_*.csv / esp32_log_*.csv などを圧縮した形式に変換する。
+#
+#   "LGZ1" | ブロック... | 索引（zlib圧縮したJSON） | 索引の長さ（4バイト） | "LGZ1"
+#
+# 各ブロックは最大 BLOCK_ROWS 行を列ごとに並べて zlib 圧縮したもの。
+#   - 時刻の列（timestamp / scan_time / send_time）は1970年からの秒数（8バイト整数）
+#   - それ以外の列は辞書の番号（4バイト整数）。辞書そのものは索引に入れる
+# 索引には各ブロックの位置・行数・時刻の範囲が入っており、必要なブロックだけ読める。
+# 元のCSVとバイト単位で同じ内容に戻せることを確認してから変換するため、
+# csv_size（元のCSVのサイズ）はそのままバイト位置として使える。
+
+MAGIC = b"LGZ1"
+ARCHIVE_EXT = ".lgz"
+TIME_COLUMNS = ("timestamp", "scan_time", "send_time")
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+BLOCK_ROWS = 4096
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def archive_filename(csv_path):
+    return os.path.splitext(csv_path)[0] + ARCHIVE_EXT
+
+
+def csv_filename(archive_path):
+    return os.path.splitext(archive_path)[0] + ".csv"
+
+
+def time_to_int(value):
+    return calendar.timegm(datetime.datetime.strptime(value, TIME_FORMAT).timetuple())
+
+
+def int_to_time(value):
+    return (EPOCH + datetime.timedelta(seconds=value)).strftime(TIME_FORMAT)
+
+
+def is_time(value):
+    try:
+        time_to_int(value)
+        return True
+    except ValueError:
+        return False
+
+
+def to_csv_bytes(rows):
+    out = io.StringIO(newline='')
+    csv.writer(out).writerows(rows)
+    return out.getvalue().encode("utf-8")
+
+
+# ====== 書き込み ======
+def encode_archive(header, rows, block_rows=BLOCK_ROWS):
+    """見出しと行からアーカイブのバイト列を作る"""
+    width = len(header)
+    for row in rows:
+        if len(row) != width:
+            raise ValueError(f"列数が見出しと一致しない行: {row}")
+    time_columns = [i for i, name in enumerate(header)
+                    if name in TIME_COLUMNS and all(is_time(row[i]) for row in rows)]
+    dicts = {i: {} for i in range(width) if i not in time_columns}
+
+    out = bytearray(MAGIC)
+    blocks = []
+    for start in range(0, len(rows), block_rows):
+        chunk = rows[start:start + block_rows]
+        columns = []
+        for i in range(width):
+            if i in time_columns:
+                columns.append(array.array('q', (time_to_int(row[i]) for row in chunk)))
+            else:
+                codes = dicts[i]
+                columns.append(array.array('I', (codes.setdefault(row[i], len(codes)) for row in chunk)))
+        data = zlib.compress(b"".join(column.tobytes() for column in columns), 9)
+        block = {"offset": len(out), "length": len(data), "rows": len(chunk)}
+        if time_columns:
+            block["min_ts"] = min(columns[time_columns[0]])
+            block["max_ts"] = max(columns[time_columns[0]])
+        blocks.append(block)
+        out += data
+
+    index = {
+        "columns": header,
+        "time_columns": time_columns,
+        "dicts": {str(i): list(codes) for i, codes in dicts.items()},
+        "blocks": blocks,
+        "rows": len(rows),
+        "csv_size": len(to_csv_bytes([header] + rows)),
+        "byteorder": sys.byteorder,
+        "int_sizes": [array.array('q').itemsize, array.array('I').itemsize],
+    }
+    index_data = zlib.compress(json.dumps(index, ensure_ascii=False).encode("utf-8"), 9)
+    out += index_data + struct.pack("<I", len(index_data)) + MAGIC
+    return bytes(out)
+
+
+# ====== 読み込み ======
+class LogArchive:
+    """アーカイブを開き、索引を使ってブロック単位で読み出す"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            f.seek(-8, os.SEEK_END)
+            index_length, magic = struct.unpack("<I4s", f.read(8))
+            if magic != MAGIC:
+                raise ValueError(f"アーカイブ形式ではありません: {path}")
+            f.seek(-8 - index_length, os.SEEK_END)
+            index = json.loads(zlib.decompress(f.read(index_length)))
+        if index["int_sizes"] != [array.array('q').itemsize, array.array('I').itemsize]:
+            raise ValueError(f"整数サイズの異なる環境で作られたアーカイブです: {path}")
+        self.columns = index["columns"]
+        self.time_columns = index["time_columns"]
+        self.dicts = {int(i): values for i, values in index["dicts"].items()}
+        self.blocks = index["blocks"]
+        self.rows = index["rows"]
+        self.csv_size = index["csv_size"]
+        self.swap = index["byteorder"] != sys.byteorder
+
+    def read_columns(self, n):
+        """
+        n 番目のブロックを列ごとの array で返す（変換前の値のまま）。
+        時刻の列は1970年からの秒数、それ以外は self.dicts[列番号] の番号。
+        """
+        block = self.blocks[n]
+        with open(self.path, "rb") as f:
+            f.seek(block["offset"])
+            data = zlib.decompress(f.read(block["length"]))
+        count = block["rows"]
+        columns = []
+        pos = 0
+        for i in range(len(self.columns)):
+            column = array.array('q' if i in self.time_columns else 'I')
+            size = column.itemsize * count
+            column.frombytes(data[pos:pos + size])
+            pos += size
+            if self.swap:
+                column.byteswap()
+            columns.append(column)
+        return columns
+
+    def read_block(self, n):
+        """n 番目のブロックの行を返す"""
+        columns = []
+        for i, column in enumerate(self.read_columns(n)):
+            if i in self.time_columns:
+                columns.append([int_to_time(value) for value in column])
+            else:
+                values = self.dicts[i]
+                columns.append([values[code] for code in column])
+        return [list(row) for row in zip(*columns)]
+
+    def iter_rows(self, since=None, until=None):
+        """
+        行を順に返す。since / until（"YYYY-MM-DD HH:MM:SS"）を指定すると、
+        最初の時刻の列で絞り込み、範囲外のブロックは読まない。
+        """
+        low = time_to_int(since) if since and self.time_columns else None
+        high = time_to_int(until) if until and self.time_columns else None
+        for n, block in enumerate(self.blocks):
+            if low is not None and block["max_ts"] < low:
+                continue
+            if high is not None and block["min_ts"] > high:
+                continue
+            for row in self.read_block(n):
+                if self.time_columns:
+                    ts = row[self.time_columns[0]]
+                    if (since and ts < since) or (until and ts > until):
+                        continue
+                yield row
+
+    def iter_csv(self, start=0):
+        """元のCSVと同じバイト列を、先頭 start バイトを飛ばして少しずつ返す"""
+        chunks = itertools.chain(
+            [to_csv_bytes([self.columns])],
+            (to_csv_bytes(self.read_block(n)) for n in range(len(self.blocks))))
+        pos = 0
+        for chunk in chunks:
+            end = pos + len(chunk)
+            if end > start:
+                yield chunk[max(start - pos, 0):]
+            pos = end
+
+    def read_csv_bytes(self):
+        return b"".join(self.iter_csv())
+
+
+# ====== 変換処理 ======
+def archive_day(csv_path, on_archived=None):
+    """
+    1日分のCSVをアーカイブに変換してCSVを削除する。
+    同じ日のアーカイブが既にあれば（後から再送された行など）その後ろに行を足す。
+    on_archived(csv_path, archive) は CSV を削除する直前に呼ばれる。
+    """
+    with open(csv_path, "rb") as f:
+        raw = f.read()
+    rows = list(csv.reader(io.StringIO(raw.decode("utf-8"), newline='')))
+    if not rows:
+        return False
+    if to_csv_bytes(rows) != raw:
+        print(f"[archive_day] {csv_path} は元の形式に戻せないため変換しません")
+        return False
+    header, rows = rows[0], rows[1:]
+
+    archive_path = archive_filename(csv_path)
+    if os.path.exists(archive_path):
+        previous = LogArchive(archive_path)
+        if previous.columns != header:
+            print(f"[archive_day] {archive_path} と見出しが異なるため変換しません")
+            return False
+        rows = list(previous.iter_rows()) + rows
+
+    try:
+        data = encode_archive(header, rows)
+    except ValueError as e:
+        print(f"[archive_day] {csv_path}: {e}")
+        return False
+
+    tmp_path = archive_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    archive = LogArchive(tmp_path)
+    if list(archive.iter_rows()) != rows:
+        os.remove(tmp_path)
+        print(f"[archive_day] {csv_path} の検証に失敗しました")
+        return False
+    os.replace(tmp_path, archive_path)
+    archive.path = archive_path
+
+    if on_archived:
+        on_archived(csv_path, archive)
+    os.remove(csv_path)
+    print(f"[archive_day] {csv_path} → {archive_path} ({len(raw)} → {len(data)} バイト)")
+    return True
+
+
+def archive_old_logs(prefix, before_date, writer=None, on_archived=None):
+    """
+    prefix_YYYY-MM-DD.csv のうち before_date（"YYYY-MM-DD"）より前の日付をアーカイブする。
+    writer（DailyLogWriter）を渡すと、その file_lock を取ってから変換する。
+    """
+    archived = []
+    for csv_path in sorted(glob.glob(f"{prefix}_*.csv")):
+        date_str = os.path.basename(csv_path)[len(prefix) + 1:-len(".csv")]
+        try:
+            datetime.datetime.strptime(date_str, "%Y-%m-%d")
+        except ValueError:
+            continue
+        if date_str >= before_date:
+            continue
+        lock = writer.file_lock if writer else contextlib.nullcontext()
+        try:
+            with lock:
+                if writer:
+                    writer.close_before(before_date)
+                if archive_day(csv_path, on_archived):
+                    archived.append(csv_path)
+        except Exception as e:
+            print(f"[archive_old_logs] {csv_path} エラー: {e}")
+    return archived
+
+
+def restore_csv(archive_path, csv_path=None):
+    """アーカイブを元のCSVに戻す（既存のファイルは上書きしない）"""
+    csv_path = csv_path or csv_filename(archive_path)
+    archive = LogArchive(archive_path)
+    with open(csv_path, "xb") as f:
+        for chunk in archive.iter_csv():
+            f.write(chunk)
+    return csv_path
+
+
+# ====== コマンドライン ======
+def main():
+    parser = argparse.ArgumentParser(description="日次ログのアーカイブ変換")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("archive", help="指定日より前のCSVをアーカイブに変換")
+    p.add_argument("--before", default=datetime.date.today().strftime("%Y-%m-%d"),
+                   help="この日付より前を変換（既定: 今日）")
+    p.add_argument("--prefix", action="append",
+                   help="対象のファイル名の接頭辞（既定: entry_log, esp32_log, server_log）")
+
+    p = sub.add_parser("restore", help="アーカイブを元のCSVに戻す")
+    p.add_argument("archive")
+    p.add_argument("-o", "--output", help="出力先（既定: 同名の .csv）")
+
+    p = sub.add_parser("cat", help="アーカイブをCSVとして標準出力へ書き出す")
+    p.add_argument("archive")
+
+    args = parser.parse_args()
+    if args.command == "archive":
+        for prefix in args.prefix or ["entry_log", "esp32_log", "server_log"]:
+            archive_old_logs(prefix, args.before)
+    elif args.command == "restore":
+        print(restore_csv(args.archive, args.output))
+    elif args.command == "cat":
+        for chunk in LogArchive(args.archive).iter_csv():
+            sys.stdout.buffer.write(chunk)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import csv
+import os
+import time
+import threading
+import atexit
+
+# ====== 日次CSVログのまとめ書き ======
+# 呼び出し側は write() で行をキューに積むだけで、ディスクには書き込まない。
+# 専用スレッドが当日のファイルを開いたまま保持し、
+#   - flush_interval 秒ごと、または
+#   - 未書き込みの行が flush_rows 行たまったとき
+# にまとめて書き込む（グループコミット）。日付が変わると新しいファイルへ切り替える。
+#
+# 耐久性:
+#   fsync="never" : 書き込み後 flush のみ。プロセスが落ちると未書き込みの行
+#                   （最大 flush_interval 秒分）が失われ、電源断ではOSのキャッシュ分も失われうる。
+#   fsync="batch" : まとめ書きごとに fsync。電源断でも直前のまとめ書きまでは残る。
+#   flush_interval=0 にするとキューに積まれた行をすぐに書き込む。
+#   flush() を呼ぶと、それまでに積まれた行が書き込まれるまで待つ。
+#
+# file_lock はファイル操作の間保持する。アーカイブ処理など、このライターが書く
+# ファイルを外から読み替える場合はこのロックを取ってから行う。
+#
+# on_commit を渡すと、まとめ書きのたびに書き込んだ日付の集合を引数にして
+# 書き込みスレッドから呼び出す（索引の更新などに使う）。
+
+
+class DailyLogWriter:
+    def __init__(self, prefix, header, flush_interval=1.0, flush_rows=100, fsync="never", on_commit=None):
+        if fsync not in ("never", "batch"):
+            raise ValueError(f"fsync は never / batch のいずれか: {fsync}")
+        self.prefix = prefix
+        self.header = header
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.fsync = fsync
+        self.on_commit = on_commit
+
+        self.cond = threading.Condition()
+        self.file_lock = threading.Lock()
+        self.pending = []
+        self.first_pending_at = 0.0
+        self.enqueued = 0
+        self.written = 0
+        self.flush_waiters = 0
+        self.closed = False
+
+        self.current_date = None
+        self.current_file = None
+        self.current_writer = None
+
+        self.thread = threading.Thread(target=self._run, name=f"log_writer[{prefix}]", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def filename(self, date_str):
+        return f"{self.prefix}_{date_str}.csv"
+
+    def write(self, date_str, row):
+        """行をキューに積む（ディスクI/Oは待たない）"""
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("DailyLogWriter は終了済みです")
+            if not self.pending:
+                self.first_pending_at = time.monotonic()
+                self.cond.notify_all()
+            self.pending.append((date_str, row))
+            self.enqueued += 1
+            if len(self.pending) >= self.flush_rows:
+                self.cond.notify_all()
+
+    def write_many(self, rows):
+        """(日付, 行) のリストをまとめてキューに積む（同じまとめ書きに入る）"""
+        if not rows:
+            return
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("DailyLogWriter は終了済みです")
+            if not self.pending:
+                self.first_pending_at = time.monotonic()
+            self.pending.extend(rows)
+            self.enqueued += len(rows)
+            self.cond.notify_all()
+
+    def flush(self, timeout=None):
+        """ここまでに積まれた行がファイルへ書き込まれるまで待つ"""
+        with self.cond:
+            target = self.enqueued
+            self.flush_waiters += 1
+            self.cond.notify_all()
+            try:
+                return self.cond.wait_for(lambda: self.written >= target or self.closed, timeout)
+            finally:
+                self.flush_waiters -= 1
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def close_before(self, date_str):
+        """date_str より前の日付のファイルを開いたままなら閉じる（file_lock を保持して呼ぶ）"""
+        if self.current_date and self.current_date < date_str:
+            self._close_current()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.closed:
+                    if not self.pending:
+                        self.cond.wait()
+                        continue
+                    if self.flush_waiters or len(self.pending) >= self.flush_rows:
+                        break
+                    remaining = self.first_pending_at + self.flush_interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch, self.pending = self.pending, []
+                closing = self.closed
+
+            with self.file_lock:
+                self._write_batch(batch)
+            if batch and self.on_commit:
+                try:
+                    self.on_commit({date_str for date_str, _ in batch})
+                except Exception as e:
+                    print(f"[DailyLogWriter] on_commitエラー: {e}")
+
+            with self.cond:
+                self.written += len(batch)
+                self.cond.notify_all()
+            if closing:
+                with self.file_lock:
+                    self._close_current()
+                return
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        # 当日以外の日付（再送された前日分など）は開いて書いて閉じる
+        others = {}
+        for date_str, row in batch:
+            if date_str != self.current_date:
+                if self.current_date is None or date_str > self.current_date:
+                    self._roll_over(date_str)
+                else:
+                    others.setdefault(date_str, []).append(row)
+                    continue
+            try:
+                self.current_writer.writerow(row)
+            except Exception as e:
+                print(f"[DailyLogWriter] 書き込みエラー: {e}")
+
+        try:
+            if self.current_file:
+                self.current_file.flush()
+                if self.fsync == "batch":
+                    os.fsync(self.current_file.fileno())
+        except Exception as e:
+            print(f"[DailyLogWriter] flushエラー: {e}")
+
+        for date_str, rows in others.items():
+            try:
+                with open(self.filename(date_str), 'a', newline='', encoding='utf-8') as f:
+                    writer = csv.writer(f)
+                    if f.tell() == 0:
+                        writer.writerow(self.header)
+                    writer.writerows(rows)
+                    f.flush()
+                    if self.fsync == "batch":
+                        os.fsync(f.fileno())
+            except Exception as e:
+                print(f"[DailyLogWriter] 書き込みエラー({date_str}): {e}")
+
+    def _roll_over(self, date_str):
+        self._close_current()
+        try:
+            self.current_file = open(self.filename(date_str), 'a', newline='', encoding='utf-8')
+            self.current_writer = csv.writer(self.current_file)
+            self.current_date = date_str
+            if self.current_file.tell() == 0:
+                self.current_writer.writerow(self.header)
+        except Exception as e:
+            print(f"[DailyLogWriter] ファイルオープンエラー: {e}")
+            self.current_file = None
+            self.current_writer = None
+            self.current_date = None
+
+    def _close_current(self):
+        if self.current_file:
+            try:
+                self.current_file.close()
+            except Exception as e:
+                print(f"[DailyLogWriter] クローズエラー: {e}")
+        self.current_file = None
+        self.current_writer = None
+        self.current_date = None
@@ -1,13 +1,38 @@
 import socket
 import time
+import os
+import binascii
 import network
-from machine import Pin, time_pulse_us, RTC
+import machine
+import esp32
+from machine import Pin, Timer, time_pulse_us, RTC
 
 # --- Wi-Fi設定 ---
 SSID = 'Wi-FiのSSID'
 PASSWORD = 'Wi-Fiのパスワード'
 PC_IP = "クライアントPCのIP" 
 PC_PORT = 50000            # クライアントPCで待ち受けるポート
+SENSOR_ID = "esp32-1"      # PCでこのセンサーを区別するID（英数字と _.:- で32文字まで）
+
+# --- 送信待ちイベントの設定 ---
+BUFFER_SIZE = 200          # 送信待ちにできる検知イベントの上限（超えたら古いものから捨てる）
+PERSIST_FILE = "events.txt"  # 送信待ちのイベントを保存するファイル（None ならRAMのみ）
+BATCH_SIZE = 20            # 1回にまとめて送るイベント数
+ACK_TIMEOUT = 5            # PCからのACKを待つ秒数
+RECONNECT_MIN = 2          # 接続に失敗したときに再接続を待つ秒数（失敗するたびに倍）
+RECONNECT_MAX = 120        # 再接続を待つ秒数の上限
+PING_INTERVAL = 30         # 送るイベントが無いときに接続維持の PING を送る間隔（秒）
+
+# --- 検知の設定 ---
+SENSE_MODE = "irq"         # "irq": PIRの割り込みで検知 / "poll": 従来の1秒間の監視
+PIR_DEBOUNCE_MS = 300      # PIRがこのミリ秒間 1 のままなら検知とする（irq）
+COOLDOWN = 15              # 検知後、次の検知を受け付けるまでの秒数
+DISTANCE_SAMPLES = 5       # 検知時に距離を測る回数（中央値を使う）
+DISTANCE_SAMPLE_INTERVAL_MS = 60  # 距離を測る間隔（HC-SR04 は 60ms 以上空ける）
+ECHO_TIMEOUT_US = 30000    # エコーを待つ最大時間（約5m分）
+LIGHT_SLEEP = True         # PIRが 0 でPCとの接続が無い間はライトスリープする（PIRが 1 になると起きる）
+LIGHT_SLEEP_MAX_MS = 10000  # 1回のライトスリープの最大時間
+LATENCY_REPORT_EVERY = 10  # 検知から送信までの時間の集計をこの件数ごとに表示
 
 # PIRセンサー（HW-416-B）
 pir = Pin(4, Pin.IN)
@@ -29,7 +54,10 @@ def connect_wifi():
     print("✅ Wi-Fi接続成功:", wlan.ifconfig())
 
 # --- NTP同期 ---
+time_synced = False
+
 def sync_time():
+    global time_synced
     try:
         import ntptime
         ntptime.host = 'ntp.jst.mfeed.ad.jp'  # 日本のNTPサーバー
@@ -37,6 +65,7 @@ def sync_time():
         rtc = RTC()
         tm = time.localtime(time.time() + 9 * 3600)  # JST補正
         rtc.datetime((tm[0], tm[1], tm[2], tm[6], tm[3], tm[4], tm[5], 0))
+        time_synced = True
         print("⏰ NTP同期成功:", "{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format(
             tm[0], tm[1], tm[2], tm[3], tm[4], tm[5]))
     except Exception as e:
@@ -51,73 +80,344 @@ def measure_distance():
     trig.off()
 
     try:
-        duration = time_pulse_us(echo, 1, 100000)  # 最大100ms待機
-        distance = (duration / 2) / 29.1  # cmに変換
-        print(f"📏 測定距離: {distance:.2f} cm")
-        return distance
+        duration = time_pulse_us(echo, 1, ECHO_TIMEOUT_US)
+        if duration < 0:  # タイムアウト（-1: 立ち上がり待ち / -2: パルスが長すぎる）
+            return None
+        return (duration / 2) / 29.1  # cmに変換
     except Exception as e:
         print(f"❌ 測定エラー: {e}")
         return None
 
-# --- PC送信関数 ---
-def send_motion_alert(distance=None):
+def measure_distance_median(n=DISTANCE_SAMPLES):
+    """n 回測って中央値を返す（外れ値や測定失敗の影響を減らす）。すべて失敗なら None"""
+    values = []
+    for i in range(n):
+        distance = measure_distance()
+        if distance is not None:
+            values.append(distance)
+        if i < n - 1:
+            time.sleep_ms(DISTANCE_SAMPLE_INTERVAL_MS)
+    if not values:
+        print("❌ 測定エラー: エコーが返りません")
+        return None
+    values.sort()
+    mid = len(values) // 2
+    distance = values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2
+    print(f"📏 測定距離: {distance:.2f} cm（{len(values)}/{n} 回の中央値）")
+    return distance
+
+# --- 送信待ちイベントのリングバッファ ---
+# 検知イベントはまずバッファに入れ、PCへの送信は upload_events() でまとめて行う。
+# PCに届かない間もイベントは失われず（BUFFER_SIZE を超えた分は古いものから捨てる）、
+# PERSIST_FILE を指定すると再起動しても送信待ちの分が残る。
+# イベントは (起動ID, 連番, 検知日時, 距離) で、PCは起動ID と連番で同じイベントの二重記録を防ぐ。
+BOOT_ID = binascii.hexlify(os.urandom(4)).decode()
+events = []  # 古い順
+next_seq = 1
+dropped = 0
+detected_ticks = {}  # (起動ID, 連番) -> 検知した時刻（ticks_ms、RAMのみ）
+latency = {"count": 0, "total": 0, "max": 0}  # 検知から送信（ACK）までのミリ秒
+
+def now_str():
+    tm = time.localtime()
+    return "{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format(tm[0], tm[1], tm[2], tm[3], tm[4], tm[5])
+
+def load_events():
+    global events
+    if not PERSIST_FILE:
+        return
     try:
-        addr = socket.getaddrinfo(PC_IP, PC_PORT)[0][-1]
-        s = socket.socket()
-        s.connect(addr)
+        with open(PERSIST_FILE) as f:
+            loaded = [tuple(line.strip().split(",")) for line in f if line.strip()]
+        events = [(e[0], int(e[1]), e[2], e[3]) for e in loaded if len(e) == 4][-BUFFER_SIZE:]
+        print(f"📦 送信待ちイベント {len(events)} 件を読み込み")
+    except OSError:
+        pass  # ファイルが無い
+    except Exception as e:
+        print(f"⚠️ 送信待ちイベントの読み込み失敗: {e}")
 
-        # データ構築
-        msg = "MOTION_DETECTED"
-        if distance is not None:
-            msg += f",DISTANCE={distance:.2f}"
+def save_events():
+    if not PERSIST_FILE:
+        return
+    try:
+        with open(PERSIST_FILE, "w") as f:
+            for e in events:
+                f.write("{},{},{},{}\n".format(*e))
+    except Exception as e:
+        print(f"⚠️ 送信待ちイベントの保存失敗: {e}")
+
+def append_event(distance, detected=None):
+    global next_seq, dropped
+    ts = now_str() if time_synced else ""  # 時刻が合っていなければPCの受信時刻を使ってもらう
+    event = (BOOT_ID, next_seq, ts, "" if distance is None else "{:.2f}".format(distance))
+    next_seq += 1
+    events.append(event)
+    if detected is not None:
+        detected_ticks[(event[0], event[1])] = detected
+    if len(events) > BUFFER_SIZE:
+        old = events.pop(0)
+        detected_ticks.pop((old[0], old[1]), None)
+        dropped += 1
+        print(f"⚠️ 送信待ちが {BUFFER_SIZE} 件を超えたため古いイベントを破棄（累計 {dropped} 件）")
+        save_events()
+    elif PERSIST_FILE:
+        try:
+            with open(PERSIST_FILE, "a") as f:
+                f.write("{},{},{},{}\n".format(*event))
+        except Exception as e:
+            print(f"⚠️ 送信待ちイベントの保存失敗: {e}")
+
+def format_event(event):
+    boot, seq, ts, distance = event
+    msg = "MOTION_DETECTED,SENSOR={},BOOT={},SEQ={}".format(SENSOR_ID, boot, seq)
+    if ts:
+        msg += ",TS=" + ts
+    if distance:
+        msg += ",DISTANCE=" + distance
+    return msg
+
+def remove_acked(boot, seq):
+    """ACK されたイベントまでをバッファから消し、消した件数を返す"""
+    for i, e in enumerate(events):
+        if e[0] == boot and e[1] == seq:
+            now = time.ticks_ms()
+            for acked in events[:i + 1]:
+                detected = detected_ticks.pop((acked[0], acked[1]), None)
+                if detected is not None:
+                    record_latency(time.ticks_diff(now, detected))
+            del events[:i + 1]
+            save_events()
+            return i + 1
+    return 0
+
+def record_latency(ms):
+    latency["count"] += 1
+    latency["total"] += ms
+    latency["max"] = max(latency["max"], ms)
+    print(f"⏱ 検知→送信: {ms} ms")
+    if latency["count"] % LATENCY_REPORT_EVERY == 0:
+        print("⏱ 検知→送信 {} 件: 平均 {} ms / 最大 {} ms".format(
+            latency["count"], latency["total"] // latency["count"], latency["max"]))
+
+# --- PCとの接続（つなぎっぱなしにし、切れたら間隔を空けて再接続） ---
+pc_addr = None
+conn = None
+next_connect = 0
+reconnect_wait = RECONNECT_MIN
+last_sent = 0
+
+def close_conn(backoff=False):
+    global conn, next_connect, reconnect_wait
+    if conn:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        conn = None
+    if backoff:
+        next_connect = time.time() + reconnect_wait
+        reconnect_wait = min(reconnect_wait * 2, RECONNECT_MAX)
+
+def ensure_connected():
+    global pc_addr, conn, reconnect_wait, last_sent
+    if conn:
+        return True
+    if time.time() < next_connect:
+        return False
+    s = None
+    try:
+        if pc_addr is None:
+            pc_addr = socket.getaddrinfo(PC_IP, PC_PORT)[0][-1]
+        s = socket.socket()
+        s.settimeout(ACK_TIMEOUT)
+        s.connect(pc_addr)
+    except Exception as e:
+        print(f"❌ PCに接続できません: {e}（{reconnect_wait} 秒後に再接続）")
+        if s:
+            s.close()
+        close_conn(backoff=True)
+        return False
+    conn = s
+    reconnect_wait = RECONNECT_MIN
+    last_sent = time.time()
+    print("🔗 PCに接続しました")
+    return True
 
-        s.send((msg + "\n").encode())
-        s.close()
-        print(f"✅ {msg} をPCへ送信")
+# --- PC送信関数 ---
+def upload_events():
+    """送信待ちのイベントを BATCH_SIZE 件ずつ送り、PCの ACK を受けた分をバッファから消す"""
+    global last_sent
+    while events:
+        if not ensure_connected():
+            return
+        batch = events[:BATCH_SIZE]
+        try:
+            conn.sendall(("\n".join(format_event(e) for e in batch) + "\nSYNC\n").encode())
+            reply = conn.readline().decode().strip()
+        except Exception as e:
+            print(f"❌ 送信エラー: {e}")
+            close_conn(backoff=True)
+            return
+        last_sent = time.time()
+        parts = reply.split(",")
+        acked = remove_acked(parts[1], int(parts[2])) if len(parts) == 3 and parts[0] == "ACK" else 0
+        if not acked:
+            print(f"❌ PCの応答が不正です: {reply}")
+            close_conn(backoff=True)
+            return
+        print(f"✅ {acked} 件をPCへ送信（残り {len(events)} 件）")
         led.value(1)
         time.sleep(0.5)
         led.value(0)
-    except Exception as e:
-        print(f"❌ 送信エラー: {e}")
+
+def keep_alive():
+    """しばらく送信していなければ PING を送る（PC側の無通信タイムアウトで切られないように）"""
+    global last_sent
+    if conn and time.time() - last_sent >= PING_INTERVAL:
+        try:
+            conn.sendall(b"PING\n")
+            last_sent = time.time()
+        except Exception as e:
+            print(f"⚠️ 接続が切れています: {e}")
+            close_conn()
+
+# --- 割り込みによる検知（SENSE_MODE = "irq"） ---
+# PIRの立ち上がりで PIR_DEBOUNCE_MS の1回タイマーを起動し、満了時にまだ 1 なら検知とする
+# （途中で 0 に戻ればタイマーを止めてノイズ扱い）。距離は検知したときだけ測る。
+# 検知したら PIR が 0 に戻る（立ち下がり）まで次の検知を受け付けない（poll と同じく、居続ける人を何度も検知しない）。
+# 割り込みハンドラでは時刻とフラグを記録するだけで、測定や送信はメインループで行う。
+debounce_timer = Timer(0)
+pir_armed = True     # 立ち上がりを検知として受け付けるか（検知で False、立ち下がりで True）
+rise_ticks = None    # 立ち上がりの時刻（ticks_ms）。デバウンス中のみ
+motion_ticks = None  # 検知が確定した立ち上がりの時刻（メインループが処理するまで）
+
+def debounce_done(timer):
+    global rise_ticks, motion_ticks, pir_armed
+    if rise_ticks is not None and pir.value() == 1:
+        motion_ticks = rise_ticks
+        pir_armed = False
+    rise_ticks = None
+
+def pir_changed(pin):
+    global rise_ticks, pir_armed
+    if pin.value() == 1:
+        if pir_armed and rise_ticks is None:
+            rise_ticks = time.ticks_ms()
+            debounce_timer.init(mode=Timer.ONE_SHOT, period=PIR_DEBOUNCE_MS, callback=debounce_done)
+    else:
+        pir_armed = True
+        if rise_ticks is not None:
+            debounce_timer.deinit()
+            rise_ticks = None
+            print("📡 PIR変動検知（ノイズ扱い）")
+
+def idle_sleep():
+    """
+    次にすることが無ければ眠る（再送・PINGの時刻までに起きる）。
+    ライトスリープは PIR が 0 で PC との接続が無いときだけ行う（ext0 は 1 の間ずっと起こし続けるため、
+    またライトスリープで Wi-Fi が切れて ACK 付きの接続を張り直すことになるため）。
+    それ以外は time.sleep_ms で待つ（接続中は Wi-Fi のモデムスリープのみ）。
+    """
+    if motion_ticks is not None:
+        return
+    if rise_ticks is not None:  # デバウンス中
+        time.sleep_ms(20)
+        return
+    wait_ms = LIGHT_SLEEP_MAX_MS
+    if events:
+        wait_ms = min(wait_ms, max(int((next_connect - time.time()) * 1000), 0))
+    elif conn:
+        wait_ms = min(wait_ms, max(int((last_sent + PING_INTERVAL - time.time()) * 1000), 0))
+    if pir.value() == 1 or conn or wait_ms < 100:
+        # 居続けている間（立ち下がり待ち）や接続中は短く区切って眠る（次の立ち上がりの処理を遅らせない）
+        time.sleep_ms(min(wait_ms, 100))
+        return
+    machine.lightsleep(wait_ms)
+    # スリープ中の立ち上がりは割り込みが入らないことがあるので、起きたときの値で補う
+    if pir.value() == 1 and rise_ticks is None:
+        pir_changed(pir)
+    if not network.WLAN(network.STA_IF).isconnected():
+        connect_wifi()
+
+def run_irq_loop():
+    global motion_ticks, pir_armed
+    pir_armed = pir.value() == 0  # 起動時に反応中なら 0 に戻るまで待つ
+    pir.irq(trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, handler=pir_changed)
+    if LIGHT_SLEEP:
+        esp32.wake_on_ext0(pin=pir, level=esp32.WAKEUP_ANY_HIGH)
+    last_motion = None
+    while True:
+        detected = motion_ticks
+        if detected is not None:
+            motion_ticks = None
+            if last_motion is not None and time.ticks_diff(detected, last_motion) < COOLDOWN * 1000:
+                print("⚠️ クールダウン中、送信スキップ")
+            else:
+                last_motion = detected
+                print("👀 PIR検知 → イベントを記録")
+                append_event(measure_distance_median(), detected)
+                upload_events()
+
+        # 送れなかったイベントの再送と接続の維持
+        if events:
+            upload_events()
+        else:
+            keep_alive()
+
+        if LIGHT_SLEEP:
+            idle_sleep()
+        else:
+            time.sleep_ms(20)
+
+# --- 一定間隔の監視による検知（SENSE_MODE = "poll"） ---
+def run_poll_loop():
+    last_sent_time = 0
+    check_period = 1.0
+    check_interval = 0.05
+
+    while True:
+        stable_detect = True
+        samples = int(check_period / check_interval)
+        started = time.ticks_ms()
+
+        for _ in range(samples):
+            if pir.value() == 0:
+                stable_detect = False
+                break
+            time.sleep(check_interval)
+
+        # PIRが検知していれば距離を測って送信
+        if stable_detect:
+            now = time.time()
+            if now - last_sent_time > COOLDOWN:
+                print("👀 PIR検知 → イベントを記録")
+                append_event(measure_distance_median(), started)
+                upload_events()
+                last_sent_time = now
+                print("⌛ PIRが0に戻るまで待機...")
+                while pir.value() == 1:
+                    time.sleep(0.1)
+            else:
+                print("⚠️ クールダウン中、送信スキップ")
+        else:
+            print("📡 PIR変動検知（ノイズ扱い）")
+
+        # 送れなかったイベントの再送と接続の維持
+        if events:
+            upload_events()
+        else:
+            keep_alive()
+
+        time.sleep(0.1)
 
 # --- メイン処理 ---
 connect_wifi()
 sync_time()
+load_events()
 
-last_sent_time = 0
-cooldown = 15  # 15秒クールダウン
-check_period = 1.0
-check_interval = 0.05
-
-print("🚨 PIR+HC-SR04シンプル検知システム起動")
-
-while True:
-    stable_detect = True
-    samples = int(check_period / check_interval)
-
-    for _ in range(samples):
-        if pir.value() == 0:
-            stable_detect = False
-            break
-        time.sleep(check_interval)
-
-    # HC-SR04の測定実行
-    distance = measure_distance()
-
-    # PIRが検知していれば送信
-    if stable_detect:
-        now = time.time()
-        if now - last_sent_time > cooldown:
-            print("👀 PIR検知 → データ送信実行")
-            send_motion_alert(distance)
-            last_sent_time = now
-            print("⌛ PIRが0に戻るまで待機...")
-            while pir.value() == 1:
-                time.sleep(0.1)
-        else:
-            print("⚠️ クールダウン中、送信スキップ")
-    else:
-        print("📡 PIR変動検知（ノイズ扱い）")
-
-    time.sleep(0.1)
+print("🚨 PIR+HC-SR04シンプル検知システム起動（{}）".format(SENSE_MODE))
 
+if SENSE_MODE == "irq":
+    run_irq_loop()
+else:
+    run_poll_loop()
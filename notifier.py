@@ -0,0 +1,215 @@
+import heapq
+import threading
+import time
+
+try:
+    import winsound
+except ImportError:  # Windows 以外
+    winsound = None
+
+try:
+    from plyer import notification
+except ImportError:
+    notification = None
+
+# ====== 通知（トースト表示・音）の配信 ======
+# 呼び出し側は notify() で通知を積むだけで、表示や音の再生は待たない。
+# 専用スレッドが優先度の高い順（同じ優先度なら古い順）に1件ずつ表示・再生する。
+#
+#   PRIORITY_SCAN   : この端末でのカード読み取りの結果（最優先）
+#   PRIORITY_ALERT  : 他のクライアントの入退室
+#   PRIORITY_MOTION : 人感センサーの検知
+#
+# key を付けた通知は、同じ key の通知がまだ再生されずに残っていればそれにまとめる
+# （表示は新しい内容に置き換え、件数を数える）。人感センサーの検知は続けて届くので key="motion" でまとめ、
+# さらに同じ key の通知は前回の再生から cooldown 秒たつまで待たせる（その間に届いた分もまとめられる）。
+# 積まれた通知が max_pending 件に達したら、優先度の低い古いものから捨てる。
+#
+# 音とトースト表示はバックエンドを差し替えられる（AUDIO_BACKENDS / TOAST_BACKENDS、または
+# beep(frequency, duration_ms) / show(title, message) を持つオブジェクトを渡す）。
+# "null" は何もしないので、winsound や plyer の無い環境（Linux でのテストなど）でも動く。
+#
+# on_latency を渡すと、通知ごとに ("notify_wait", 積まれてから再生を始めるまでの秒数) と
+# ("notify", 表示・再生にかかった秒数) を引数にして呼び出す。
+
+PRIORITY_SCAN = 0
+PRIORITY_ALERT = 1
+PRIORITY_MOTION = 2
+
+# 音の名前 -> (表示用の説明, [(周波数Hz, ミリ秒) または 無音の秒数, ...])
+SOUNDS = {
+    "enter": ("入室: 高い音", [(880, 500)]),
+    "exit": ("退室: 低い音", [(440, 500)]),
+    "motion": ("動き検知: 短い音", [(660, 200), 0.5, (660, 200)]),
+    "recorded": ("記録完了", [(700, 800)]),
+}
+
+
+# ----- バックエンド -----
+class WinsoundAudio:
+    def beep(self, frequency, duration_ms):
+        winsound.Beep(frequency, duration_ms)
+
+
+class PlyerToast:
+    def __init__(self, timeout=3):
+        self.timeout = timeout
+
+    def show(self, title, message):
+        notification.notify(title=title, message=message, timeout=self.timeout)
+
+
+class NullAudio:
+    def beep(self, frequency, duration_ms):
+        pass
+
+
+class NullToast:
+    def show(self, title, message):
+        pass
+
+
+AUDIO_BACKENDS = {"winsound": WinsoundAudio, "null": NullAudio}
+TOAST_BACKENDS = {"plyer": PlyerToast, "null": NullToast}
+
+
+def make_audio(name="auto"):
+    if name == "auto":
+        name = "winsound" if winsound else "null"
+    if name == "winsound" and winsound is None:
+        raise ValueError("winsound が使えない環境です")
+    return AUDIO_BACKENDS[name]()
+
+
+def make_toast(name="auto"):
+    if name == "auto":
+        name = "plyer" if notification else "null"
+    if name == "plyer" and notification is None:
+        raise ValueError("plyer がインストールされていません")
+    return TOAST_BACKENDS[name]()
+
+
+# ----- 配信 -----
+class Notification:
+    def __init__(self, priority, title, message, sound, key, seq):
+        self.priority = priority
+        self.title = title
+        self.message = message
+        self.sound = sound
+        self.key = key
+        self.seq = seq
+        self.count = 1
+        self.queued_at = time.monotonic()
+        self.due = 0.0  # これより前（monotonic）には再生しない
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class NotificationService:
+    def __init__(self, audio="auto", toast="auto", max_pending=32, cooldown=3.0, on_latency=None):
+        self.audio = make_audio(audio) if isinstance(audio, str) else audio
+        self.toast = make_toast(toast) if isinstance(toast, str) else toast
+        self.max_pending = max_pending
+        self.cooldown = cooldown
+        self.on_latency = on_latency
+
+        self.cond = threading.Condition()
+        self.heap = []
+        self.by_key = {}  # key -> 未再生の Notification
+        self.last_played = {}  # key -> 最後に再生した時刻（monotonic）
+        self.pending = 0
+        self.seq = 0
+        self.dropped = 0
+
+        self.thread = threading.Thread(target=self._run, name="notifier", daemon=True)
+        self.thread.start()
+
+    def notify(self, priority, title=None, message=None, sound=None, key=None):
+        """通知を積む（表示・再生は待たない）。title が None ならトーストは出さず音だけ鳴らす"""
+        if sound is not None and sound not in SOUNDS:
+            raise ValueError(f"未知の音です: {sound}")
+        with self.cond:
+            item = self.by_key.get(key) if key is not None else None
+            if item:
+                item.title, item.message, item.sound = title, message, sound
+                item.count += 1
+                return
+            if self.pending >= self.max_pending and not self._drop_one(priority):
+                self.dropped += 1
+                print(f"[通知] 通知が追いつかないため捨てます: {title} {message}")
+                return
+            self.seq += 1
+            item = Notification(priority, title, message, sound, key, self.seq)
+            if key is not None:
+                self.by_key[key] = item
+                item.due = self.last_played.get(key, float("-inf")) + self.cooldown
+            heapq.heappush(self.heap, item)
+            self.pending += 1
+            self.cond.notify_all()
+
+    def _drop_one(self, priority):
+        """priority 以下の優先度（数値が同じか大きい）のうち最も低く古い通知を1件捨てる（cond を保持して呼ぶ）"""
+        candidates = [item for item in self.heap if not item.cancelled and item.priority >= priority]
+        if not candidates:
+            return False
+        victim = max(candidates, key=lambda item: (item.priority, -item.seq))
+        victim.cancelled = True
+        self.pending -= 1
+        if victim.key is not None:
+            self.by_key.pop(victim.key, None)
+        self.dropped += 1
+        print(f"[通知] 通知が追いつかないため古い通知を捨てます: {victim.title} {victim.message}")
+        return True
+
+    def _next(self):
+        """再生できる通知のうち最も優先度の高いものを取り出す。無ければ次に再生できるまでの秒数を返す"""
+        while True:
+            while self.heap and self.heap[0].cancelled:
+                heapq.heappop(self.heap)
+            now = time.monotonic()
+            ready = [item for item in self.heap if not item.cancelled and item.due <= now]
+            if ready:
+                item = min(ready)
+                item.cancelled = True  # ヒープからは上の while で取り除く
+                self.pending -= 1
+                if item.key is not None:
+                    self.by_key.pop(item.key, None)
+                    self.last_played[item.key] = now
+                return item, None
+            waiting = [item.due - now for item in self.heap if not item.cancelled]
+            return None, (min(waiting) if waiting else None)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    item, wait = self._next()
+                    if item:
+                        break
+                    self.cond.wait(wait)
+            started = time.monotonic()
+            self._play(item)
+            if self.on_latency:
+                self.on_latency("notify_wait", started - item.queued_at)
+                self.on_latency("notify", time.monotonic() - started)
+
+    def _play(self, item):
+        if item.title is not None:
+            message = item.message if item.count == 1 else f"{item.message}（{item.count} 件）"
+            try:
+                self.toast.show(item.title, message)
+            except Exception as e:
+                print(f"[通知エラー] {e}")
+        if item.sound is not None:
+            label, tones = SOUNDS[item.sound]
+            print(f"🔊 {label}を再生")
+            try:
+                for tone in tones:
+                    if isinstance(tone, tuple):
+                        self.audio.beep(*tone)
+                    else:
+                        time.sleep(tone)
+            except Exception as e:
+                print(f"[音声通知エラー] {e}")
@@ -0,0 +1,187 @@
+import csv
+import io
+import json
+import os
+import re
+import threading
+
+# ====== 再送キュー（追記専用のセグメントファイル + カーソル） ======
+# 送れなかった行をディレクトリ内のセグメントファイル（00000001.csv, 00000002.csv, ...）に
+# 追記していく。ファイルの書き直しはしない。
+#
+#   append(rows)              : 末尾のセグメントへ追記する（fsync=True なら書き込みごとに fsync）
+#   read_batch(n)             : カーソルの位置から最大 n 行と、読み終えた位置を返す
+#   commit(position)          : 送信済みの位置までカーソルを進めて cursor.json に保存する
+#
+# 位置は (セグメント番号, バイト位置)。カーソルより前のセグメントは読み終えたものとして削除し、
+# 末尾まで読み終えたら新しいセグメントに切り替える（古いセグメントを消せるようにするため）。
+# セグメントが segment_bytes を超えた場合も新しいセグメントに切り替える。
+#
+# カーソルは送信に成功してから進めるので、送信中に落ちた場合は同じ行をもう一度送る
+# （少なくとも1回は届く。二重に届いた分はサーバーがイベントIDで除く）。
+# 書きかけで落ちた末尾の行は開くときに切り捨てる。
+# 行の値に改行は使えない（空白に置き換えて保存する）。
+
+CURSOR_FILE = "cursor.json"
+SEGMENT_PATTERN = re.compile(r"^(\d{8})\.csv$")
+
+
+def encode_row(row):
+    out = io.StringIO(newline='')
+    csv.writer(out, lineterminator="\n").writerow([str(v).replace("\r", " ").replace("\n", " ") for v in row])
+    return out.getvalue().encode("utf-8")
+
+
+class RetryQueue:
+    def __init__(self, directory, segment_bytes=256 * 1024, fsync=True):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = sorted(int(m.group(1)) for m in map(SEGMENT_PATTERN.match, os.listdir(directory)) if m)
+        self.cursor = self._load_cursor()
+        if not self.segments or self.segments[-1] < self.cursor[0]:
+            self.segments.append(self.cursor[0])
+        self.tail = self.segments[-1]
+        self._truncate_partial(self.tail)
+        self.tail_file = open(self._path(self.tail), "ab")
+        self.tail_size = self.tail_file.tell()
+        self._remove_consumed()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:08d}.csv")
+
+    # ----- カーソル -----
+    def _load_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return int(data["segment"]), int(data["offset"])
+        except FileNotFoundError:
+            return (self.segments[0] if self.segments else 1), 0
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # カーソルが壊れていたら先頭から送り直す（重複はサーバー側で除かれる）
+            print(f"[RetryQueue] カーソルの読み込みエラー: {e}")
+            return (self.segments[0] if self.segments else 1), 0
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"segment": self.cursor[0], "offset": self.cursor[1]}, f)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    # ----- セグメント -----
+    def _truncate_partial(self, segment):
+        """書きかけの末尾行（改行で終わっていない部分）を切り捨てる"""
+        path = self._path(segment)
+        if not os.path.exists(path):
+            return
+        with open(path, "r+b") as f:
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end != len(data):
+                print(f"[RetryQueue] {path} の書きかけの行を破棄")
+                f.truncate(end)
+
+    def _roll(self):
+        """新しいセグメントに切り替える（lock を保持して呼ぶ）"""
+        self.tail_file.close()
+        self.tail += 1
+        self.segments.append(self.tail)
+        self.tail_file = open(self._path(self.tail), "ab")
+        self.tail_size = 0
+
+    def _remove_consumed(self):
+        """カーソルより前のセグメントを削除する（lock を保持して呼ぶ）"""
+        for segment in [s for s in self.segments if s < self.cursor[0]]:
+            try:
+                os.remove(self._path(segment))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"[RetryQueue] セグメント削除エラー: {e}")
+                continue
+            self.segments.remove(segment)
+
+    # ----- 追記 -----
+    def append(self, rows):
+        data = b"".join(encode_row(row) for row in rows)
+        if not data:
+            return
+        with self.lock:
+            self.tail_file.write(data)
+            self.tail_file.flush()
+            if self.fsync:
+                os.fsync(self.tail_file.fileno())
+            self.tail_size += len(data)
+            if self.tail_size >= self.segment_bytes:
+                self._roll()
+
+    # ----- 読み出し -----
+    def end_position(self):
+        with self.lock:
+            return self.tail, self.tail_size
+
+    def pending(self):
+        """未送信の行があるか（ファイルは読まない）"""
+        with self.lock:
+            return self.cursor < (self.tail, self.tail_size)
+
+    def read_batch(self, max_rows, end=None, start=None):
+        """
+        start（省略時はカーソル）から end（省略時は現在の末尾）までのうち最大 max_rows 行と、
+        読み終えた位置を返す
+        """
+        with self.lock:
+            segment, offset = start or self.cursor
+            end = end or (self.tail, self.tail_size)
+            segments = [s for s in self.segments if s > segment]
+        rows = []
+        while len(rows) < max_rows and (segment, offset) < end:
+            limit = end[1] if segment == end[0] else None
+            with open(self._path(segment), "rb") as f:
+                f.seek(offset)
+                data = f.read(-1 if limit is None else limit - offset)
+            for line in data.splitlines(keepends=True):
+                if len(rows) >= max_rows or not line.endswith(b"\n"):
+                    break
+                rows.extend(csv.reader([line.decode("utf-8")]))
+                offset += len(line)
+            if len(rows) >= max_rows or segment == end[0] or not segments:
+                break
+            segment, offset = segments.pop(0), 0
+        return rows, (segment, offset)
+
+    def iter_pending(self, batch_rows=1000):
+        """未送信の行を順に返す（カーソルは進めない）"""
+        end = self.end_position()
+        position = None
+        while True:
+            rows, position = self.read_batch(batch_rows, end, position)
+            if not rows:
+                return
+            yield from rows
+
+    # ----- 送信済みの記録 -----
+    def commit(self, position):
+        """position までを送信済みとしてカーソルを進め、読み終えたセグメントを削除する"""
+        with self.lock:
+            if position <= self.cursor:
+                return
+            self.cursor = position
+            if position == (self.tail, self.tail_size) and self.tail_size > 0:
+                self._roll()
+                self.cursor = (self.tail, 0)
+            self._save_cursor()
+            self._remove_consumed()
+
+    def close(self):
+        with self.lock:
+            self.tail_file.close()
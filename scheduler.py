@@ -0,0 +1,265 @@
+import datetime
+import heapq
+import json
+import os
+import threading
+import time
+
+# ====== 定時・定期処理のスケジューラ ======
+# ジョブを実行予定時刻の順にヒープに入れ、専用スレッドが次の予定まで眠って実行する。
+# 毎分の時刻確認（ポーリング）は行わない。
+#
+#   add_daily(name, "HH:MM", func)     : 毎日決まった時刻に実行（強制退室など）
+#                                        with_slot=True なら func(予定時刻) として呼ぶ（run_now では None）
+#   add_interval(name, seconds, func)  : 一定間隔で実行（アーカイブ、再送など）
+#
+# 予定時刻は time.monotonic() 基準で管理する。毎日のジョブは壁時計の時刻から換算するため、
+# 壁時計が変更された（NTPの補正、手動変更など）ことを検知したら予定を計算し直す。
+# 検知のため、次の予定が遠くても CLOCK_CHECK_INTERVAL 秒ごとに一度起きる。
+#
+# 実行漏れ（プロセス停止中や時計が進められて予定時刻を過ぎた場合）:
+#   catch_up=True  : 予定時刻から max_delay 秒以内なら1回だけすぐに実行する
+#   catch_up=False : 実行せず次の予定を待つ
+# 時計が戻された場合も、実行済みの予定時刻（last_slot）より前の予定は実行しない。
+#
+# 各ジョブは実行ごとに別スレッドで動かす（長いジョブが他のジョブの時刻を遅らせない）。
+# 前回の実行が終わっていなければその回は見送る。
+# 実行した時刻・かかった時間・エラーを記録し、history_file を渡すとJSONで保存する
+# （再起動後の実行漏れの判定にも使う）。
+
+CLOCK_CHECK_INTERVAL = 60  # 壁時計の変更を確認する間隔（秒）
+CLOCK_JUMP_TOLERANCE = 5  # これ以上ずれたら壁時計が変更されたとみなす（秒）
+HISTORY_RUNS = 20  # ジョブごとに残す実行記録の件数
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class Job:
+    def __init__(self, name, func, at=None, interval=None, catch_up=False, max_delay=3600, run_at_start=False,
+                 with_slot=False):
+        self.name = name
+        self.func = func
+        self.with_slot = with_slot  # 予定時刻を引数にして func を呼ぶ
+        self.at = at  # 毎日のジョブ: (時, 分)
+        self.interval = interval  # 定期ジョブ: 秒
+        self.catch_up = catch_up
+        self.max_delay = max_delay
+        self.run_at_start = run_at_start
+        self.due = None  # monotonic 基準の次の予定
+        self.slot = None  # 毎日のジョブ: 次に実行する予定時刻（壁時計）
+        self.last_slot = None  # 毎日のジョブ: 最後に実行した予定時刻（壁時計）
+        self.generation = 0  # 予定を立て直すたびに増やす（ヒープ内の古い予定を無視するため）
+        self.running = False
+
+
+class Scheduler:
+    def __init__(self, history_file=None):
+        self.history_file = history_file
+        self.cond = threading.Condition()
+        self.jobs = {}
+        self.heap = []
+        self.seq = 0
+        self.offset = None  # 壁時計 - monotonic
+        self.stopped = False
+        self.thread = None
+        self.records = self._load_history()
+
+    # ----- ジョブの登録 -----
+    def add_daily(self, name, at, func, catch_up=True, max_delay=3600, with_slot=False):
+        """毎日 at（"HH:MM"）に func() を実行する（with_slot なら func(予定時刻)）"""
+        hour, minute = (int(v) for v in at.split(":"))
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError(f"時刻の形式が不正です: {at}")
+        job = Job(name, func, at=(hour, minute), catch_up=catch_up, max_delay=max_delay, with_slot=with_slot)
+        last_slot = self.records.get(name, {}).get("last_slot")
+        if last_slot:
+            job.last_slot = datetime.datetime.strptime(last_slot, TIME_FORMAT)
+        self._add(job)
+
+    def add_interval(self, name, seconds, func, run_at_start=False):
+        """seconds 秒ごとに func() を実行する（run_at_start なら開始直後にも実行）"""
+        if seconds <= 0:
+            raise ValueError(f"間隔は正の秒数: {seconds}")
+        self._add(Job(name, func, interval=seconds, run_at_start=run_at_start))
+
+    def _add(self, job):
+        with self.cond:
+            if job.name in self.jobs:
+                raise ValueError(f"同じ名前のジョブがあります: {job.name}")
+            self.jobs[job.name] = job
+            if self.thread:
+                self._schedule(job, time.monotonic(), datetime.datetime.now(), first=True)
+                self.cond.notify_all()
+
+    # ----- 開始・停止 -----
+    def start(self):
+        with self.cond:
+            if self.thread:
+                return
+            now_m, now_w = time.monotonic(), datetime.datetime.now()
+            self.offset = time.time() - now_m
+            for job in self.jobs.values():
+                self._schedule(job, now_m, now_w, first=True)
+            self.thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def run_now(self, name):
+        """ジョブをすぐに実行する（予定はそのまま）"""
+        with self.cond:
+            job = self.jobs[name]
+        self._launch(job, None)
+
+    # ----- 予定の計算 -----
+    def _next_slot(self, job, now_w):
+        """
+        last_slot より後の最初の予定時刻を返す。それが過去なら実行漏れで、
+        catch_up かつ max_delay 以内ならその予定（すぐ実行）、それ以外は now_w より後の予定。
+        """
+        hour, minute = job.at
+        today = now_w.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        upcoming = today if today > now_w else today + datetime.timedelta(days=1)
+        missed = upcoming - datetime.timedelta(days=1)
+        if job.last_slot is None:  # 実行記録が無い初回は直前の予定を実行済みとみなす
+            job.last_slot = missed
+            record = self.records.setdefault(job.name, {"count": 0, "runs": []})
+            record["last_slot"] = missed.strftime(TIME_FORMAT)
+            self._save_history()
+        if missed <= job.last_slot:
+            while upcoming <= job.last_slot:  # 時計が戻された場合、実行済みの予定は飛ばす
+                upcoming += datetime.timedelta(days=1)
+            return upcoming
+        if job.catch_up and (now_w - missed).total_seconds() <= job.max_delay:
+            print(f"[scheduler] {job.name}: {missed.strftime(TIME_FORMAT)} の実行漏れを実行します")
+            return missed
+        print(f"[scheduler] {job.name}: {missed.strftime(TIME_FORMAT)} の実行漏れは見送ります")
+        return upcoming
+
+    def _schedule(self, job, now_m, now_w, first=False):
+        """次の予定を立ててヒープに入れる（cond を保持して呼ぶ）"""
+        if job.at:
+            job.slot = self._next_slot(job, now_w)
+            job.due = now_m + max((job.slot - now_w).total_seconds(), 0)
+        elif first:
+            job.due = now_m if job.run_at_start else now_m + job.interval
+        else:
+            job.due += job.interval
+            if job.due <= now_m:  # 大きく遅れた分はまとめて1回にする
+                job.due = now_m + job.interval
+        job.generation += 1
+        self.seq += 1
+        heapq.heappush(self.heap, (job.due, self.seq, job.generation, job))
+
+    def _check_clock(self, now_m):
+        """壁時計が変更されていれば毎日のジョブの予定を立て直す（cond を保持して呼ぶ）"""
+        offset = time.time() - now_m
+        drift = offset - self.offset
+        if abs(drift) < CLOCK_JUMP_TOLERANCE:
+            return
+        self.offset = offset
+        print(f"[scheduler] 時計の変更を検知しました（{drift:+.0f} 秒）。予定を再計算します")
+        now_w = datetime.datetime.now()
+        for job in self.jobs.values():
+            if job.at:
+                self._schedule(job, now_m, now_w)
+
+    # ----- 実行 -----
+    def _run(self):
+        with self.cond:
+            while not self.stopped:
+                now_m = time.monotonic()
+                self._check_clock(now_m)
+                while self.heap and self.heap[0][0] <= now_m:
+                    _, _, generation, job = heapq.heappop(self.heap)
+                    if generation != job.generation:
+                        continue
+                    slot = job.slot
+                    if job.at:
+                        job.last_slot = slot
+                    self._schedule(job, now_m, datetime.datetime.now())
+                    self._launch(job, slot)
+                timeout = CLOCK_CHECK_INTERVAL
+                if self.heap:
+                    timeout = min(max(self.heap[0][0] - now_m, 0), timeout)
+                self.cond.wait(timeout)
+
+    def _launch(self, job, slot):
+        if job.running:
+            print(f"[scheduler] {job.name}: 前回の実行が終わっていないため見送ります")
+            return
+        job.running = True
+        threading.Thread(target=self._execute, args=(job, slot), name=f"job[{job.name}]", daemon=True).start()
+
+    def _execute(self, job, slot):
+        started = datetime.datetime.now()
+        begin = time.monotonic()
+        error = None
+        try:
+            if job.with_slot:
+                job.func(slot)
+            else:
+                job.func()
+        except Exception as e:
+            error = str(e)
+            print(f"[scheduler] {job.name} エラー: {e}")
+        finally:
+            job.running = False
+        self._record(job, slot, started, time.monotonic() - begin, error)
+
+    # ----- 実行記録 -----
+    def _load_history(self):
+        if not self.history_file or not os.path.exists(self.history_file):
+            return {}
+        try:
+            with open(self.history_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[scheduler] 実行記録の読み込みエラー: {e}")
+            return {}
+
+    def _record(self, job, slot, started, duration, error):
+        run = {"started": started.strftime(TIME_FORMAT), "duration": round(duration, 3)}
+        if slot:
+            run["slot"] = slot.strftime(TIME_FORMAT)
+        if error:
+            run["error"] = error
+        with self.cond:
+            record = self.records.setdefault(job.name, {"count": 0, "runs": []})
+            record["count"] += 1
+            record["last_run"] = run["started"]
+            record["last_duration"] = run["duration"]
+            if job.last_slot:
+                record["last_slot"] = job.last_slot.strftime(TIME_FORMAT)
+            record["runs"] = (record["runs"] + [run])[-HISTORY_RUNS:]
+            self._save_history()
+
+    def _save_history(self):
+        """実行記録をファイルへ書き出す（cond を保持して呼ぶ）"""
+        if not self.history_file:
+            return
+        try:
+            tmp_path = self.history_file + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.records, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.history_file)
+        except OSError as e:
+            print(f"[scheduler] 実行記録の保存エラー: {e}")
+
+    def history(self):
+        """ジョブごとの実行記録と次の予定を返す"""
+        with self.cond:
+            now_m = time.monotonic()
+            result = {}
+            for name, job in self.jobs.items():
+                record = dict(self.records.get(name, {"count": 0, "runs": []}))
+                if job.at and job.slot:
+                    record["next_run"] = job.slot.strftime(TIME_FORMAT)
+                elif job.due is not None:
+                    next_run = datetime.datetime.now() + datetime.timedelta(seconds=max(job.due - now_m, 0))
+                    record["next_run"] = next_run.strftime(TIME_FORMAT)
+                record["running"] = job.running
+                result[name] = record
+            return result
@@ -5,17 +5,108 @@ import os
 import datetime
 import time
 import json
+import argparse
+import contextlib
+import zlib
+import glob
+import io
+import itertools
+import sqlite3
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from log_writer import DailyLogWriter
+from scheduler import Scheduler
+from log_archive import LogArchive, archive_filename, archive_old_logs, to_csv_bytes, ARCHIVE_EXT
 
 # ====== 設定 ======
 HOST = '0.0.0.0'
 PORT = サーバのポート番号
 USER_CSV = "user_data.csv"
 ENTRY_STATE_FILE = "entry_state.json"
+ENTRY_STATE_JOURNAL = "entry_state.journal"
+DEDUP_EVENTS_FILE = "entry_events.log"  # 処理済みのイベントID（追記のみ。古いものは書き直して捨てる）
+JOURNAL_COMPACT_RECORDS = 1000  # ジャーナルがこの件数を超えたらスナップショットへ集約
+JOURNAL_COMPACT_INTERVAL = 300  # 件数に達しなくてもこの秒数ごとに集約
+JOURNAL_FSYNC = False  # True にすると1件ごとにfsync（電源断でも直前の記録まで残る）
 MISSED_EXIT_FILE = "missed_exit.json"
+LOG_FLUSH_INTERVAL = 1.0  # 入退室ログをまとめて書き込む間隔（秒）。0 で即時書き込み
+LOG_FLUSH_ROWS = 100  # この行数がたまったら間隔を待たずに書き込む
+LOG_FSYNC = "never"  # "never": flushのみ / "batch": まとめ書きごとにfsync（log_writer.py参照）
+LOG_INDEX_DB = "entry_index.db"  # 入退室ログの検索用索引（SQLite）
+QUERY_FETCH_ROWS = 500  # QUERY_LOG で一度に読み出して送る行数
+SERVER_MODE = "thread"  # "thread"（接続ごとにスレッド） / "async"（イベントループ）
+IO_WORKERS = 8  # イベントループモードでファイルI/Oを処理するスレッド数の上限
+PROTOCOL_VERSION = 2  # フレーム化プロトコルの最新バージョン
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # 1フレームの最大サイズ（バイト）
+PROTOCOL_FEATURES = ["zlib"]  # HELLO で交渉できる機能
+LOG_COMPRESS_LEVEL = 6  # ログ送信を zlib 圧縮するときの圧縮レベル
+STATE_LOCK_STRIPES = 64  # 入退室状態のロックを idm ごとに分割する数
+ARCHIVE_AFTER_DAYS = 1  # この日数より前の入退室ログをアーカイブ（.lgz）へ変換する
+ARCHIVE_INTERVAL = 3600  # アーカイブ対象を確認する間隔（秒）
+STATS_CHECKPOINT_INTERVAL = 3600  # 累計滞在時間を索引に保存する間隔（秒）。起動時はその後の分だけ読む
+FORCE_CHECKOUT_TIME = "20:00"  # 全員を強制退室させる時刻
+FORCE_CHECKOUT_MAX_DELAY = 4 * 3600  # 停止中などで実行漏れした強制退室を、この秒数以内なら起動後に実行
+SCHEDULER_HISTORY_FILE = "scheduler_history.json"  # 定時処理の実行記録
+SUBSCRIBER_QUEUE_SIZE = 256  # 購読者ごとに送信待ちにできる通知の上限（超えたら古いものから捨てる）
+SUBSCRIBE_HEARTBEAT = 30  # 通知が無いときに HEARTBEAT を送る間隔（秒）
+SUBSCRIBE_SEND_TIMEOUT = 10  # 購読者への送信がこの秒数進まなければ切断する
+DEDUP_WINDOW = 7 * 24 * 3600  # 同じイベントIDを重複とみなす期間（秒）
+DEDUP_MAX_EVENTS = 100000  # 重複判定のために覚えておくイベントIDの上限（古いものから忘れる）
 
-lock = threading.Lock()
+# ロックは用途ごとに分ける（どれもファイルI/Oの間に他の用途を止めない）
+#   users_lock  : ユーザー登録（user_data.csv への追記）
+#   state_locks : idm のハッシュで分割した入退室状態のロック
+#   journal_lock: ジャーナルへの追記とスナップショット切り替え
+#   index_lock  : ログの索引（entry_index.db）の更新とアーカイブへの変換
+#   stats_lock  : 在室状況の集計（メモリ上のみ。他のロックを保持したまま取ってよい）
+#   subscribers_lock: 通知の購読者の一覧（他のロックを保持したまま取ってよい）
+#   state_version_lock: 入退室状態の版と変更履歴（他のロックを保持したまま取ってよい）
+#   dedup_lock  : 処理済みイベントIDの索引（他のロックを保持したまま取ってよい）
+#   ログ書き込みは log_writer が自前のキューで排他する
+# CHECK / GET_ENTRY_STATE は辞書の参照・コピーだけなのでロックを取らない。
+# 複数のロックを取る場合は users_lock → state_locks（番号順） → journal_lock の順。
+users_lock = threading.Lock()
+state_locks = [threading.Lock() for _ in range(STATE_LOCK_STRIPES)]
 entry_state = {}
 
+journal_lock = threading.Lock()
+journal_file = None
+journal_seq = 0
+journal_records = 0  # 前回の集約以降に追記した件数
+journal_events = []  # 前回の集約以降に処理したイベント [[イベントID, 時刻, 応答], ...]
+dedup_file_lines = 0  # DEDUP_EVENTS_FILE の行数
+compact_request = threading.Event()
+
+state_version_lock = threading.Lock()
+state_version = 0
+state_epoch = str(int(time.time()))  # 版番号は起動ごとに0から数え直すため、起動の区別に使う
+state_changes = collections.OrderedDict()  # idm → 最後に状態が変わった版（古い順）
+state_snapshot = (-1, b"")  # (版, GET_ENTRY_STATE の全件のJSON)
+
+dedup_lock = threading.Lock()
+dedup_events = collections.OrderedDict()  # イベントID → (処理した時刻, 応答)（古い順）
+
+stats_lock = threading.Lock()
+stats = {"date": None, "headcount": 0, "hourly_in": [0] * 24, "hourly_out": [0] * 24}
+presence_total = {}  # idm → 退室済みの滞在時間の合計（秒）
+present_since = {}  # idm → 入室中の人の入室時刻
+
+index_lock = threading.RLock()  # アーカイブ処理が索引の更新をまとめて保持するため再入可能
+index_db = None
+
+subscribers_lock = threading.Lock()
+subscribers = set()
+
+scheduler = Scheduler(SCHEDULER_HISTORY_FILE)
+
+log_writer = DailyLogWriter("entry_log", ["timestamp", "idm", "name", "action"],
+                            flush_interval=LOG_FLUSH_INTERVAL, flush_rows=LOG_FLUSH_ROWS,
+                            fsync=LOG_FSYNC,
+                            on_commit=lambda dates: update_log_index(
+                                [log_writer.filename(d) for d in dates]))
+
 
 # ====== ユーザー情報の読み書き ======
 def load_users():
@@ -29,7 +120,7 @@ def load_users():
 
 
 def register_user(users, idm, name):
-    with lock:
+    with users_lock:
         if idm in users:
             return False
         users[idm] = name
@@ -38,30 +129,306 @@ def register_user(users, idm, name):
         return True
 
 
+# ====== 入退室状態のロック ======
+def state_lock(idm):
+    return state_locks[hash(idm) % STATE_LOCK_STRIPES]
+
+
+@contextlib.contextmanager
+def state_locks_for(idms):
+    """複数の idm に対応するロックを番号順に取得する（デッドロック防止）"""
+    stripes = sorted({hash(idm) % STATE_LOCK_STRIPES for idm in idms})
+    with contextlib.ExitStack() as stack:
+        for i in stripes:
+            stack.enter_context(state_locks[i])
+        yield
+
+
+def all_state_locks():
+    return state_locks_for(range(STATE_LOCK_STRIPES))
+
+
 # ====== 入退室状態の保存・復元 ======
+# 状態の変化はジャーナル（1行1レコードのJSON）へ追記するだけにし、
+# 全体のスナップショット（entry_state.json）はバックグラウンドで定期的に書き直す。
+# スナップショットは一時ファイルへ書いてから置き換えるため、途中で落ちても壊れない。
+# 起動時はスナップショットを読み、それより新しい seq のジャーナルを再適用する。
+# ジャーナルのレコードは {"seq", "idm", "state"}（状態の変化）と
+# {"seq", "event", "ts", "result"}（処理済みのイベントID）の2種類。
+# 処理済みのイベントIDはスナップショットに入れず、集約のたびに前回以降の分だけを
+# DEDUP_EVENTS_FILE へ追記する（集約の手間がイベントIDを覚えておく件数に比例しないように）。
+# このファイルは覚えている件数の2倍を超えたら、覚えている分だけに書き直す。
+def read_journal(path):
+    """ジャーナルを読み、(レコード一覧, 正常に読めた末尾位置) を返す。書きかけの末尾行は無視する"""
+    records = []
+    valid_end = 0
+    if not os.path.exists(path):
+        return records, valid_end
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+            valid_end += len(line)
+    return records, valid_end
+
+
 def load_entry_state():
-    global entry_state
+    global entry_state, journal_file, journal_seq, journal_records, dedup_file_lines
+    records, valid_end = read_journal(DEDUP_EVENTS_FILE)
+    for event_id, ts, result in records:
+        remember_event(event_id, result, ts)
+    dedup_file_lines = len(records)
+    if os.path.exists(DEDUP_EVENTS_FILE) and os.path.getsize(DEDUP_EVENTS_FILE) != valid_end:
+        print(f"[load_entry_state] {DEDUP_EVENTS_FILE} の書きかけの行を破棄")
+        os.truncate(DEDUP_EVENTS_FILE, valid_end)
+
+    entry_state = {}
+    snapshot_seq = 0
     if os.path.exists(ENTRY_STATE_FILE):
         try:
             with open(ENTRY_STATE_FILE, "r", encoding="utf-8") as f:
-                entry_state = json.load(f)
+                data = json.load(f)
+            if isinstance(data.get("state"), dict) and "seq" in data:
+                entry_state = data["state"]
+                snapshot_seq = data["seq"]
+                # イベントIDをスナップショットに入れていた形式 → 次の集約で DEDUP_EVENTS_FILE へ移す
+                for event_id, ts, result in data.get("events", []):
+                    remember_event(event_id, result, ts)
+                    journal_events.append([event_id, ts, result])
+            else:
+                entry_state = data  # ジャーナル導入前の形式
         except Exception as e:
             print(f"[load_entry_state] エラー: {e}")
             entry_state = {}
+
+    journal_seq = snapshot_seq
+    replayed = 0
+    for path in (ENTRY_STATE_JOURNAL + ".old", ENTRY_STATE_JOURNAL):
+        records, valid_end = read_journal(path)
+        for record in records:
+            if record["seq"] > snapshot_seq:
+                if "event" in record:
+                    remember_event(record["event"], record["result"], record["ts"])
+                    journal_events.append([record["event"], record["ts"], record["result"]])
+                else:
+                    entry_state[record["idm"]] = record["state"]
+                replayed += 1
+            journal_seq = max(journal_seq, record["seq"])
+        if path == ENTRY_STATE_JOURNAL:
+            journal_records = len(records)  # 集約の対象（0 だと compact_entry_state が何もしない）
+        if os.path.exists(path) and os.path.getsize(path) != valid_end:
+            print(f"[load_entry_state] {path} の書きかけレコードを破棄")
+            os.truncate(path, valid_end)
+
+    journal_file = open(ENTRY_STATE_JOURNAL, "a", encoding="utf-8")
+    if replayed:
+        print(f"[load_entry_state] ジャーナルから {replayed} 件を再適用")
+    if journal_records or journal_events:
+        compact_request.set()
+
+
+def save_entry_state(idms, events=()):
+    """
+    指定した idm の現在の状態をジャーナルへまとめて追記する。
+    events（(イベントID, 応答) のリスト）を渡すと処理済みとして覚え、同じ書き込みで記録する。
+    """
+    global journal_seq, journal_records
+    with journal_lock:
+        lines = []
+        for idm in idms:
+            journal_seq += 1
+            lines.append(json.dumps(
+                {"seq": journal_seq, "idm": idm, "state": entry_state.get(idm, False)},
+                ensure_ascii=False) + "\n")
+        now = time.time()
+        for event_id, result in events:
+            remember_event(event_id, result, now)
+            journal_events.append([event_id, now, result])
+            journal_seq += 1
+            lines.append(json.dumps(
+                {"seq": journal_seq, "event": event_id, "ts": now, "result": result},
+                ensure_ascii=False) + "\n")
+        try:
+            journal_file.write("".join(lines))
+            journal_file.flush()
+            if JOURNAL_FSYNC:
+                os.fsync(journal_file.fileno())
+        except Exception as e:
+            print(f"[save_entry_state] エラー: {e}")
+        journal_records += len(lines)
+        if journal_records >= JOURNAL_COMPACT_RECORDS:
+            compact_request.set()
+
+
+def write_entry_state_snapshot(seq, state):
+    tmp_path = ENTRY_STATE_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"seq": seq, "state": state}, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, ENTRY_STATE_FILE)
+
+
+def write_dedup_events(events):
+    """処理済みのイベントIDを DEDUP_EVENTS_FILE へ追記する。行が増えすぎていれば覚えている分だけに書き直す"""
+    global dedup_file_lines
+    if dedup_file_lines + len(events) > 2 * max(len(dedup_events), JOURNAL_COMPACT_RECORDS):
+        events = recent_events()
+        mode, dedup_file_lines = "w", 0
+        path = DEDUP_EVENTS_FILE + ".tmp"
     else:
-        entry_state = {}
+        mode, path = "a", DEDUP_EVENTS_FILE
+    with open(path, mode, encoding="utf-8") as f:
+        f.write("".join(json.dumps(event, ensure_ascii=False) + "\n" for event in events))
+        f.flush()
+        os.fsync(f.fileno())
+    if mode == "w":
+        os.replace(path, DEDUP_EVENTS_FILE)
+    dedup_file_lines += len(events)
+
 
+def compact_entry_state():
+    """現在の状態をスナップショットに書き出し、反映済みのジャーナルを削除する"""
+    global journal_file, journal_records, journal_events
+    old_path = ENTRY_STATE_JOURNAL + ".old"
+    with journal_lock:
+        if journal_records == 0 and not journal_events and not os.path.exists(old_path):
+            return
+        snapshot = dict(entry_state)
+        events, journal_events = journal_events, []
+        seq = journal_seq
+        # 前回の集約が失敗して .old が残っている場合は切り替えない
+        # （現在のジャーナルに残る seq 以下のレコードは次回起動時に読み飛ばされる）
+        if not os.path.exists(old_path):
+            journal_file.close()
+            os.replace(ENTRY_STATE_JOURNAL, old_path)
+            journal_file = open(ENTRY_STATE_JOURNAL, "a", encoding="utf-8")
+            journal_records = 0
 
-def save_entry_state():
+    # イベントIDを先に書く（スナップショットの後で落ちると、その seq 以下のジャーナルは読まれない）
     try:
-        with open(ENTRY_STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(entry_state, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"[save_entry_state] エラー: {e}")
+        if events:
+            write_dedup_events(events)
+    except Exception:
+        with journal_lock:
+            journal_events = events + journal_events  # 次の集約でやり直す
+        raise
+    write_entry_state_snapshot(seq, snapshot)
+    if os.path.exists(old_path):
+        os.remove(old_path)
+
+
+def entry_state_compactor():
+    while True:
+        compact_request.wait(JOURNAL_COMPACT_INTERVAL)
+        compact_request.clear()
+        try:
+            compact_entry_state()
+        except Exception as e:
+            print(f"[entry_state_compactor] エラー: {e}")
+
+
+# ====== イベントIDによる重複排除 ======
+# クライアントはスキャンごとに一意なイベントIDを付けて送る（TOGGLE / ENTRY_EVENT / ENTRY_EVENT_BATCH）。
+# 処理したイベントIDと応答を DEDUP_WINDOW 秒・最大 DEDUP_MAX_EVENTS 件覚えておき、
+# 再送などで同じIDが届いたら状態もログも変えずに最初の応答を返す。
+# 覚えたIDはジャーナルと DEDUP_EVENTS_FILE に入るため、再起動しても忘れない。
+# 判定から記録までは idm の state_lock を保持して行う（同じイベントは同じ idm なので二重に通らない）。
+MAX_EVENT_ID_LENGTH = 64
+
+
+def valid_event_id(event_id):
+    return bool(event_id) and len(event_id) <= MAX_EVENT_ID_LENGTH and \
+        all(c.isalnum() or c in "-_" for c in event_id)
+
+
+def find_event(event_id):
+    """処理済みのイベントIDなら最初の応答を、そうでなければ None を返す"""
+    if not event_id:
+        return None
+    with dedup_lock:
+        entry = dedup_events.get(event_id)
+    if entry and time.time() - entry[0] <= DEDUP_WINDOW:
+        return entry[1]
+    return None
+
+
+def remember_event(event_id, result, ts):
+    with dedup_lock:
+        dedup_events[event_id] = (ts, result)
+        dedup_events.move_to_end(event_id)
+        limit = time.time() - DEDUP_WINDOW
+        while dedup_events:
+            oldest_ts = next(iter(dedup_events.values()))[0]
+            if len(dedup_events) <= DEDUP_MAX_EVENTS and oldest_ts >= limit:
+                break
+            dedup_events.popitem(last=False)
+
+
+def recent_events():
+    """覚えている [[イベントID, 時刻, 応答], ...]（DEDUP_EVENTS_FILE を書き直すときに使う）"""
+    with dedup_lock:
+        return [[event_id, ts, result] for event_id, (ts, result) in dedup_events.items()]
+
+
+# ====== 入退室状態の版（GET_ENTRY_STATE） ======
+# 状態が変わるたびに版を1つ進め、idm ごとに最後に変わった版を記録する。
+# GET_ENTRY_STATE の全件のJSONは版が変わるまで使い回し、
+# "GET_ENTRY_STATE,<epoch>,<版>" にはその版より後に変わった idm だけを返す。
+# 版を読んでから状態を読むので、応答には少なくともその版までの変更が入っている
+# （それより新しい変更が入っていても、次の差分で同じ内容が届くだけで矛盾しない）。
+def set_entry_state(idm, is_in):
+    """入退室状態を更新し、変わった場合は版を進める。変更前の状態を返す（idm の state_lock を保持して呼ぶ）"""
+    global state_version
+    previous = entry_state.get(idm)
+    entry_state[idm] = is_in
+    if previous != is_in:
+        with state_version_lock:
+            state_version += 1
+            state_changes[idm] = state_version
+            state_changes.move_to_end(idm)
+    return bool(previous)
+
+
+def entry_state_entries(items, users):
+    return [{"idm": idm, "name": users.get(idm, "不明"), "state": "IN" if state else "OUT"}
+            for idm, state in items]
+
+
+def entry_state_snapshot(users):
+    """(版, 全件のJSON) を返す。版が変わっていなければ前回作ったものを返す"""
+    global state_snapshot
+    with state_version_lock:
+        version = state_version
+        cached_version, data = state_snapshot
+    if cached_version == version:
+        return version, data
+    data = json.dumps(entry_state_entries(dict(entry_state).items(), users), ensure_ascii=False).encode("utf-8")
+    with state_version_lock:
+        if version > state_snapshot[0]:
+            state_snapshot = (version, data)
+    return version, data
+
+
+def entry_state_delta(since, users):
+    """(版, since より後に状態が変わった idm の一覧) を返す"""
+    with state_version_lock:
+        version = state_version
+        idms = []
+        for idm, changed in reversed(state_changes.items()):
+            if changed <= since:
+                break
+            idms.append(idm)
+    return version, entry_state_entries(((idm, entry_state.get(idm, False)) for idm in reversed(idms)), users)
 
 
 # ====== ログ保存 ======
 def save_log(idm, name, action, scan_timestamp=None):
+    """ログ行を log_writer のキューに積み、記録した時刻を返す（書き込みはまとめて非同期に行われる）"""
     try:
         if scan_timestamp:
             try:
@@ -72,18 +439,483 @@ def save_log(idm, name, action, scan_timestamp=None):
             now = datetime.datetime.now()
         timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
         date_str = now.strftime("%Y-%m-%d")
-        log_filename = f"entry_log_{date_str}.csv"
-
-        file_exists = os.path.isfile(log_filename)
-        with open(log_filename, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            if not file_exists:
-                writer.writerow(["timestamp", "idm", "name", "action"])
-            writer.writerow([timestamp, idm, name, action])
+        log_writer.write(date_str, [timestamp, idm, name, action])
+        return now
     except Exception as e:
         print(f"[save_log] エラー: {e}")
 
 
+# ====== ログの索引（SQLite） ======
+# entry_log_*.csv の内容を SQLite に写して、日をまたいだ検索をできるようにする。
+# ファイルごとに索引済みのバイト位置を記録し、log_writer のまとめ書きのたびに
+# 追記された分だけを取り込む。起動時も同じ処理で未索引の分を取り込む。
+def open_index_db():
+    db = sqlite3.connect(LOG_INDEX_DB, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+
+def get_index_db():
+    global index_db
+    if index_db is None:
+        index_db = open_index_db()
+        with index_db:
+            index_db.execute(
+                "CREATE TABLE IF NOT EXISTS entries (ts TEXT, date TEXT, idm TEXT, name TEXT, action TEXT)")
+            index_db.execute("CREATE INDEX IF NOT EXISTS entries_ts ON entries(ts)")
+            index_db.execute("CREATE INDEX IF NOT EXISTS entries_idm_ts ON entries(idm, ts)")
+            index_db.execute(
+                "CREATE TABLE IF NOT EXISTS indexed_files (filename TEXT PRIMARY KEY, offset INTEGER)")
+            index_db.execute(
+                "CREATE TABLE IF NOT EXISTS presence "
+                "(idm TEXT PRIMARY KEY, total REAL, is_in INTEGER, last_ts TEXT, in_since TEXT)")
+            index_db.execute(
+                "CREATE TABLE IF NOT EXISTS presence_checkpoint (id INTEGER PRIMARY KEY, rid INTEGER, ts TEXT, idm TEXT)")
+    return index_db
+
+
+def day_log_files(date_str="*"):
+    """索引の対象ファイル。同じ日はアーカイブ → CSV（アーカイブ後に届いた行）の順"""
+    files = glob.glob(f"entry_log_{date_str}{ARCHIVE_EXT}") + glob.glob(f"entry_log_{date_str}.csv")
+    return sorted(files, key=lambda f: (os.path.splitext(f)[0], f.endswith(".csv")))
+
+
+def index_log_file(db, filename):
+    """1ファイルの未索引部分を索引に追加する（index_lock を保持して呼ぶ）"""
+    if not os.path.exists(filename):  # アーカイブ済み
+        return
+    date_str = os.path.splitext(os.path.basename(filename))[0][len("entry_log_"):]
+    archive = LogArchive(filename) if filename.endswith(ARCHIVE_EXT) else None
+    size = archive.csv_size if archive else os.path.getsize(filename)
+    row = db.execute("SELECT offset FROM indexed_files WHERE filename = ?",
+                     (filename,)).fetchone()
+    offset = row[0] if row else 0
+    if offset > size:  # ファイルが作り直された → その日の分を取り込み直す
+        with db:
+            db.execute("DELETE FROM entries WHERE date = ?", (date_str,))
+            db.execute("DELETE FROM indexed_files WHERE filename IN (?, ?)",
+                       (f"entry_log_{date_str}.csv", f"entry_log_{date_str}{ARCHIVE_EXT}"))
+        for other in day_log_files(date_str):
+            index_log_file(db, other)
+        return
+    if offset == size:
+        return
+    if archive:
+        data = b"".join(archive.iter_csv(offset))
+    else:
+        with open(filename, "rb") as f:
+            f.seek(offset)
+            data = f.read(size - offset)
+        data = data[:data.rfind(b"\n") + 1]  # 書きかけの行は次回に回す
+    rows = [
+        (r[0], date_str, r[1], r[2], r[3])
+        for r in csv.reader(io.StringIO(data.decode("utf-8", errors="replace")))
+        if len(r) >= 4 and r[0] != "timestamp"
+    ]
+    with db:
+        db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?)", rows)
+        db.execute("INSERT OR REPLACE INTO indexed_files VALUES (?, ?)",
+                   (filename, offset + len(data)))
+
+
+def update_log_index(filenames=None):
+    """ログファイルの未索引部分を索引に追加する（filenames 省略時は全日分）"""
+    if filenames is None:
+        filenames = day_log_files()
+    with index_lock:
+        db = get_index_db()
+        for filename in filenames:
+            try:
+                index_log_file(db, filename)
+            except Exception as e:
+                print(f"[update_log_index] {filename} エラー: {e}")
+
+
+def build_log_query(filters):
+    """
+    検索条件から (SQL, 引数) を作る。条件が不正なら ValueError。
+    filters: idm / name / action / since / until（"YYYY-MM-DD[ HH:MM:SS]"） / limit
+    """
+    where = []
+    args = []
+    for key in ("idm", "name"):
+        if filters.get(key):
+            where.append(f"{key} = ?")
+            args.append(filters[key])
+    if filters.get("action"):
+        where.append("action = ?")
+        args.append({"IN": "入室", "OUT": "退室"}.get(filters["action"], filters["action"]))
+    if filters.get("since"):
+        where.append("ts >= ?")
+        args.append(filters["since"])
+    if filters.get("until"):
+        until = filters["until"]
+        where.append("ts <= ?")
+        args.append(until + " 23:59:59" if len(until) == 10 else until)
+    sql = "SELECT ts, idm, name, action FROM entries"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY ts"
+    if filters.get("limit"):
+        sql += " LIMIT ?"
+        args.append(int(filters["limit"]))
+    return sql, args
+
+
+def query_log_index(sql, args):
+    """索引を検索し、CSV（見出し付き）を少しずつ返す"""
+    with index_lock:
+        get_index_db()  # テーブルがまだ無ければ作る
+    db = open_index_db()
+    try:
+        cursor = db.execute(sql, args)
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(["timestamp", "idm", "name", "action"])
+        while True:
+            rows = cursor.fetchmany(QUERY_FETCH_ROWS)
+            writer.writerows(rows)
+            yield out.getvalue().encode("utf-8")
+            out.seek(0)
+            out.truncate()
+            if not rows:
+                break
+    finally:
+        db.close()
+
+
+# ====== ログのアーカイブ ======
+# 日付の変わった entry_log_*.csv を log_archive.py の形式（.lgz）に変換する。
+# 変換後も GET_LOG / GET_LOG_SINCE / QUERY_LOG からは CSV と同じように読める。
+# アーカイブ後に届いた行（再送された前日分など）は同じ日の CSV に書かれ、
+# 読み出し時はアーカイブの後ろに続けて扱い、次回の変換でアーカイブへ追加される。
+def on_log_archived(csv_path, archive):
+    """CSV を削除する直前に、索引済みの位置をアーカイブ側へ移す"""
+    update_log_index([csv_path])
+    with index_lock:
+        db = get_index_db()
+        with db:
+            db.execute("DELETE FROM indexed_files WHERE filename = ?", (csv_path,))
+            db.execute("INSERT OR REPLACE INTO indexed_files VALUES (?, ?)",
+                       (archive_filename(csv_path), archive.csv_size))
+
+
+def run_archival():
+    before = (datetime.date.today() - datetime.timedelta(days=ARCHIVE_AFTER_DAYS - 1)).strftime("%Y-%m-%d")
+    log_writer.flush()
+    # 変換の間は索引を更新させない（CSVの削除前に同じ行を取り込み直さないように）
+    with index_lock:
+        update_log_index()
+        archived = archive_old_logs("entry_log", before, writer=log_writer, on_archived=on_log_archived)
+    if archived:
+        print(f"[アーカイブ] {len(archived)} 日分を変換しました")
+
+
+def open_day_log(date_str):
+    """
+    その日のログを (サイズ, アーカイブ, CSVのパス, CSVの読み飛ばすバイト数) で返す。
+    アーカイブがある日は、アーカイブの内容の後ろに CSV の見出しを除いた部分が続く。
+    """
+    log_writer.flush()
+    csv_path = log_writer.filename(date_str)
+    archive_path = archive_filename(csv_path)
+    archive = LogArchive(archive_path) if os.path.exists(archive_path) else None
+    csv_size = os.path.getsize(csv_path) if os.path.exists(csv_path) else 0
+    skip = len(to_csv_bytes([archive.columns])) if archive and csv_size else 0
+    size = (archive.csv_size if archive else 0) + csv_size - skip
+    return size, archive, csv_path, skip
+
+
+def day_log_response(day_log, start=0, header=b"", compress=False):
+    """open_day_log() の start バイト目以降を送る応答を作る"""
+    size, archive, csv_path, skip = day_log
+    if archive is None:
+        return FileResponse(csv_path, start, size - start, header, compress)
+    csv_start = skip + max(start - archive.csv_size, 0)
+    tail = FileResponse(csv_path, csv_start, size - archive.csv_size + skip - csv_start)
+    chunks = itertools.chain([header], archive.iter_csv(start), tail.iter_chunks())
+    return StreamResponse(chunks, compress)
+
+
+# ====== 在室状況の集計 ======
+# 入退室を反映するたびに集計を更新し、STATS コマンドはログを読まずに返す。
+#   headcount          : 現在の在室人数
+#   hourly_in / out    : 当日の時間帯（0〜23時）ごとの入室・退室の件数（ログの行数と一致）
+#   presence_total     : idm ごとの累計滞在時間（入室中の分は STATS で現在時刻まで足す）
+# 起動時は索引（entry_index.db）と entry_state から作り直す。
+# 累計滞在時間は索引の presence 表に「どの行まで数えたか」（presence_checkpoint）と一緒に保存し、
+# 起動時と STATS_CHECKPOINT_INTERVAL 秒ごとに、それより後に索引へ入った行だけを足し込む。
+# 数えた行より古い日時の行が後から入った idm（再送された前日分、取り込み直した日など）は、
+# その idm の分だけ全履歴から数え直す。保存した位置の行が索引に無ければ全員分を数え直す。
+def advance_presence(state, rows):
+    """state = [累計秒, 入室中か, 最後の行の日時, 入室した日時] に (日時, 入室か) の行を日時順に反映する"""
+    for ts, is_in in rows:
+        is_in = bool(is_in)
+        if is_in != state[1]:
+            if is_in:
+                state[3] = ts
+            elif state[3]:
+                try:
+                    seconds = (datetime.datetime.strptime(ts, "%Y-%m-%d %H:%M:%S") -
+                               datetime.datetime.strptime(state[3], "%Y-%m-%d %H:%M:%S")).total_seconds()
+                    state[0] += max(seconds, 0)
+                except ValueError:
+                    pass
+                state[3] = None
+        state[1] = is_in
+        state[2] = ts
+    return state
+
+
+def update_presence():
+    """索引の新しい行を presence 表に反映し、{idm: [累計秒, 入室中か, 最後の行の日時, 入室した日時]} を返す"""
+    with index_lock:
+        db = get_index_db()
+        checkpoint = db.execute("SELECT rid, ts, idm FROM presence_checkpoint WHERE id = 0").fetchone()
+        since = 0
+        if checkpoint and db.execute("SELECT 1 FROM entries WHERE rowid = ? AND ts IS ? AND idm IS ?",
+                                     checkpoint).fetchone():
+            since = checkpoint[0]
+        elif checkpoint:
+            print("[update_presence] 保存した位置が索引に無いため、累計滞在時間を数え直します")
+        states = {} if since == 0 else {
+            idm: [total, None if is_in is None else bool(is_in), last_ts, in_since]
+            for idm, total, is_in, last_ts, in_since in db.execute("SELECT * FROM presence")}
+        last = db.execute("SELECT rowid, ts, idm FROM entries ORDER BY rowid DESC LIMIT 1").fetchone()
+        if last is None or last[0] <= since:
+            return states
+
+        rows = {}
+        for idm, ts, is_in in db.execute(
+                "SELECT idm, ts, action IN ('入室', 'IN') FROM entries WHERE rowid > ? AND rowid <= ? "
+                "ORDER BY idm, ts, rowid", (since, last[0])):
+            rows.setdefault(idm, []).append((ts, is_in))
+        recounted = 0
+        for idm, new_rows in rows.items():
+            state = states.get(idm)
+            if state and state[2] is not None and new_rows[0][0] <= state[2]:
+                new_rows = db.execute("SELECT ts, action IN ('入室', 'IN') FROM entries "
+                                      "WHERE idm = ? AND rowid <= ? ORDER BY ts, rowid", (idm, last[0]))
+                state = None
+                recounted += 1
+            states[idm] = advance_presence(state or [0.0, None, None, None], new_rows)
+
+        with db:
+            if since == 0:
+                db.execute("DELETE FROM presence")
+            db.executemany("INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?, ?)",
+                           [(idm, *states[idm]) for idm in rows])
+            db.execute("INSERT OR REPLACE INTO presence_checkpoint VALUES (0, ?, ?, ?)", last)
+        print(f"[update_presence] 索引の {sum(len(r) for r in rows.values())} 行を反映"
+              f"（{len(rows)} 人、うち {recounted} 人は全履歴から数え直し）")
+        return states
+
+
+def roll_stats_day(date_str):
+    """日付が変わっていれば当日の件数を0に戻す（stats_lock を保持して呼ぶ）"""
+    if stats["date"] is None or date_str > stats["date"]:
+        stats["date"] = date_str
+        stats["hourly_in"] = [0] * 24
+        stats["hourly_out"] = [0] * 24
+
+
+def update_stats(idm, was_in, is_in, when=None):
+    """1件の入退室を集計に反映する（idm の state_lock を保持して呼ぶ）"""
+    when = when or datetime.datetime.now()
+    with stats_lock:
+        roll_stats_day(when.strftime("%Y-%m-%d"))
+        if when.strftime("%Y-%m-%d") == stats["date"]:
+            stats["hourly_in" if is_in else "hourly_out"][when.hour] += 1
+        if is_in and not was_in:
+            stats["headcount"] += 1
+            present_since[idm] = when
+        elif was_in and not is_in:
+            stats["headcount"] -= 1
+            since = present_since.pop(idm, None)
+            if since:
+                presence_total[idm] = presence_total.get(idm, 0) + max((when - since).total_seconds(), 0)
+
+
+def rebuild_stats():
+    """索引と entry_state から集計を作り直す（起動時、update_log_index() の後に呼ぶ）"""
+    today = datetime.date.today().strftime("%Y-%m-%d")
+    hourly = {True: [0] * 24, False: [0] * 24}
+    totals = {}
+    last_in = {}
+    with index_lock:
+        db = get_index_db()
+        for hour, is_in, count in db.execute(
+                "SELECT CAST(substr(ts, 12, 2) AS INTEGER), action IN ('入室', 'IN'), COUNT(*) "
+                "FROM entries WHERE date = ? AND action IN ('入室', 'IN', '退室', 'OUT') GROUP BY 1, 2",
+                (today,)):
+            if 0 <= hour < 24:
+                hourly[bool(is_in)][hour] = count
+        for idm, (seconds, is_in, _, in_since) in update_presence().items():
+            totals[idm] = float(seconds or 0)
+            if is_in and in_since:
+                last_in[idm] = in_since
+
+    now = datetime.datetime.now()
+    since = {}
+    for idm, state in dict(entry_state).items():
+        if state:
+            try:
+                since[idm] = datetime.datetime.strptime(last_in[idm], "%Y-%m-%d %H:%M:%S")
+            except (KeyError, ValueError):
+                since[idm] = now
+    with stats_lock:
+        stats.update(date=today, headcount=len(since), hourly_in=hourly[True], hourly_out=hourly[False])
+        presence_total.clear()
+        presence_total.update(totals)
+        present_since.clear()
+        present_since.update(since)
+    print(f"[rebuild_stats] 在室 {len(since)} 人、本日の入室 {sum(hourly[True])} 件、退室 {sum(hourly[False])} 件")
+
+
+def current_stats():
+    with stats_lock:
+        roll_stats_day(datetime.date.today().strftime("%Y-%m-%d"))
+        return {"date": stats["date"], "headcount": stats["headcount"],
+                "hourly_in": list(stats["hourly_in"]), "hourly_out": list(stats["hourly_out"])}
+
+
+def user_stats(idm, users):
+    with stats_lock:
+        seconds = presence_total.get(idm, 0)
+        since = present_since.get(idm)
+    if since:
+        seconds += max((datetime.datetime.now() - since).total_seconds(), 0)
+    return {"idm": idm, "name": users.get(idm, "不明"),
+            "state": "IN" if entry_state.get(idm, False) else "OUT",
+            "presence_seconds": int(seconds)}
+
+
+# ====== 通知の配信（SUBSCRIBE） ======
+# "SUBSCRIBE[,<トピック>...][,NOSELF]" を送った接続は、以降サーバーからの通知専用になる。
+# トピックは ENTER / EXIT / MOTION（省略時はすべて）。NOSELF を付けると同じIPアドレスの
+# クライアントが起こしたイベントは送らない（自分で音を鳴らしているため）。
+# 通知は1行1件で、
+#   ENTER_ALERT,<idm>,<名前>,<日時> / EXIT_ALERT,<idm>,<名前>,<日時>
+#   FORCE_EXIT_ALERT,<人数>,<日時>（強制退室） / MOTION_ALERT,<日時>,<距離>
+#   DROPPED,<件数>（送れずに捨てた件数） / HEARTBEAT（SUBSCRIBE_HEARTBEAT 秒ごと）
+# publish() は購読者ごとのキューに積むだけで送信を待たない。送信は購読者ごとのスレッド
+# （イベントループモードではタスク）が行うため、止まった購読者がいても入退室の処理は遅れない。
+# 送信が追いつかない購読者のキューでは、同じ idm（動き検知は同じ送信元）の未送信の通知を
+# 最新のものに置き換え、それでも SUBSCRIBER_QUEUE_SIZE を超えたら古いものから捨てる。
+# 送信が SUBSCRIBE_SEND_TIMEOUT 秒進まない購読者は切断する。
+SUBSCRIBE_TOPICS = ("ENTER", "EXIT", "MOTION")
+
+
+class Subscriber:
+    """1つの購読接続。送信待ちの通知を上限付きで保持する"""
+    def __init__(self, addr, topics, no_self=False):
+        self.addr = addr
+        self.topics = set(topics)
+        self.no_self = no_self
+        self.lock = threading.Lock()
+        self.pending = collections.OrderedDict()  # 置き換え用のキー → 通知行
+        self.dropped = 0
+        self.sent = 0
+        self.seq = 0
+        self.wakeup = None  # 通知を積んだときに呼ぶ（送信側が設定する）
+
+    def offer(self, topic, line, key=None, origin=None):
+        if topic not in self.topics:
+            return
+        if self.no_self and origin and self.addr and origin == self.addr[0]:
+            return
+        with self.lock:
+            if key is None:
+                self.seq += 1
+                key = self.seq
+            if key in self.pending:
+                del self.pending[key]
+            elif len(self.pending) >= SUBSCRIBER_QUEUE_SIZE:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            self.pending[key] = line
+        if self.wakeup:
+            self.wakeup()
+
+    def take(self):
+        """送信待ちの通知をすべて取り出す"""
+        with self.lock:
+            lines = list(self.pending.values())
+            self.pending.clear()
+            if self.dropped:
+                lines.insert(0, f"DROPPED,{self.dropped}")
+                self.dropped = 0
+        self.sent += len(lines)
+        return lines
+
+
+def parse_subscribe(message, addr):
+    options = [p.strip().upper() for p in message.strip().split(',')[1:] if p.strip()]
+    no_self = "NOSELF" in options
+    topics = [p for p in options if p != "NOSELF"]
+    if any(topic not in SUBSCRIBE_TOPICS for topic in topics):
+        return None
+    return Subscriber(addr, topics or SUBSCRIBE_TOPICS, no_self)
+
+
+def add_subscriber(subscriber):
+    with subscribers_lock:
+        subscribers.add(subscriber)
+    print(f"[SUBSCRIBE] {subscriber.addr} 購読開始 {sorted(subscriber.topics)}")
+
+
+def remove_subscriber(subscriber):
+    with subscribers_lock:
+        subscribers.discard(subscriber)
+    print(f"[SUBSCRIBE] {subscriber.addr} 購読終了（送信 {subscriber.sent} 件）")
+
+
+def publish(topic, line, key=None, origin=None):
+    """全購読者のキューに通知を積む（送信は待たない。どのロックを保持したまま呼んでもよい）"""
+    with subscribers_lock:
+        targets = list(subscribers)
+    for subscriber in targets:
+        subscriber.offer(topic, line, key, origin)
+
+
+def publish_entry(idm, name, is_in, when, addr=None):
+    kind = "ENTER" if is_in else "EXIT"
+    name = name.replace(",", "，").replace("\n", " ")
+    publish(kind, f"{kind}_ALERT,{idm},{name},{when.strftime('%Y-%m-%d %H:%M:%S')}",
+            key=("entry", idm), origin=addr[0] if addr else None)
+
+
+def subscriber_lines(subscriber, woke):
+    """送信する行を返す（通知が無く待ち時間が切れた場合は HEARTBEAT）"""
+    lines = subscriber.take()
+    if not lines and not woke:
+        lines = ["HEARTBEAT"]
+    return ("".join(line + "\n" for line in lines)).encode("utf-8")
+
+
+# ====== 入退室イベントの反映 ======
+def apply_entry_event(users, idm, name, action, scan_timestamp=None, addr=None, event_id=None):
+    """
+    1件の入退室イベントを状態とログに反映し、結果コードを返す。
+    idm の state_lock を保持した状態で呼び出し、save_entry_state() は呼び出し側で行う。
+    event_id が処理済みなら何も反映せず "ENTRY_EVENT_DUPLICATE" を返す。
+    """
+    if idm not in users:
+        return "NOT_REGISTERED"
+    if find_event(event_id):
+        return "ENTRY_EVENT_DUPLICATE"
+    if action in ["入室", "IN"]:
+        was_in = set_entry_state(idm, True)
+    elif action in ["退室", "OUT"]:
+        was_in = set_entry_state(idm, False)
+    else:
+        return "ENTRY_EVENT_FAIL"
+    when = save_log(idm, name, action, scan_timestamp) or datetime.datetime.now()
+    update_stats(idm, was_in, entry_state[idm], when)
+    publish_entry(idm, users[idm], entry_state[idm], when, addr)
+    return "ENTRY_EVENT_OK"
+
+
 # ====== 退室漏れ通知と強制退室処理 ======
 def show_missed_exit_users():
     if os.path.exists(MISSED_EXIT_FILE):
@@ -101,125 +933,538 @@ def show_missed_exit_users():
         os.remove(MISSED_EXIT_FILE)
 
 
-def force_checkout_all(users):
+def force_checkout_all(users, idms=None, before=None):
+    """
+    入室中の全員（idms を渡すとそのうち入室中の人）を退室にし、退室させた人の一覧を返す。
+    before を渡すと、その時刻以降に入室した人（入室時刻が分からない人も）は対象外にする。
+    状態の保存とログの書き込みはそれぞれ1回にまとめる。
+    退室済みの人は対象外なので、何度呼んでも退室の行が重複しない。
+    """
     now = datetime.datetime.now()
-    print(f"{now.strftime('%Y-%m-%d %H:%M:%S')} 全員退室処理実行")
+    timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+    print(f"{timestamp} 全員退室処理実行")
     missed = []
 
-    with lock:
-        for idm, state in entry_state.items():
-            if state:
-                entry_state[idm] = False
-                name = users.get(idm, "不明")
-                save_log(idm, name, "退室")
+    with (all_state_locks() if idms is None else state_locks_for(idms)):
+        for idm in (list(entry_state) if idms is None else idms):
+            if entry_state.get(idm):
+                if before is not None:
+                    with stats_lock:
+                        since = present_since.get(idm)
+                    if since is None or since >= before:
+                        continue
+                set_entry_state(idm, False)
+                update_stats(idm, True, False, now)
                 missed.append({
                     "idm": idm,
-                    "name": name,
-                    "timestamp": now.strftime("%Y-%m-%d %H:%M:%S")
+                    "name": users.get(idm, "不明"),
+                    "timestamp": timestamp
                 })
-
-        save_entry_state()
+        if missed:
+            log_writer.write_many([(now.strftime("%Y-%m-%d"), [timestamp, record["idm"], record["name"], "退室"])
+                                   for record in missed])
+            save_entry_state([record["idm"] for record in missed])
 
     if missed:
+        print(f"[force_checkout_all] {len(missed)} 人を退室にしました")
+        publish("EXIT", f"FORCE_EXIT_ALERT,{len(missed)},{timestamp}")
+        # 同じ日に複数回実行された場合（クライアントからの CHECKOUT_ALL など）はその日の分に追記する
+        previous = []
+        if os.path.exists(MISSED_EXIT_FILE):
+            try:
+                with open(MISSED_EXIT_FILE, "r", encoding="utf-8") as f:
+                    previous = [record for record in json.load(f)
+                                if record.get("timestamp", "")[:10] == timestamp[:10]]
+            except (OSError, ValueError) as e:
+                print(f"[force_checkout_all] {MISSED_EXIT_FILE} 読み込みエラー: {e}")
         with open(MISSED_EXIT_FILE, "w", encoding="utf-8") as f:
-            json.dump(missed, f, ensure_ascii=False, indent=2)
+            json.dump(previous + missed, f, ensure_ascii=False, indent=2)
+    return missed
+
+
+# ====== 定時処理 ======
+# 強制退室（毎日 FORCE_CHECKOUT_TIME）とアーカイブ（ARCHIVE_INTERVAL 秒ごと）は scheduler.py で実行する。
+# 実行記録は SCHEDULER_HISTORY_FILE に残り、JOBS コマンドで確認できる。
+# 強制退室は予定時刻より前に入室した人だけを対象にする。停止中に実行漏れした分を起動後に実行しても、
+# 予定時刻の後に入室し直した人は退室にしない。
+def start_scheduler(users):
+    scheduler.add_daily("force_checkout", FORCE_CHECKOUT_TIME, lambda slot: force_checkout_all(users, before=slot),
+                        catch_up=True, max_delay=FORCE_CHECKOUT_MAX_DELAY, with_slot=True)
+    scheduler.add_interval("archive", ARCHIVE_INTERVAL, run_archival, run_at_start=True)
+    scheduler.add_interval("stats_checkpoint", STATS_CHECKPOINT_INTERVAL, update_presence)
+    scheduler.start()
+
+
+# ====== コマンド処理 ======
+def compress_chunks(chunks):
+    """バイト列のイテレータを1つの zlib ストリームにして少しずつ返す"""
+    compressor = zlib.compressobj(LOG_COMPRESS_LEVEL)
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+class FileResponse:
+    """
+    ファイルの一部を応答として送る。メモリに読み込まず、非圧縮なら sendfile で送る。
+    header はファイル内容の前に付けるバイト列。
+    """
+    def __init__(self, path, offset=0, count=0, header=b"", compress=False):
+        self.path = path
+        self.offset = offset
+        self.count = count
+        self.header = header
+        self.compress = compress
+
+    def iter_chunks(self, chunk_size=65536):
+        yield self.header
+        if self.count:
+            with open(self.path, "rb") as f:
+                f.seek(self.offset)
+                remaining = self.count
+                while remaining > 0:
+                    chunk = f.read(min(chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+
+    def iter_compressed(self):
+        return compress_chunks(self.iter_chunks())
+
+
+class StreamResponse:
+    """長さが事前に分からない応答（検索結果など）を少しずつ送る"""
+    def __init__(self, chunks, compress=False):
+        self.chunks = chunks
+        self.compress = compress
+
+    def iter_chunks(self):
+        return self.chunks
+
+    def iter_compressed(self):
+        return compress_chunks(self.iter_chunks())
+
+
+def execute_command(message, users, addr=None):
+    """
+    1コマンドを処理して (応答, 後処理) を返す。応答はバイト列 / FileResponse / StreamResponse。
+    後処理は None / "shutdown"（送信側を閉じる） / "close"（接続を閉じる） /
+    "subscribe"（応答は Subscriber。以降その接続へ通知を送る）
+    """
+    parts = message.strip().split(',', 4)
+    cmd = parts[0].strip()
+
+    if cmd == "PING":
+        # 接続の死活確認（クライアントの接続プールが使い回す前に送る）
+        return b"PONG", None
+
+    elif cmd == "CHECK" and len(parts) >= 2:
+        idm = parts[1]
+        name = users.get(idm)
+        if name is not None:
+            status = "IN" if entry_state.get(idm, False) else "OUT"
+            return f"REGISTERED,{name},{status}".encode(), None
+        return b"NOT_REGISTERED", None
+
+    elif cmd == "REGISTER" and len(parts) == 3:
+        idm, name = parts[1], parts[2]
+        success = register_user(users, idm, name)
+        return (b"REGISTER_SUCCESS" if success else b"REGISTER_FAIL"), None
+
+    elif cmd in ["ENTER", "EXIT"] and len(parts) == 2:
+        idm = parts[1]
+        with state_lock(idm):
+            if idm in users:
+                was_in = set_entry_state(idm, cmd == "ENTER")
+                save_entry_state([idm])
+                action = "入室" if cmd == "ENTER" else "退室"
+                when = save_log(idm, users[idm], action) or datetime.datetime.now()
+                update_stats(idm, was_in, entry_state[idm], when)
+                publish_entry(idm, users[idm], entry_state[idm], when, addr)
+                return f"{cmd}_OK".encode(), None
+            return b"NOT_REGISTERED", None
+
+    elif cmd == "TOGGLE" and len(parts) in (2, 3, 4):
+        # TOGGLE,<idm>[,<読み取り日時>[,<イベントID>]] → TOGGLE_OK,<名前>,<IN|OUT>,<記録した日時>
+        # 照会・入退室の切り替え・ログの記録を1往復で行う。切り替えはサーバー側の状態を基準にするため
+        # 同じ部屋に複数のカードリーダーがあっても状態が食い違わない。
+        # 処理済みのイベントIDなら切り替えずに最初の応答を返す
+        idm = parts[1].strip()
+        scan_timestamp = parts[2].strip() if len(parts) >= 3 else None
+        event_id = parts[3].strip() if len(parts) == 4 else None
+        if event_id and not valid_event_id(event_id):
+            return b"TOGGLE_FAIL", None
+        with state_lock(idm):
+            if idm not in users:
+                return b"NOT_REGISTERED", None
+            duplicate = find_event(event_id)
+            if duplicate:
+                print(f"[TOGGLE] {addr} 処理済みのイベント {event_id}")
+                return duplicate.encode("utf-8"), None
+            is_in = not entry_state.get(idm, False)
+            was_in = set_entry_state(idm, is_in)
+            when = save_log(idm, users[idm], "入室" if is_in else "退室", scan_timestamp) or datetime.datetime.now()
+            status = "IN" if is_in else "OUT"
+            response = f"TOGGLE_OK,{users[idm]},{status},{when.strftime('%Y-%m-%d %H:%M:%S')}"
+            save_entry_state([idm], [(event_id, response)] if event_id else ())
+            update_stats(idm, was_in, is_in, when)
+            publish_entry(idm, users[idm], is_in, when, addr)
+        return response.encode("utf-8"), None
+
+    elif cmd == "ENTRY_EVENT" and (len(parts) == 4 or len(parts) == 5):
+        # ENTRY_EVENT,<idm>,<名前>,<入室|退室>[,<読み取り日時>[,<イベントID>]]
+        idm, name, action = parts[1], parts[2], parts[3]
+        scan_timestamp, _, event_id = parts[4].partition(',') if len(parts) == 5 else (None, "", "")
+        event_id = event_id.strip() or None
+        if event_id and not valid_event_id(event_id):
+            return b"ENTRY_EVENT_FAIL", "close"
+        with state_lock(idm):
+            result = apply_entry_event(users, idm, name, action, scan_timestamp, addr, event_id)
+            if result == "ENTRY_EVENT_OK":
+                save_entry_state([idm], [(event_id, result)] if event_id else ())
+            elif result == "ENTRY_EVENT_DUPLICATE":  # 処理済みなので受け付けたことにする
+                print(f"[ENTRY_EVENT] {addr} 処理済みのイベント {event_id}")
+                result = "ENTRY_EVENT_OK"
+        return result.encode(), ("close" if result == "ENTRY_EVENT_FAIL" else None)
+
+    elif cmd == "ENTRY_EVENT_BATCH":
+        # ENTRY_EVENT_BATCH,[{"idm":..,"name":..,"action":..,"scan_timestamp":..,"event_id":..}, ...]
+        # 処理済みのイベントIDは反映せず ENTRY_EVENT_OK を返す
+        try:
+            events = json.loads(message.strip().split(',', 1)[1])
+            if not isinstance(events, list):
+                raise ValueError("イベントの配列ではありません")
+        except (IndexError, ValueError) as e:
+            print(f"[ENTRY_EVENT_BATCH] 解析エラー: {e}")
+            return b"ENTRY_EVENT_BATCH_FAIL", None
+        results = []
+        changed = []
+        processed = []
+        processed_ids = set()
+        duplicates = 0
+        # 文字列でない idm はロックの対象にせず、下のイベントごとの検証で ENTRY_EVENT_FAIL にする
+        idms = [event.get("idm") for event in events
+                if isinstance(event, dict) and isinstance(event.get("idm"), str)]
+        with state_locks_for(idms):
+            for event in events:
+                try:
+                    if not isinstance(event["idm"], str):
+                        raise TypeError("idm が文字列ではありません")
+                    event_id = event.get("event_id")
+                    if event_id is not None and not (isinstance(event_id, str) and valid_event_id(event_id)):
+                        raise ValueError("不正なイベントID")
+                    if event_id and event_id in processed_ids:
+                        result = "ENTRY_EVENT_DUPLICATE"  # 同じバッチ内の重複
+                    else:
+                        result = apply_entry_event(users, event["idm"], event["name"], event["action"],
+                                                   event.get("scan_timestamp"), addr, event_id)
+                except (KeyError, TypeError, AttributeError, ValueError):
+                    result = "ENTRY_EVENT_FAIL"
+                if result == "ENTRY_EVENT_DUPLICATE":
+                    duplicates += 1
+                    result = "ENTRY_EVENT_OK"
+                elif result == "ENTRY_EVENT_OK":
+                    changed.append(event["idm"])
+                    if event_id:
+                        processed.append((event_id, result))
+                        processed_ids.add(event_id)
+                results.append(result)
+            if changed:
+                save_entry_state(changed, processed)
+        print(f"[ENTRY_EVENT_BATCH] {addr} {len(changed)}/{len(results)} 件反映（処理済み {duplicates} 件）")
+        return ("ENTRY_EVENT_BATCH_OK," + json.dumps(results)).encode(), None
+
+    elif cmd == "CHECKOUT_ALL":
+        # CHECKOUT_ALL[,["idm", ...]] → CHECKOUT_ALL_OK,[{"idm":..,"name":..,"timestamp":..}, ...]
+        # 入室中の全員（リスト指定時はそのうち入室中の人）を退室にする。既に退室済みなら空のリストを返す
+        idms = None
+        body = message.strip().partition(',')[2].strip()
+        if body:
+            try:
+                idms = json.loads(body)
+                if not isinstance(idms, list) or not all(isinstance(idm, str) for idm in idms):
+                    raise ValueError("idm の配列ではありません")
+            except ValueError as e:
+                print(f"[CHECKOUT_ALL] 解析エラー: {e}")
+                return b"CHECKOUT_ALL_FAIL", None
+        checked_out = force_checkout_all(users, idms)
+        print(f"[CHECKOUT_ALL] {addr} {len(checked_out)} 人を退室")
+        return ("CHECKOUT_ALL_OK," + json.dumps(checked_out, ensure_ascii=False)).encode("utf-8"), None
+
+    elif cmd == "GET_ENTRY_STATE":
+        # GET_ENTRY_STATE → 全員の状態（JSON配列）
+        # GET_ENTRY_STATE,<epoch>,<版> → {"epoch", "version", "full", "entries"}
+        #   epoch が一致すればその版より後に変わった idm だけ（full=false）、
+        #   一致しない（初回・サーバー再起動後）場合は全員（full=true）を返す
+        if len(parts) < 2:
+            return entry_state_snapshot(users)[1], None
+        try:
+            epoch, since = parts[1].strip(), int(parts[2])
+        except (IndexError, ValueError):
+            return b"GET_ENTRY_STATE_FAIL", None
+        if epoch == state_epoch and since > 0:
+            version, entries = entry_state_delta(since, users)
+            data, full = json.dumps(entries, ensure_ascii=False).encode("utf-8"), "false"
+        else:
+            (version, data), full = entry_state_snapshot(users), "true"
+        header = f'{{"epoch": "{state_epoch}", "version": {version}, "full": {full}, "entries": '
+        return header.encode() + data + b"}", None
+
+    elif cmd == "STATS":
+        # STATS → 在室人数と当日の時間帯別件数 / STATS,<idm> → その人の累計滞在時間
+        idm = parts[1].strip() if len(parts) >= 2 else ""
+        data = user_stats(idm, users) if idm else current_stats()
+        return json.dumps(data, ensure_ascii=False).encode("utf-8"), None
+
+    elif cmd == "MOTION":
+        # MOTION[,<距離>] : クライアントが受けた人感センサーの検知を購読者へ配信する
+        distance = parts[1].strip().replace("\n", " ") if len(parts) >= 2 else "Unknown"
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        origin = addr[0] if addr else None
+        publish("MOTION", f"MOTION_ALERT,{now},{distance}", key=("motion", origin), origin=origin)
+        return b"MOTION_OK", None
+
+    elif cmd == "SUBSCRIBE":
+        subscriber = parse_subscribe(message, addr)
+        if subscriber is None:
+            return b"SUBSCRIBE_FAIL", None
+        return subscriber, "subscribe"
+
+    elif cmd == "JOBS":
+        # 定時処理ごとの実行記録（最後に実行した時刻・かかった時間・次の予定）
+        return json.dumps(scheduler.history(), ensure_ascii=False).encode("utf-8"), None
+
+    elif cmd == "GET_LOG":
+        # GET_LOG[,<日付>][,zlib] : 日付省略時は当日。zlib を付けると（従来形式でも）圧縮して返す
+        options = [p.strip() for p in parts[1:]]
+        compress = "zlib" in options
+        options = [p for p in options if p != "zlib"]
+        try:
+            date_str = (datetime.datetime.strptime(options[0], "%Y-%m-%d").date() if options
+                        else datetime.date.today()).strftime("%Y-%m-%d")
+        except ValueError:
+            return b"GET_LOG_FAIL", None
+        print(f"[GET_LOG] {addr} からのログ取得リクエスト ({date_str})")
+        return day_log_response(open_day_log(date_str), compress=compress), "shutdown"
+
+    elif cmd == "GET_LOG_SINCE" and len(parts) == 3:
+        # GET_LOG_SINCE,<日付>,<バイト位置> → "LOG_DELTA,<日付>,<開始位置>,<新しい位置>\n" + 差分
+        # 指定位置がファイルより大きい場合（ファイルが作り直された等）は先頭から返す
+        try:
+            date_str = datetime.datetime.strptime(parts[1], "%Y-%m-%d").strftime("%Y-%m-%d")
+            offset = int(parts[2])
+        except ValueError:
+            return b"GET_LOG_SINCE_FAIL", None
+        day_log = open_day_log(date_str)
+        size = day_log[0]
+        start = offset if 0 <= offset <= size else 0
+        print(f"[GET_LOG_SINCE] {addr} {date_str} {start}→{size}")
+        header = f"LOG_DELTA,{date_str},{start},{size}\n".encode()
+        return day_log_response(day_log, start, header), "shutdown"
+
+    elif cmd == "QUERY_LOG":
+        # QUERY_LOG,{"idm":..,"name":..,"action":..,"since":..,"until":..,"limit":..}[,zlib]
+        # 応答は見出し付きCSV（全日分の索引から検索）
+        body, _, option = message.strip().partition(',')[2].rpartition('}')
+        try:
+            filters = json.loads(body + '}')
+            if not isinstance(filters, dict):
+                raise ValueError("条件がオブジェクトではありません")
+            sql, args = build_log_query(filters)
+        except (ValueError, TypeError, AttributeError) as e:
+            print(f"[QUERY_LOG] 解析エラー: {e}")
+            return b"QUERY_LOG_FAIL", None
+        print(f"[QUERY_LOG] {addr} {filters}")
+        log_writer.flush()
+        return StreamResponse(query_log_index(sql, args), compress=(option == ",zlib")), "shutdown"
+
+    return b"UNKNOWN_COMMAND", None
+
+
+# ====== フレーム化プロトコル（v2） ======
+# 接続直後にクライアントが "HELLO,<バージョン>[,<機能>...]\n" を送るとフレームモードになる。
+# 以降は双方向とも "<リクエストID>,<ペイロード長>\n<ペイロード>" の形式で、
+# 1接続で複数コマンドを続けて送れる（応答はリクエスト順に返す）。
+# HELLO で zlib を交渉した場合、ログ送信や検索の応答は "<リクエストID>,z\n" に続く
+# zlib ストリーム（終端はストリーム自身で判別）になる。
+# 長さが事前に分からない応答（検索結果）は "<リクエストID>,c\n" に続けて
+# "<長さ>\n<データ>" を繰り返し、長さ 0 で終わる。
+# HELLO で始まらない接続は従来通り recv 1回 = 1コマンドとして扱う。
+def negotiate_hello(line):
+    """HELLO行を解釈し、(セッション設定, 応答バイト列) を返す"""
+    fields = line.decode(errors='ignore').strip().split(',')
+    try:
+        version = min(int(fields[1]), PROTOCOL_VERSION)
+    except (IndexError, ValueError):
+        version = PROTOCOL_VERSION
+    features = [f for f in fields[2:] if f in PROTOCOL_FEATURES]
+    session = {"version": version, "zlib": "zlib" in features}
+    return session, ",".join(["HELLO_OK", str(version)] + features).encode() + b"\n"
+
+
+def encode_frame(req_id, payload):
+    return f"{req_id},{len(payload)}\n".encode() + payload
+
+
+def pop_frames(buffer):
+    """
+    bytearray から完全なフレームを取り出し [(リクエストID, ペイロード), ...] を返す。
+    取り出した分は buffer から削除する。ヘッダ不正時は ValueError。
+    """
+    frames = []
+    while True:
+        nl = buffer.find(b"\n")
+        if nl < 0:
+            if len(buffer) > 64:
+                raise ValueError("フレームヘッダが長すぎます")
+            break
+        req_id, sep, length = buffer[:nl].decode(errors='ignore').partition(',')
+        length = int(length)
+        if not sep or not req_id.strip() or length < 0 or length > MAX_FRAME_SIZE:
+            raise ValueError(f"不正なフレームヘッダ: {bytes(buffer[:nl])!r}")
+        end = nl + 1 + length
+        if len(buffer) < end:
+            break
+        frames.append((req_id.strip(), bytes(buffer[nl + 1:end])))
+        del buffer[:end]
+    return frames
+
+
+def execute_frames(frames, users, addr=None):
+    """受信済みフレームを順に処理し、([(リクエストID, 応答), ...], 接続を閉じるか) を返す"""
+    results = []
+    for req_id, payload in frames:
+        response, after = execute_command(payload.decode(errors='ignore'), users, addr)
+        if after == "subscribe":  # 通知の購読は従来形式の接続でのみ受け付ける
+            response = b"SUBSCRIBE_FAIL"
+        results.append((req_id, response))
+        if after == "close":
+            return results, True
+    return results, False
+
+
+# ====== 応答の送信 ======
+def send_response(conn, response, compress=False):
+    if isinstance(response, bytes):
+        conn.sendall(response)
+    elif compress or response.compress:
+        for chunk in response.iter_compressed():
+            conn.sendall(chunk)
+    elif isinstance(response, FileResponse):
+        conn.sendall(response.header)
+        if response.count:
+            with open(response.path, "rb") as f:
+                conn.sendfile(f, response.offset, response.count)
+    else:
+        for chunk in response.iter_chunks():
+            conn.sendall(chunk)
+
+
+def frame_header(req_id, response, session):
+    if isinstance(response, bytes):
+        return f"{req_id},{len(response)}\n".encode()
+    if session["zlib"]:
+        return f"{req_id},z\n".encode()
+    if isinstance(response, FileResponse):
+        return f"{req_id},{len(response.header) + response.count}\n".encode()
+    return f"{req_id},c\n".encode()
+
+
+def iter_chunked(chunks):
+    for chunk in chunks:
+        if chunk:
+            yield f"{len(chunk)}\n".encode() + chunk
+    yield b"0\n"
+
+
+def send_frames(conn, results, session):
+    pending = []
+    for req_id, response in results:
+        if isinstance(response, bytes):
+            pending.append(encode_frame(req_id, response))
+            continue
+        pending.append(frame_header(req_id, response, session))
+        conn.sendall(b"".join(pending))
+        pending = []
+        if isinstance(response, StreamResponse) and not session["zlib"]:
+            for chunk in iter_chunked(response.iter_chunks()):
+                conn.sendall(chunk)
+        else:
+            send_response(conn, response, compress=session["zlib"])
+    if pending:
+        conn.sendall(b"".join(pending))
 
 
-def daily_checker(users):
+async def send_chunks_async(writer, chunks, executor):
+    # チャンクの生成（ファイル読み込み・圧縮・検索）はスレッドプールで行う
+    loop = asyncio.get_running_loop()
     while True:
-        now = datetime.datetime.now()
-        if now.hour == 20 and now.minute == 0:
-            force_checkout_all(users)
-            time.sleep(60)  # 1分間隔で重複実行防止
-        time.sleep(10)
+        chunk = await loop.run_in_executor(executor, next, chunks, None)
+        if chunk is None:
+            break
+        writer.write(chunk)
+        await writer.drain()
+
+
+async def send_response_async(writer, response, executor, compress=False):
+    loop = asyncio.get_running_loop()
+    if isinstance(response, bytes):
+        writer.write(response)
+    elif compress or response.compress:
+        await send_chunks_async(writer, response.iter_compressed(), executor)
+    elif isinstance(response, FileResponse):
+        writer.write(response.header)
+        await writer.drain()
+        if response.count:
+            with open(response.path, "rb") as f:
+                await loop.sendfile(writer.transport, f, response.offset, response.count)
+    else:
+        await send_chunks_async(writer, iter(response.iter_chunks()), executor)
+    await writer.drain()
+
+
+async def send_frames_async(writer, results, session, executor):
+    for req_id, response in results:
+        if isinstance(response, bytes):
+            writer.write(encode_frame(req_id, response))
+            continue
+        writer.write(frame_header(req_id, response, session))
+        if isinstance(response, StreamResponse) and not session["zlib"]:
+            await send_chunks_async(writer, iter_chunked(response.iter_chunks()), executor)
+        else:
+            await send_response_async(writer, response, executor, compress=session["zlib"])
+    await writer.drain()
 
 
-# ====== クライアント処理 ======
+# ====== クライアント処理（スレッドモード） ======
 def handle_client(conn, addr, users):
     print(f"{addr} 接続")
     try:
         with conn:
+            first = True
             while True:
                 data = conn.recv(4096)
                 if not data:
                     break
-                parts = data.decode(errors='ignore').strip().split(',', 4)
-                cmd = parts[0].strip()
-
-                if cmd == "CHECK" and len(parts) >= 2:
-                    idm = parts[1]
-                    with lock:
-                        if idm in users:
-                            state = entry_state.get(idm, False)
-                            name = users[idm]
-                            status = "IN" if state else "OUT"
-                            conn.sendall(f"REGISTERED,{name},{status}".encode())
-                        else:
-                            conn.sendall(b"NOT_REGISTERED")
-
-                elif cmd == "REGISTER" and len(parts) == 3:
-                    idm, name = parts[1], parts[2]
-                    success = register_user(users, idm, name)
-                    conn.sendall(b"REGISTER_SUCCESS" if success else b"REGISTER_FAIL")
-
-                elif cmd in ["ENTER", "EXIT"] and len(parts) == 2:
-                    idm = parts[1]
-                    with lock:
-                        if idm in users:
-                            entry_state[idm] = (cmd == "ENTER")
-                            save_entry_state()
-                            action = "入室" if cmd == "ENTER" else "退室"
-                            save_log(idm, users[idm], action)
-                            conn.sendall(f"{cmd}_OK".encode())
-                        else:
-                            conn.sendall(b"NOT_REGISTERED")
-
-                elif cmd == "ENTRY_EVENT" and (len(parts) == 4 or len(parts) == 5):
-                    idm, name, action = parts[1], parts[2], parts[3]
-                    scan_timestamp = parts[4] if len(parts) == 5 else None
-                    with lock:
-                        if idm in users:
-                            if action in ["入室", "IN"]:
-                                entry_state[idm] = True
-                                action_log = "入室"
-                            elif action in ["退室", "OUT"]:
-                                entry_state[idm] = False
-                                action_log = "退室"
-                            else:
-                                conn.sendall(b"ENTRY_EVENT_FAIL")
-                                return
-
-                            save_entry_state()
-                            save_log(idm, name, action, scan_timestamp)
-                            conn.sendall(b"ENTRY_EVENT_OK")
-                        else:
-                            conn.sendall(b"NOT_REGISTERED")
-
-                elif cmd == "GET_ENTRY_STATE":
-                    with lock:
-                        entries = [
-                            {"idm": idm, "name": users.get(idm, "不明"), "state": "IN" if state else "OUT"}
-                            for idm, state in entry_state.items()
-                        ]
-                        data = json.dumps(entries, ensure_ascii=False)
-                        conn.sendall(data.encode("utf-8"))
-
-                elif cmd == "GET_LOG":
-                    print(f"[GET_LOG] {addr} からのログ取得リクエスト")
-                    today_str = datetime.date.today().strftime("%Y-%m-%d")
-                    log_filename = f"entry_log_{today_str}.csv"
-                    if os.path.exists(log_filename):
-                        with open(log_filename, "r", encoding="utf-8") as f:
-                            log_content = f.read()
-                        conn.sendall(log_content.encode("utf-8"))
-                    else:
-                        conn.sendall("".encode("utf-8"))
+                if first and data.startswith(b"HELLO"):
+                    serve_framed(conn, addr, users, bytearray(data))
+                    break
+                first = False
+                response, after = execute_command(data.decode(errors='ignore'), users, addr)
+                if after == "subscribe":
+                    serve_subscriber(conn, response)
+                    return
+                send_response(conn, response)
+                if after == "close":
+                    return
+                if after == "shutdown":
                     try:
                         conn.shutdown(socket.SHUT_WR)
                     except Exception as e:
                         print(f"[GET_LOG] shutdownエラー: {e}")
-                else:
-                    conn.sendall(b"UNKNOWN_COMMAND")
 
     except Exception as e:
         print(f"[handle_client] 通信エラー: {e}")
@@ -227,22 +1472,200 @@ def handle_client(conn, addr, users):
         print(f"{addr} 切断")
 
 
-# ====== メイン処理 ======
-if __name__ == "__main__":
-    users = load_users()
-    show_missed_exit_users()
-    load_entry_state()
+def serve_framed(conn, addr, users, buffer):
+    while b"\n" not in buffer:
+        chunk = conn.recv(4096)
+        if not chunk:
+            return
+        buffer += chunk
+    line, _, rest = bytes(buffer).partition(b"\n")
+    session, reply = negotiate_hello(line)
+    conn.sendall(reply)
+    print(f"{addr} フレームモード v{session['version']}")
+
+    buffer = bytearray(rest)
+    while True:
+        try:
+            frames = pop_frames(buffer)
+        except ValueError as e:
+            print(f"[serve_framed] {e}")
+            conn.sendall(encode_frame("0", b"PROTOCOL_ERROR"))
+            return
+        if frames:
+            results, close = execute_frames(frames, users, addr)
+            send_frames(conn, results, session)
+            if close:
+                return
+        chunk = conn.recv(65536)
+        if not chunk:
+            return
+        buffer += chunk
+
+
+def serve_subscriber(conn, subscriber):
+    event = threading.Event()
+    subscriber.wakeup = event.set
+    add_subscriber(subscriber)
+    try:
+        conn.settimeout(SUBSCRIBE_SEND_TIMEOUT)
+        conn.sendall(b"SUBSCRIBE_OK\n")
+        while True:
+            woke = event.wait(SUBSCRIBE_HEARTBEAT)
+            event.clear()
+            data = subscriber_lines(subscriber, woke)
+            if data:
+                conn.sendall(data)
+    except OSError as e:
+        print(f"[serve_subscriber] {subscriber.addr} 送信エラー: {e}")
+    finally:
+        remove_subscriber(subscriber)
 
-    threading.Thread(target=daily_checker, args=(users,), daemon=True).start()
 
+def run_threaded_server(users):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((HOST, PORT))
         s.listen()
-        print(f"サーバー起動: {HOST}:{PORT}")
+        print(f"サーバー起動（スレッドモード）: {HOST}:{PORT}")
         while True:
             try:
                 conn, addr = s.accept()
                 threading.Thread(target=handle_client, args=(conn, addr, users), daemon=True).start()
             except Exception as e:
                 print(f"[main] 接続受付エラー: {e}")
+
+
+# ====== クライアント処理（イベントループモード） ======
+# 1つのイベントループで全接続を捌き、ファイルI/Oを伴うコマンド処理は
+# 上限付きのスレッドプールに逃がす
+async def handle_client_async(reader, writer, users, executor):
+    addr = writer.get_extra_info("peername")
+    print(f"{addr} 接続")
+    loop = asyncio.get_running_loop()
+    try:
+        first = True
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            if first and data.startswith(b"HELLO"):
+                await serve_framed_async(reader, writer, addr, users, executor, bytearray(data))
+                break
+            first = False
+            response, after = await loop.run_in_executor(
+                executor, execute_command, data.decode(errors='ignore'), users, addr)
+            if after == "subscribe":
+                await serve_subscriber_async(writer, response)
+                break
+            await send_response_async(writer, response, executor)
+            if after == "close":
+                break
+            if after == "shutdown":
+                try:
+                    writer.write_eof()
+                except Exception as e:
+                    print(f"[GET_LOG] shutdownエラー: {e}")
+    except Exception as e:
+        print(f"[handle_client_async] 通信エラー: {e}")
+    finally:
+        writer.close()
+        print(f"{addr} 切断")
+
+
+async def serve_framed_async(reader, writer, addr, users, executor, buffer):
+    loop = asyncio.get_running_loop()
+    while b"\n" not in buffer:
+        chunk = await reader.read(4096)
+        if not chunk:
+            return
+        buffer += chunk
+    line, _, rest = bytes(buffer).partition(b"\n")
+    session, reply = negotiate_hello(line)
+    writer.write(reply)
+    print(f"{addr} フレームモード v{session['version']}")
+
+    buffer = bytearray(rest)
+    while True:
+        try:
+            frames = pop_frames(buffer)
+        except ValueError as e:
+            print(f"[serve_framed_async] {e}")
+            writer.write(encode_frame("0", b"PROTOCOL_ERROR"))
+            await writer.drain()
+            return
+        if frames:
+            results, close = await loop.run_in_executor(executor, execute_frames, frames, users, addr)
+            await send_frames_async(writer, results, session, executor)
+            if close:
+                return
+        chunk = await reader.read(65536)
+        if not chunk:
+            return
+        buffer += chunk
+
+
+async def serve_subscriber_async(writer, subscriber):
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+
+    def wakeup():
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:  # イベントループが終了済み
+            pass
+
+    subscriber.wakeup = wakeup
+    add_subscriber(subscriber)
+    try:
+        writer.write(b"SUBSCRIBE_OK\n")
+        await asyncio.wait_for(writer.drain(), SUBSCRIBE_SEND_TIMEOUT)
+        while True:
+            try:
+                await asyncio.wait_for(event.wait(), SUBSCRIBE_HEARTBEAT)
+                woke = True
+            except asyncio.TimeoutError:
+                woke = False
+            event.clear()
+            data = subscriber_lines(subscriber, woke)
+            if data:
+                writer.write(data)
+                await asyncio.wait_for(writer.drain(), SUBSCRIBE_SEND_TIMEOUT)
+    except (OSError, asyncio.TimeoutError) as e:
+        print(f"[serve_subscriber_async] {subscriber.addr} 送信エラー: {e!r}")
+    finally:
+        remove_subscriber(subscriber)
+
+
+async def serve_async(users):
+    executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+    server = await asyncio.start_server(
+        lambda r, w: handle_client_async(r, w, users, executor), HOST, PORT, reuse_address=True)
+    print(f"サーバー起動（イベントループモード）: {HOST}:{PORT}")
+    async with server:
+        await server.serve_forever()
+
+
+def run_async_server(users):
+    asyncio.run(serve_async(users))
+
+
+# ====== メイン処理 ======
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="入退室管理サーバー")
+    parser.add_argument("--mode", choices=["thread", "async"], default=SERVER_MODE,
+                        help="thread: 接続ごとにスレッド / async: イベントループ")
+    args = parser.parse_args()
+
+    users = load_users()
+    show_missed_exit_users()
+    load_entry_state()
+    update_log_index()  # 未索引分の取り込み（初回は全日分のため時間がかかる）
+    rebuild_stats()
+
+    start_scheduler(users)
+    threading.Thread(target=entry_state_compactor, daemon=True).start()
+
+    if args.mode == "async":
+        run_async_server(users)
+    else:
+        run_threaded_server(users)